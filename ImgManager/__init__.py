@@ -1,17 +1,53 @@
+import threading
 from flask import Flask
-from ImgManager.config import DevConfig
-from flask_sqlalchemy import SQLAlchemy
+from ImgManager.config import from_environment
+from ImgManager.database import TunedSQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 
-# need an app before we import models because models need it
-app = Flask(__name__)
-app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
-app.config.from_object(DevConfig)
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+# extensions are bound to an app by create_app, models import them before any app exists
+db = TunedSQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+login_manager.login_view = 'api.login'
 login_manager.login_message_category = 'info'
 
-from ImgManager import routes
+_app_lock = threading.Lock()
+
+
+def create_app(config=None):
+    """A new app configured from config (default: IMGMANAGER_CONFIG), with the models and routes.
+
+    Its database is left alone, see schema.upgrade_database. Caches,
+    indexes and metrics live in their modules, apps of the same process
+    share them.
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
+    app.config.from_object(config or from_environment())
+    db.init_app(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+
+    from ImgManager import models, schema, queryplan
+    from ImgManager.metrics import Instrumentation
+    from ImgManager.uploads import UploadRequest
+    from ImgManager.routes import api
+    Instrumentation(app)
+    app.request_class = UploadRequest
+    app.register_blueprint(api)
+    return app
+
+
+def __getattr__(name):
+    # the default app is built by the first `from ImgManager import app`, so
+    # importing a module of the package does not load the routes
+    if name != "app":
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    with _app_lock:
+        if "app" not in globals():
+            app = create_app()
+            # its models can be queried outside of an app context
+            db.app = app
+            globals()["app"] = app
+    return globals()["app"]
@@ -0,0 +1,149 @@
+import struct
+import tarfile
+import zlib
+
+ZIP_LOCAL_HEADER = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR = b'PK\x07\x08'
+ZIP64_EXTRA_ID = 0x0001
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+class PushbackStream(object):
+    """A read-only stream that can be given back bytes it read too far."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = b''
+
+    def read(self, size):
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data
+        return self.stream.read(size)
+
+    def read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ArchiveError("Archive is truncated.")
+            data += chunk
+        return data
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+
+class _StoredEntry(object):
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+
+    def read(self, size=64 * 1024):
+        if not self.remaining:
+            return b''
+        data = self.stream.read_exact(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+
+class _DeflatedEntry(object):
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def read(self, size=64 * 1024):
+        while not self.inflater.eof:
+            data = self.inflater.unconsumed_tail
+            if not data:
+                data = self.stream.read(self.chunk_size)
+                if not data:
+                    raise ArchiveError("Archive is truncated.")
+            # the deflate stream tells where it ends, its size may only come after it
+            data = self.inflater.decompress(data, size)
+            if self.inflater.eof:
+                self.stream.unread(self.inflater.unused_data)
+            if data:
+                return data
+        return b''
+
+
+def iter_zip(stream):
+    """Yield (name, reader) for each file of a zip read front to back.
+
+    Only local headers are used, so the archive is processed as it arrives
+    and the central directory at its end is never needed. Stored entries
+    must give their size in the local header, deflated ones may use a data
+    descriptor. Readers must be used before moving to the next entry.
+    """
+    stream = PushbackStream(stream)
+    while True:
+        signature = stream.read_exact(4)
+        if signature != ZIP_LOCAL_HEADER:
+            # central directory: no more file data
+            return
+        (_, flags, method, _, _, _, compressed_size, _, name_length, extra_length) = \
+            struct.unpack('<HHHHHIIIHH', stream.read_exact(26))
+        raw_name = stream.read_exact(name_length)
+        extra = stream.read_exact(extra_length)
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        zip64 = compressed_size == 0xFFFFFFFF or _has_zip64_extra(extra)
+        if zip64 and compressed_size == 0xFFFFFFFF:
+            compressed_size = _zip64_compressed_size(extra)
+
+        if flags & 0x1:
+            raise ArchiveError("Encrypted zip entries are not supported.")
+        if method == 0:
+            if flags & 0x8:
+                raise ArchiveError("Stored zip entries need their size in the local header.")
+            reader = _StoredEntry(stream, compressed_size)
+        elif method == 8:
+            reader = _DeflatedEntry(stream)
+        else:
+            raise ArchiveError("Unsupported zip compression method {}.".format(method))
+
+        if not name.endswith('/'):
+            yield name, reader
+        # skip what the consumer did not read
+        while reader.read():
+            pass
+        if flags & 0x8:
+            # optional signature, crc, then the compressed and uncompressed sizes
+            if stream.read_exact(4) == ZIP_DATA_DESCRIPTOR:
+                stream.read_exact(4)
+            stream.read_exact(16 if zip64 else 8)
+
+
+def _has_zip64_extra(extra):
+    return any(header_id == ZIP64_EXTRA_ID for header_id, _ in _iter_extra(extra))
+
+
+def _zip64_compressed_size(extra):
+    for header_id, data in _iter_extra(extra):
+        if header_id == ZIP64_EXTRA_ID:
+            # uncompressed size comes first, then the compressed size
+            return struct.unpack('<QQ', data[:16])[1]
+    raise ArchiveError("Missing zip64 sizes.")
+
+
+def _iter_extra(extra):
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[offset:offset + 4])
+        yield header_id, extra[offset + 4:offset + 4 + size]
+        offset += 4 + size
+
+
+def iter_tar(stream):
+    """Yield (name, reader) for each regular file of a (possibly compressed) tar stream."""
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+    except tarfile.TarError as e:
+        raise ArchiveError(str(e))
@@ -0,0 +1,279 @@
+import asyncio
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileWrapper(object):
+    """wsgi.file_wrapper of the ASGI adapter: marks a file body so it is read without a request thread.
+
+    Iterating it works like werkzeug's FileWrapper, for the code that does.
+    """
+
+    def __init__(self, file, buffer_size=64 * 1024):
+        self.file = file
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read(self.buffer_size)
+        if data:
+            return data
+        raise StopIteration()
+
+    def seekable(self):
+        return hasattr(self.file, "seekable") and self.file.seekable()
+
+    def seek(self, *args):
+        self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def _file_body(iterable):
+    """(FileWrapper, start, end) when a response body is a file, or a range of one (werkzeug's _RangeWrapper)."""
+    if isinstance(iterable, FileWrapper):
+        return iterable, None, None
+    inner = getattr(iterable, "iterable", None)
+    if isinstance(inner, FileWrapper) and inner.seekable() and hasattr(iterable, "start_byte"):
+        return inner, iterable.start_byte, iterable.end_byte
+    return None
+
+
+class ASGIAdapter(object):
+    """Serves a WSGI app, the Flask app, to an ASGI server.
+
+    The routes still run on threads, since Flask, Flask-SQLAlchemy and the
+    database driver are synchronous. What the adapter keeps off those
+    threads is waiting on clients:
+
+    - request bodies are received on the event loop, spooled to memory and
+      past spool_bytes to a temporary file, before a thread runs the route;
+    - file responses (pictures, variants) are read in chunks by the loop's
+      executor and sent as the client takes them;
+    - other responses are pulled from the app up to buffer_bytes, which
+      holds every JSON response.
+
+    The thread goes back to the pool as soon as the route returned, before
+    any of the response is sent. Only long streamed bodies (unpaginated
+    listings, album exports) keep theirs, to produce each chunk on: their
+    generator runs in Flask's contexts and the SQLAlchemy session of the
+    route, which belong to the thread it started on. bcrypt work
+    already runs on its own pool; Pillow work runs on the request thread,
+    like the rest of the route. At most `threads` requests run app code at
+    once, the others wait on the loop without holding a thread.
+    """
+
+    def __init__(self, app, threads=32, spool_bytes=64 * 1024, buffer_bytes=256 * 1024, max_body=None):
+        self.app = app
+        self.threads = threads
+        self.spool_bytes = spool_bytes
+        self.buffer_bytes = buffer_bytes
+        self.max_body = max_body
+        self.idle = None
+        self.workers = []
+
+    @classmethod
+    def from_app(cls, app):
+        config = app.config
+        return cls(app, config.get("ASGI_THREADS", 32), config.get("ASGI_SPOOL_BYTES", 64 * 1024),
+                   config.get("ASGI_BUFFER_BYTES", 256 * 1024), config.get("MAX_CONTENT_LENGTH"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            # no websockets
+            return
+
+        body = await self._read_body(scope, receive)
+        if body is None:
+            return
+        if body is False:
+            return await self._send_simple(send, 413, b'{"code":413,"msg":"Request body is too large."}\n')
+
+        loop = asyncio.get_event_loop()
+        worker = await self._lease()
+        try:
+            started, buffered, stream, file_body = await loop.run_in_executor(worker, self._start,
+                                                                              self._environ(scope, body))
+            if stream is None:
+                # the rest is sent without it, a slow client does not hold a thread
+                self.idle.put_nowait(worker)
+                worker = None
+            await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+            if file_body is not None:
+                await self._send_file(send, *file_body)
+            else:
+                await self._send_body(worker, send, buffered, stream)
+        finally:
+            if worker is not None:
+                self.idle.put_nowait(worker)
+            body.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown(wait=False)
+        self.workers = []
+        self.idle = None
+
+    async def _lease(self):
+        """A single-thread executor for one request, started on demand up to `threads` of them."""
+        if self.idle is None:
+            self.idle = asyncio.LifoQueue()
+        if self.idle.empty() and len(self.workers) < self.threads:
+            worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asgi-{}".format(len(self.workers)))
+            self.workers.append(worker)
+            return worker
+        return await self.idle.get()
+
+    async def _read_body(self, scope, receive):
+        """The request body in a spooled file, None if the client left, False if it is over max_body."""
+        loop = asyncio.get_event_loop()
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if self.max_body is not None and size > self.max_body:
+                body.close()
+                return False
+            if chunk:
+                if size > self.spool_bytes:
+                    # on disk by now
+                    await loop.run_in_executor(None, body.write, chunk)
+                else:
+                    body.write(chunk)
+            if not message.get("more_body"):
+                break
+        body.seek(0)
+        return body
+
+    def _environ(self, scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(body.seek(0, 2)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+        body.seek(0)
+        for name, value in scope.get("headers", ()):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_LENGTH":
+                continue
+            key = name if name == "CONTENT_TYPE" else "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+    def _start(self, environ):
+        """Run the app until its body is a file, done, or over buffer_bytes, on the request thread."""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                  for name, value in headers]
+            return buffered.append
+
+        buffered = []
+        iterable = self.app(environ, start_response)
+        file_body = _file_body(iterable)
+        if file_body is not None:
+            return started, buffered, None, file_body
+
+        iterator = iter(iterable)
+        size = 0
+        for chunk in iterator:
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= self.buffer_bytes:
+                return started, buffered, (iterable, iterator), None
+        _close(iterable)
+        return started, buffered, None, None
+
+    async def _send_body(self, worker, send, buffered, stream):
+        """Send the chunks _start buffered, then pull the rest of a streamed body on its thread, worker."""
+        loop = asyncio.get_event_loop()
+        try:
+            for chunk in buffered:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if stream is not None:
+                iterable, iterator = stream
+                while True:
+                    chunk = await loop.run_in_executor(worker, next, iterator, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if stream is not None:
+                await loop.run_in_executor(worker, _close, stream[0])
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_file(self, send, wrapper, start, end):
+        loop = asyncio.get_event_loop()
+        try:
+            if start:
+                await loop.run_in_executor(None, wrapper.seek, start)
+            remaining = None if end is None else end - (start or 0)
+            while remaining is None or remaining > 0:
+                size = wrapper.buffer_size if remaining is None else min(wrapper.buffer_size, remaining)
+                chunk = await loop.run_in_executor(None, wrapper.file.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await loop.run_in_executor(None, wrapper.close)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_simple(self, send, status, body):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode("ascii"))]})
+        await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+def _close(iterable):
+    if hasattr(iterable, "close"):
+        iterable.close()
@@ -0,0 +1,344 @@
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+from flask import current_app
+
+
+class StorageError(IOError):
+    pass
+
+
+class StorageBackend(object):
+    """Where picture bytes live, addressed by keys such as "ab/cd/<digest>.jpg".
+
+    Keys use "/" whatever the platform. Backends that keep objects as local
+    files return their path from local_path(), which lets the web server send
+    them with sendfile and Pillow open them in place; others return None and
+    are read through open().
+    """
+
+    def put(self, key, stream, chunk_size=64 * 1024):
+        """Store the bytes read from stream under key, replacing any previous object."""
+        upload = self.begin_upload(key)
+        try:
+            for chunk in iter(lambda: stream.read(chunk_size), b""):
+                upload.write(chunk)
+        except Exception:
+            upload.abort()
+            raise
+        upload.complete()
+
+    def put_file(self, key, path, move=False):
+        """Store a local file under key. With move=True the file is consumed."""
+        with open(path, "rb") as f:
+            self.put(key, f)
+        if move:
+            os.remove(path)
+
+    def begin_upload(self, key):
+        """Start a chunked write, see MultipartUpload."""
+        raise NotImplementedError
+
+    def open(self, key):
+        """A seekable binary file object with the bytes of key."""
+        raise NotImplementedError
+
+    def iter_range(self, key, start=0, stop=None, chunk_size=64 * 1024):
+        """Yield the bytes [start, stop) of key."""
+        with self.open(key) as f:
+            f.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def stat(self, key):
+        """(size, mtime) of key, raises FileNotFoundError when it is missing."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        try:
+            self.stat(key)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete(self, key):
+        """Remove key, returns False if it was not there."""
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        """Remove several keys, returns how many were there."""
+        return sum(1 for key in keys if self.delete(key))
+
+    def local_path(self, key):
+        return None
+
+    def iter_keys(self, pool=None):
+        """Every stored key, in sorted order. Backends may list ahead on the threads of pool."""
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def local_copy(self, key, folder=None):
+        """A local file with the bytes of key for the time of the with block."""
+        path = self.local_path(key)
+        if path is not None:
+            yield path
+            return
+        fd, path = tempfile.mkstemp(dir=folder, prefix=".fetch-", suffix=os.path.splitext(key)[1])
+        try:
+            with os.fdopen(fd, "wb") as out, self.open(key) as f:
+                shutil.copyfileobj(f, out)
+            yield path
+        finally:
+            os.remove(path)
+
+
+class MultipartUpload(object):
+    """A write to a backend made of parts, invisible to readers until complete()."""
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def complete(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+
+class _LocalUpload(MultipartUpload):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".part-")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def complete(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class LocalBackend(StorageBackend):
+    """Objects are files under root, at the path spelled by their key."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        if os.path.isabs(key):
+            # rows stored before keys existed, until `flask migrate-storage` converts them
+            return key
+        path = os.path.normpath(os.path.join(self.root, *key.split("/")))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError("Invalid storage key {!r}".format(key))
+        return path
+
+    def begin_upload(self, key):
+        return _LocalUpload(self.path(key))
+
+    def put_file(self, key, path, move=False):
+        if not move:
+            return super(LocalBackend, self).put_file(key, path)
+        dest = self.path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            # uploads are written next to the store, so this is a rename
+            os.replace(path, dest)
+        except OSError:
+            super(LocalBackend, self).put_file(key, path, move=True)
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def stat(self, key):
+        stat = os.stat(self.path(key))
+        return stat.st_size, stat.st_mtime
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def local_path(self, key):
+        return self.path(key)
+
+    def _listing(self, prefix):
+        """Sorted (sort key, key, is folder) of the entries of the folder of prefix, "." names left out."""
+        entries = []
+        with os.scandir(os.path.join(self.root, *prefix.split("/"))) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    # uploads in progress
+                    continue
+                key = prefix + entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                # a folder sorts as its keys do, with the "/" that follows its name
+                entries.append((key + "/" if is_dir else key, key, is_dir))
+        entries.sort()
+        return entries
+
+    def iter_keys(self, pool=None):
+        """Keys depth first, in sorted order. Folders are listed ahead on the threads of pool.
+
+        Only the folders along the current path have their listings held, so
+        memory follows the fan-out of the tree, not its size.
+        """
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                yield from self.iter_keys(pool)
+            return
+        pending = collections.deque([pool.submit(self._listing, "")])
+        while pending:
+            item = pending.popleft()
+            if isinstance(item, str):
+                yield item
+                continue
+            try:
+                entries = item.result()
+            except FileNotFoundError:
+                # removed since its parent was listed, or no store yet
+                continue
+            pending.extendleft(reversed([pool.submit(self._listing, key + "/") if is_dir else key
+                                         for _, key, is_dir in entries]))
+
+
+class _ObjectUpload(MultipartUpload):
+    def __init__(self, store, key, part_size):
+        self.store = store
+        self.key = key
+        self.part_size = part_size
+        self.folder = os.path.join(store.root, ".uploads", uuid.uuid4().hex)
+        os.makedirs(self.folder)
+        self.parts = []
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _upload_part(self, data):
+        number = len(self.parts) + 1
+        with open(os.path.join(self.folder, str(number)), "wb") as f:
+            f.write(data)
+        self.parts.append(hashlib.md5(data).digest())
+
+    def complete(self):
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        # parts are put together server side, like S3's CompleteMultipartUpload
+        data_path = self.store.data_path(self.key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".complete-")
+        size = 0
+        with os.fdopen(fd, "wb") as out:
+            for number in range(1, len(self.parts) + 1):
+                with open(os.path.join(self.folder, str(number)), "rb") as part:
+                    shutil.copyfileobj(part, out)
+                    size += part.tell()
+            out.flush()
+            os.fsync(out.fileno())
+        etag = "{}-{}".format(hashlib.md5(b"".join(self.parts)).hexdigest(), len(self.parts))
+        os.replace(tmp_path, data_path)
+        with open(data_path + ".meta", "w") as meta:
+            json.dump({"key": self.key, "size": size, "etag": etag}, meta)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def abort(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class ObjectStoreBackend(StorageBackend):
+    """A local stand-in for an S3-like object store.
+
+    Objects live flat in one bucket folder, named by their escaped key, and
+    only ever written whole: writes go through multipart uploads of
+    part_size parts that are assembled on completion. Nothing is exposed as a
+    local path, so the app reads them the way it would read a remote store,
+    which keeps that code path exercised without a network service.
+    """
+
+    def __init__(self, root, part_size=8 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.part_size = part_size
+        os.makedirs(self.root, exist_ok=True)
+
+    def data_path(self, key):
+        if os.path.isabs(key) or not key or ".." in key.split("/"):
+            raise StorageError("Invalid storage key {!r}".format(key))
+        return os.path.join(self.root, quote(key, safe=""))
+
+    def begin_upload(self, key):
+        self.data_path(key)
+        return _ObjectUpload(self, key, self.part_size)
+
+    def open(self, key):
+        return open(self.data_path(key), "rb")
+
+    def stat(self, key):
+        stat = os.stat(self.data_path(key))
+        return stat.st_size, stat.st_mtime
+
+    def delete(self, key):
+        path = self.data_path(key)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(path + ".meta")
+        except FileNotFoundError:
+            pass
+        return True
+
+    def iter_keys(self, pool=None):
+        # a real store lists keys in order, the stand-in sorts its bucket folder in memory
+        with os.scandir(self.root) as it:
+            keys = sorted(unquote(entry.name) for entry in it
+                          if not entry.name.startswith(".") and not entry.name.endswith(".meta"))
+        return iter(keys)
+
+
+def create_backend(config):
+    kind = config.get("STORAGE_BACKEND", "local")
+    root = config.get("STORAGE_ROOT") or config["PICTURE_FOLDER"]
+    if kind == "local":
+        return LocalBackend(root)
+    if kind == "objectstore":
+        return ObjectStoreBackend(root, config.get("STORAGE_PART_SIZE", 8 * 1024 * 1024))
+    raise ValueError("Unknown STORAGE_BACKEND {!r}".format(kind))
+
+
+def get_backend():
+    """The storage backend of the current app, created on first use."""
+    config = current_app.config
+    spec = (config.get("STORAGE_BACKEND", "local"), config.get("STORAGE_ROOT") or config["PICTURE_FOLDER"])
+    cached = current_app.extensions.get("storage")
+    if cached is None or cached[0] != spec:
+        cached = (spec, create_backend(config))
+        current_app.extensions["storage"] = cached
+    return cached[1]
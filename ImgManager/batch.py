@@ -0,0 +1,150 @@
+import logging
+import os
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from ImgManager import db
+from ImgManager.database import is_locked
+from ImgManager.models import Picture, PictureMetadata
+from ImgManager.jobs import enqueue_many
+from ImgManager.metadata import read_metadata
+from ImgManager.archives import ArchiveError
+from ImgManager.storage import BlobTooLarge, write_pending
+from ImgManager.uploads import HEADER_SIZE, sniff_image
+
+# request content types read as an archive instead of multipart parts
+ZIP_TYPES = {"application/zip", "application/x-zip-compressed"}
+TAR_TYPES = {"application/x-tar", "application/x-gtar", "application/gzip", "application/x-gzip",
+             "application/x-bzip2", "application/x-xz"}
+
+logger = logging.getLogger(__name__)
+
+
+def entry_name(filename):
+    """Picture name for an uploaded file: its base name without extension."""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+class BatchIngest(object):
+    """Turns uploaded files into Picture rows of one album.
+
+    Files are streamed to the store as they come, and their rows inserted with
+    one executemany per BATCH_INSERT_CHUNK files, each chunk in its own
+    transaction. results holds one dict per file, in the order they came.
+    A chunk failing on a conflict or a locked database only fails its own
+    files, the chunks committed before it are kept.
+    """
+
+    def __init__(self, album_id):
+        self.album_id = album_id
+        self.chunk_size = current_app.config.get("BATCH_INSERT_CHUNK", 200)
+        self.max_size = current_app.config.get("MAX_PICTURE_SIZE")
+        self.results = []
+        self.pending = []
+        self.seen = set()
+
+    def _result(self, index, name, code, msg, picture_id=None):
+        result = {"name": name, "code": code, "msg": msg}
+        if picture_id is not None:
+            result["id"] = str(picture_id)
+        self.results[index] = result
+
+    def add_stream(self, filename, stream):
+        """Store a file read from an archive entry."""
+        name = entry_name(filename)
+        index = len(self.results)
+        self.results.append(None)
+
+        try:
+            head = stream.read(HEADER_SIZE)
+            ext = sniff_image(head)
+            if not ext:
+                return self._result(index, name, 403, "Unsupported image format")
+            blob = write_pending(stream, ext, head=head, max_size=self.max_size)
+        except BlobTooLarge as e:
+            return self._result(index, name, 413, str(e))
+        except ArchiveError as e:
+            # the entry broken halfway is reported too, the caller stops reading
+            self._result(index, name, 400, str(e))
+            raise
+        self._add(index, name, blob)
+
+    def add_upload(self, upload):
+        """Store a multipart file, already streamed to disk by the request parser."""
+        name = entry_name(upload.filename)
+        index = len(self.results)
+        self.results.append(None)
+
+        if upload.stream.too_large:
+            return self._result(index, name, 413, upload.stream.too_large)
+        ext = sniff_image(upload.stream.header)
+        if not ext:
+            return self._result(index, name, 403, "Unsupported image format")
+        self._add(index, name, upload.stream.pending(ext))
+
+    def _add(self, index, name, blob):
+        if not name or name in self.seen:
+            blob.discard()
+            return self._result(index, name, 403, "Missing or duplicate name in this batch")
+        self.seen.add(name)
+        self.pending.append((index, name, blob))
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        names = [name for _, name, _ in pending]
+        taken = {row.name for row in db.session.query(Picture.name).filter(Picture.name.in_(names))}
+        accepted = []
+        for index, name, blob in pending:
+            if name in taken:
+                blob.discard()
+                self._result(index, name, 403, "Name is already taken")
+            else:
+                accepted.append((index, name, blob))
+        if not accepted:
+            return
+
+        # the headers are read before the transaction, which holds the write lock
+        headers = [read_metadata(blob.tmp_path) for _, _, blob in accepted]
+        rows = [{"name": name, "album_id": self.album_id, "path": blob.key, "digest": blob.digest,
+                 "crc32": blob.crc32, "status": 'pending'} for _, name, blob in accepted]
+        try:
+            db.session.execute(Picture.__table__.insert(), rows)
+            ids = dict(db.session.query(Picture.name, Picture.id).filter(Picture.name.in_([row["name"] for row in rows])))
+            db.session.execute(PictureMetadata.__table__.insert(),
+                               [dict(header, picture_id=ids[name], size=blob.size)
+                                for header, (_, name, blob) in zip(headers, accepted)])
+            enqueue_many('picture.process', [{"picture_id": ids[row["name"]]} for row in rows])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for _, _, blob in accepted:
+                blob.discard()
+            if isinstance(e, IntegrityError):
+                # a picture of the same name committed since the names were checked
+                code, msg = 409, "Conflicts with a picture stored meanwhile, please retry."
+            elif is_locked(e):
+                code, msg = 503, "Server busy, please retry."
+            else:
+                raise
+            logger.warning("Batch chunk of %s pictures not stored: %s", len(accepted), e)
+            for index, name, _ in accepted:
+                self._result(index, name, code, msg)
+            return
+
+        for index, name, blob in accepted:
+            blob.commit()
+            self._result(index, name, 200, "success", ids[name])
+
+    def finish(self):
+        self.flush()
+        return self.results
+
+    def abort(self):
+        """Drop the files not stored yet, when the request fails before finish()."""
+        pending, self.pending = self.pending, []
+        for _, _, blob in pending:
+            blob.discard()
@@ -1,9 +1,128 @@
+import os
+
+
 class Config(object):
-    SQLALCHEMY_DATABASE_URI = "sqlite:///SOEN487_A1.sqlite"
+    # IMGMANAGER_DATABASE_URI points the dev and prod configs at another database
+    SQLALCHEMY_DATABASE_URI = os.environ.get("IMGMANAGER_DATABASE_URI", "sqlite:///SOEN487_A1.sqlite")
+    # applied to every new SQLite connection, see https://sqlite.org/pragma.html
+    # (negative cache_size is in KiB)
+    SQLITE_PRAGMAS = {
+        "busy_timeout": 5000,
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "memory",
+    }
+    # connections kept open per process, and how many more may be opened under load
+    SQLITE_POOL_SIZE = 5
+    SQLITE_POOL_OVERFLOW = 10
+    SQLITE_POOL_TIMEOUT = 30
+    # writes of a process are serialized, a transaction waits this many seconds
+    # for its turn, and is run again up to SQLITE_WRITE_RETRIES times when
+    # SQLite still reports the database as locked
+    SQLITE_WRITE_LOCK_TIMEOUT = 30
+    SQLITE_WRITE_RETRIES = 5
+    SQLITE_RETRY_DELAY = 0.05
+    # upper bound for the ?limit= parameter of the listing endpoints
+    MAX_PAGE_SIZE = 1000
+    # rows fetched per round trip and characters per chunk when streaming listings
+    STREAM_BATCH_SIZE = 1000
+    STREAM_CHUNK_SIZE = 64 * 1024
+    # serialized responses of the read endpoints, kept in memory up to
+    # RESPONSE_CACHE_BYTES, bodies over RESPONSE_CACHE_MAX_BODY are not kept.
+    # RESPONSE_CACHE_FOLDER adds a disk tier shared by the processes of a host.
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+    RESPONSE_CACHE_MAX_BODY = 1024 * 1024
+    RESPONSE_CACHE_FOLDER = None
+    RESPONSE_CACHE_DISK_BYTES = 256 * 1024 * 1024
+    # requests slower than this are logged with (up to) their first queries
+    SLOW_REQUEST_SECONDS = 1.0
+    SLOW_REQUEST_MAX_QUERIES = 50
+    # largest ?maxdist= of /picture/<id>/similar, in bits out of 64. Searches
+    # look at more candidates every 4 bits: past 10 they take milliseconds
+    # with a million pictures.
+    SIMILAR_MAX_DISTANCE = 10
+    # processes reading files for `flask backfill-metadata`, None for one per CPU
+    METADATA_WORKERS = None
+    # log EXPLAIN QUERY PLAN for every query and warn about full table scans
+    EXPLAIN_QUERIES = False
+    # bcrypt cost, hashes stored with another cost are rehashed on login
+    BCRYPT_LOG_ROUNDS = 12
+    # bcrypt version of new hashes, "2a" for readers of older bcrypt libraries
+    BCRYPT_HASH_PREFIX = "2b"
+    # password hashing runs on a bounded "thread" or "process" pool, requests
+    # beyond HASHING_WORKERS + HASHING_MAX_PENDING get a 503
+    HASHING_EXECUTOR = "thread"
+    HASHING_WORKERS = 4
+    HASHING_MAX_PENDING = 16
+    # logged in users kept in memory by the Flask-Login user loader
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 300
+    # local folder uploads are written to while they come in, and the store
+    # itself with the "local" backend
+    PICTURE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pictures')
+    # where pictures are stored: "local" files under STORAGE_ROOT, or
+    # "objectstore", an S3-like bucket emulated under STORAGE_ROOT and written
+    # in STORAGE_PART_SIZE parts. STORAGE_ROOT defaults to PICTURE_FOLDER.
+    # Run `flask migrate-storage` before leaving "local" with older rows.
+    STORAGE_BACKEND = "local"
+    STORAGE_ROOT = None
+    STORAGE_PART_SIZE = 8 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    # uploads are rejected with a 413 as soon as they go over this many bytes
+    MAX_PICTURE_SIZE = 20 * 1024 * 1024
+    # /picture/<id>/raw: Cache-Control max-age of content-addressed files, and
+    # offloading the body to the front proxy with X-Sendfile or X-Accel-Redirect
+    PICTURE_CACHE_MAX_AGE = 365 * 24 * 3600
+    USE_X_SENDFILE = False
+    X_ACCEL_REDIRECT_PREFIX = None
+    # resized variants served by /picture/<id>?w=&fmt=, evicted least recently
+    # used first once they take more than DERIVATIVE_CACHE_BYTES
+    DERIVATIVE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'derivatives')
+    DERIVATIVE_CACHE_BYTES = 512 * 1024 * 1024
+    DERIVATIVE_MAX_WIDTH = 2048
+    DERIVATIVE_QUALITY = 85
+    # (width, fmt) variants rendered in the background right after an upload
+    DERIVATIVE_PREWARM = [(256, "jpeg")]
+    # background jobs, run by worker.py
+    JOB_WORKER_THREADS = 2
+    JOB_POLL_INTERVAL = 1.0
+    JOB_MAX_ATTEMPTS = 5
+    # seconds before the first retry, doubled after each failed attempt
+    JOB_RETRY_DELAY = 10
+    # running jobs older than this are requeued when a worker starts
+    JOB_TIMEOUT = 600
+    # files of deleted pictures unlinked per reaper transaction
+    REAPER_BATCH_SIZE = 500
+    # pictures inserted per transaction by /Album/<id>/addPictures
+    BATCH_INSERT_CHUNK = 200
+    # `flask scan-storage`: threads listing folders and hashing files, and the
+    # age in seconds before an unreferenced file counts as orphaned, younger
+    # ones may belong to uploads in progress
+    SCAN_WORKERS = 8
+    SCAN_MIN_AGE = 3600
+    # asgi.py: threads running routes, at most this many requests at once;
+    # request bodies kept in memory up to ASGI_SPOOL_BYTES, then on disk;
+    # responses buffered up to ASGI_BUFFER_BYTES before holding their thread
+    ASGI_THREADS = 32
+    ASGI_SPOOL_BYTES = 64 * 1024
+    ASGI_BUFFER_BYTES = 256 * 1024
+    # serve.py: worker processes (None for one per CPU) and request threads
+    # of each. Workers are replaced after SERVER_MAX_REQUESTS requests, plus
+    # up to SERVER_MAX_REQUESTS_JITTER so they are not all replaced at once,
+    # and get SERVER_GRACEFUL_TIMEOUT seconds to finish their requests.
+    SERVER_WORKERS = None
+    SERVER_THREADS = 16
+    SERVER_MAX_REQUESTS = 10000
+    SERVER_MAX_REQUESTS_JITTER = 1000
+    SERVER_GRACEFUL_TIMEOUT = 30
 
 
 class ProdConfig(Config):
-    pass
+    SQLITE_PRAGMAS = dict(Config.SQLITE_PRAGMAS, cache_size=-256 * 1024, mmap_size=1024 * 1024 * 1024)
+    SQLITE_POOL_SIZE = 10
 
 
 class DevConfig(Config):
@@ -12,4 +131,19 @@ class DevConfig(Config):
 
 class TestConfig(Config):
     TESTING = True
+    BCRYPT_LOG_ROUNDS = 4
+    # test databases are thrown away, no need to wait for the disk
+    SQLITE_PRAGMAS = dict(Config.SQLITE_PRAGMAS, synchronous="off", mmap_size=0)
     SQLALCHEMY_DATABASE_URI = "sqlite:///tests/test_SOEN487_A1.sqlite"
+
+
+# selected by the IMGMANAGER_CONFIG environment variable
+CONFIGS = {"dev": DevConfig, "prod": ProdConfig, "test": TestConfig}
+
+
+def from_environment(default="dev"):
+    """The config class named by IMGMANAGER_CONFIG, default when it is not set."""
+    name = os.environ.get("IMGMANAGER_CONFIG", default).lower()
+    if name not in CONFIGS:
+        raise ValueError("IMGMANAGER_CONFIG must be one of {}".format(", ".join(sorted(CONFIGS))))
+    return CONFIGS[name]
@@ -0,0 +1,179 @@
+import functools
+import logging
+import sqlite3
+import threading
+import time
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import Pool, QueuePool
+from ImgManager.config import Config
+from ImgManager.metrics import Sampled, registry
+
+logger = logging.getLogger(__name__)
+
+# statements that take SQLite's write lock
+_WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER", "BEGIN IMMEDIATE")
+
+
+def _config():
+    return current_app.config if has_app_context() else Config.__dict__
+
+
+def pool_options(config):
+    """create_engine options for a file SQLite database."""
+    busy_timeout = config.get("SQLITE_PRAGMAS", {}).get("busy_timeout", 5000)
+    return {
+        # pysqlite defaults to a new connection per checkout, which loses the
+        # page cache and mmap between requests
+        "poolclass": QueuePool,
+        "pool_size": config.get("SQLITE_POOL_SIZE", 5),
+        "max_overflow": config.get("SQLITE_POOL_OVERFLOW", 10),
+        "pool_timeout": config.get("SQLITE_POOL_TIMEOUT", 30),
+        "connect_args": {"check_same_thread": False, "timeout": busy_timeout / 1000.0},
+    }
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with a real connection pool for file SQLite databases.
+
+    Options given in SQLALCHEMY_ENGINE_OPTIONS still take precedence.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        rv = super(TunedSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername == "sqlite" and sa_url.database not in (None, "", ":memory:"):
+            options.update(pool_options(app.config))
+        return rv
+
+
+@event.listens_for(Engine, "connect")
+def _apply_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    pragmas = _config().get("SQLITE_PRAGMAS") or {}
+    cursor = dbapi_connection.cursor()
+    try:
+        # busy_timeout first, so that switching the journal mode waits for other writers
+        for name in sorted(pragmas, key=lambda name: name != "busy_timeout"):
+            cursor.execute("PRAGMA {} = {}".format(name, pragmas[name]))
+            cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+class SerializedWriter(object):
+    """Lets one transaction of the process write at a time.
+
+    SQLite only has one writer anyway. Queuing writers here, instead of in
+    SQLite's busy handler, keeps them in order and out of "database is
+    locked" errors. The lock is taken by the first write statement of a
+    transaction and released when its connection goes back to the pool. It
+    is reentrant per thread, and a writer that waited more than
+    SQLITE_WRITE_LOCK_TIMEOUT goes on without it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.owner = None
+        self.depth = 0
+        self.writes = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def acquire(self, timeout):
+        me = threading.get_ident()
+        with self.condition:
+            self.writes += 1
+            if self.owner not in (None, me):
+                self.waits += 1
+                start = time.monotonic()
+                free = self.condition.wait_for(lambda: self.owner is None, timeout)
+                self.wait_time += time.monotonic() - start
+                if not free:
+                    self.timeouts += 1
+                    return False
+            self.owner = me
+            self.depth += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.depth -= 1
+            if not self.depth:
+                self.owner = None
+                self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {"writes": self.writes, "waits": self.waits, "wait_time": self.wait_time,
+                    "timeouts": self.timeouts}
+
+
+writer = SerializedWriter()
+registry.add(Sampled("imgmanager_sqlite_write_waits_total", "Transactions that waited for the write lock.",
+                     lambda: writer.stats()["waits"], "counter"))
+registry.add(Sampled("imgmanager_sqlite_write_wait_seconds_total", "Time spent waiting for the write lock.",
+                     lambda: writer.stats()["wait_time"], "counter"))
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _serialize_writes(conn, cursor, statement, parameters, context, executemany):
+    if conn.dialect.name != "sqlite" or conn.info.get("writer_held"):
+        return
+    if not statement.lstrip().upper().startswith(_WRITE_STATEMENTS):
+        return
+    if writer.acquire(_config().get("SQLITE_WRITE_LOCK_TIMEOUT", 30)):
+        conn.info["writer_held"] = True
+    else:
+        logger.warning("Waited too long for the write lock, writing without it: %s", statement)
+
+
+@event.listens_for(Pool, "checkin")
+def _release_writer(dbapi_connection, connection_record):
+    # the transaction was committed or rolled back before the connection came back
+    if connection_record is not None and connection_record.info.pop("writer_held", False):
+        writer.release()
+
+
+def begin_write(session):
+    """Start the session's transaction with the write lock taken, until it commits or rolls back.
+
+    For checks that must still hold when the transaction ends, like "no
+    row references this file" before deleting the file: no other writer
+    can commit in between. The session must not have written anything yet.
+    """
+    session.execute("BEGIN IMMEDIATE")
+
+
+def is_locked(error):
+    """Whether an exception is SQLite giving up on getting its lock."""
+    return isinstance(error, OperationalError) and "database is locked" in str(error.orig)
+
+
+def retry_locked(fn):
+    """Run a whole unit of work again when it fails with "database is locked".
+
+    The session is rolled back between attempts, with an exponential
+    backoff. fn must not have side effects outside the database that a
+    second run would repeat.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        from ImgManager import db
+        config = _config()
+        retries = config.get("SQLITE_WRITE_RETRIES", 5)
+        delay = config.get("SQLITE_RETRY_DELAY", 0.05)
+        for attempt in range(retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except OperationalError as e:
+                if not is_locked(e) or attempt == retries:
+                    raise
+                db.session.rollback()
+                logger.info("Database is locked, retrying %s (%s/%s)", fn.__name__, attempt + 1, retries)
+                time.sleep(delay * 2 ** attempt)
+    return wrapper
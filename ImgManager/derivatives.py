@@ -0,0 +1,142 @@
+import hashlib
+import os
+import tempfile
+import threading
+from flask import current_app
+from ImgManager.backends import get_backend
+from ImgManager.metrics import timed
+
+# ?fmt= values and the Pillow format and extension they are rendered with
+FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "png": ("PNG", ".png"),
+}
+
+
+def render(source_path, dest, width, fmt):
+    """Write a copy of source_path resized to width pixels (never upscaled)."""
+    # Pillow takes a while to import, processes that never resize do not pay for it
+    from PIL import Image
+    pil_format, _ = FORMATS[fmt]
+    with timed("pillow"), Image.open(source_path) as img:
+        width = min(width, img.width)
+        height = max(1, round(img.height * width / img.width))
+
+        # JPEG sources are decoded straight at 1/2, 1/4 or 1/8 scale
+        img.draft("RGB", (width, height))
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.LANCZOS)
+
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(dest, pil_format, quality=current_app.config.get("DERIVATIVE_QUALITY", 85))
+
+
+def source_key(picture):
+    """What identifies the content of a picture's file for the cache keys."""
+    if picture.digest:
+        return picture.digest
+    size, mtime = get_backend().stat(picture.path)
+    return "{}:{}:{}".format(picture.path, mtime, size)
+
+
+class DerivativeCache(object):
+    """Resized variants of stored pictures, cached on disk under a byte budget.
+
+    Files are keyed by (source, width, format). Hits refresh the file mtime,
+    which the eviction uses as its LRU order. Concurrent requests for the same
+    missing variant wait on one lock, so it is only rendered once per process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.total = None
+
+    def folder(self):
+        return current_app.config["DERIVATIVE_FOLDER"]
+
+    def path_for(self, source_key, width, fmt):
+        key = hashlib.sha1("{}:{}:{}".format(source_key, width, fmt).encode("utf-8")).hexdigest()
+        return os.path.join(self.folder(), key[:2], key + FORMATS[fmt][1])
+
+    def get(self, source, source_key, width, fmt):
+        """Path of the variant of the stored picture source, rendering it if needed."""
+        path = self.path_for(source_key, width, fmt)
+        if self._touch(path):
+            return path
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(path, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                # someone may have rendered it while we waited
+                if self._touch(path):
+                    return path
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".render-")
+                os.close(fd)
+                try:
+                    # remote backends only download the source when a variant is missing
+                    with get_backend().local_copy(source, os.path.dirname(path)) as source_path:
+                        render(source_path, tmp_path, width, fmt)
+                    os.replace(tmp_path, path)
+                except Exception:
+                    os.remove(tmp_path)
+                    raise
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self.key_locks[path]
+
+        self._account(os.path.getsize(path))
+        return path
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def _scan(self):
+        entries = []
+        for sub in os.scandir(self.folder()):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _account(self, size):
+        budget = current_app.config.get("DERIVATIVE_CACHE_BYTES", 512 * 1024 * 1024)
+        with self.lock:
+            if self.total is None:
+                self.total = sum(entry[1] for entry in self._scan())
+            else:
+                self.total += size
+            if self.total <= budget:
+                return
+            self.evict(budget * 9 // 10)
+
+    def evict(self, target):
+        """Remove least recently used variants until at most target bytes remain."""
+        entries = sorted(self._scan())
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.total = total
+
+
+derivative_cache = DerivativeCache()
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import struct
+import tarfile
+import time
+import zlib
+from flask import current_app, request
+from ImgManager.models import row2dict, Picture
+from ImgManager.backends import get_backend
+
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+class ArchiveLayout(object):
+    """A byte-exact plan of an archive, made of literal, file and lazy segments.
+
+    The total size is known before anything is read, and any byte range can
+    be produced on its own, which is what makes interrupted downloads
+    resumable. Lazy segments are the parts of a zip that need file CRCs:
+    the ones stored at upload are given in crcs, the others are computed
+    while a file is streamed whole, or by reading it when a resumed
+    download skipped it. File segments are read through opener, which
+    returns a binary file object for a source.
+    """
+
+    def __init__(self, opener=None, crcs=None):
+        self.opener = opener or (lambda path: open(path, "rb"))
+        self.segments = []
+        self.size = 0
+        self.crcs = dict(crcs or ())
+        self.sizes = {}
+
+    def add_bytes(self, data):
+        self.segments.append((len(data), "bytes", data))
+        self.size += len(data)
+
+    def add_file(self, path, size):
+        self.segments.append((size, "file", path))
+        self.sizes[path] = size
+        self.size += size
+
+    def add_lazy(self, length, produce):
+        self.segments.append((length, "lazy", produce))
+        self.size += length
+
+    def crc(self, path):
+        if path not in self.crcs:
+            crc = size = 0
+            with self.opener(path) as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+            if size != self.sizes.get(path, size):
+                raise IOError("{} changed while being exported".format(path))
+            self.crcs[path] = crc
+        return self.crcs[path]
+
+    def iter_range(self, start, stop, chunk_size=64 * 1024):
+        """Yield the bytes of [start, stop) of the archive."""
+        offset = 0
+        for length, kind, value in self.segments:
+            seg_start, offset = offset, offset + length
+            if offset <= start:
+                continue
+            if seg_start >= stop:
+                break
+            lo = max(start, seg_start) - seg_start
+            hi = min(stop, offset) - seg_start
+            if kind == "bytes":
+                yield value[lo:hi]
+            elif kind == "lazy":
+                data = value()
+                if len(data) != length:
+                    raise IOError("archive segment of {} bytes came out as {}".format(length, len(data)))
+                yield data[lo:hi]
+            else:
+                for chunk in self._read_file(value, lo, hi, length, chunk_size):
+                    yield chunk
+
+    def _read_file(self, path, lo, hi, size, chunk_size):
+        whole = lo == 0 and hi == size and path not in self.crcs
+        crc = 0
+        with self.opener(path) as f:
+            f.seek(lo)
+            remaining = hi - lo
+            while remaining:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise IOError("{} changed while being exported".format(path))
+                if whole:
+                    crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        if whole:
+            self.crcs[path] = crc
+
+
+def _dos_datetime(mtime):
+    t = time.gmtime(max(mtime, 315532800))
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+
+def zip_layout(entries, opener=None, crcs=None):
+    """Plan a stored (uncompressed) zip of entries.
+
+    entries are (arcname, source, size, mtime) where source is a file path or
+    the bytes of the entry, crcs the known CRC-32 of sources. Sizes go in the
+    central directory and CRCs in data descriptors, so nothing needs to be
+    read before streaming starts. Zip64 records are used only where sizes or
+    offsets need them.
+    """
+    layout = ArchiveLayout(opener, crcs)
+    central = []
+    for arcname, source, size, mtime in entries:
+        name = arcname.encode("utf-8")
+        offset = layout.size
+        zip64 = size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT
+        dostime, dosdate = _dos_datetime(mtime)
+        version = 45 if zip64 else 20
+        # bit 3: crc and sizes follow the data, bit 11: utf-8 names
+        flags = 0x08 | 0x800
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if zip64 else b""
+        layout.add_bytes(struct.pack("<4sHHHHHIIIHH", b"PK\x03\x04", version, flags, 0, dostime, dosdate,
+                                     0, 0, 0, len(name), len(extra)) + name + extra)
+
+        if isinstance(source, bytes):
+            # in-memory entries are keyed by name in the crc cache
+            layout.crcs[arcname] = zlib.crc32(source)
+            layout.add_bytes(source)
+            crc_key = arcname
+        else:
+            layout.add_file(source, size)
+            crc_key = source
+
+        def descriptor(crc_key=crc_key, size=size, zip64=zip64):
+            crc = layout.crc(crc_key)
+            if zip64:
+                return struct.pack("<4sIQQ", b"PK\x07\x08", crc, size, size)
+            return struct.pack("<4sIII", b"PK\x07\x08", crc, size, size)
+        layout.add_lazy(24 if zip64 else 16, descriptor)
+        central.append((name, crc_key, size, offset, version, flags, dostime, dosdate))
+
+    cd_offset = layout.size
+    cd_entries = []
+    cd_size = 0
+    for name, crc_key, size, offset, version, flags, dostime, dosdate in central:
+        fields = []
+        if size >= ZIP64_LIMIT:
+            fields += [size, size]
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+        extra = struct.pack("<HH", 1, 8 * len(fields)) + struct.pack("<" + "Q" * len(fields), *fields) if fields else b""
+        cd_entries.append((name, crc_key, size, offset, version, flags, dostime, dosdate, extra))
+        cd_size += 46 + len(name) + len(extra)
+
+    def central_directory():
+        records = []
+        for name, crc_key, size, offset, version, flags, dostime, dosdate, extra in cd_entries:
+            crc = layout.crc(crc_key)
+            stored_size = ZIP64_LIMIT if size >= ZIP64_LIMIT else size
+            records.append(struct.pack("<4sHHHHHHIIIHHHHHII", b"PK\x01\x02", 3 << 8 | version, version, flags, 0,
+                                       dostime, dosdate, crc, stored_size, stored_size, len(name), len(extra),
+                                       0, 0, 0, 0o100644 << 16, min(offset, ZIP64_LIMIT)) + name + extra)
+        return b"".join(records)
+    layout.add_lazy(cd_size, central_directory)
+
+    count = len(entries)
+    end = b""
+    if count > 0xFFFF or cd_size >= ZIP64_LIMIT or cd_offset >= ZIP64_LIMIT:
+        zip64_end_offset = layout.size
+        end += struct.pack("<4sQHHIIQQQQ", b"PK\x06\x06", 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        end += struct.pack("<4sIQI", b"PK\x06\x07", 0, zip64_end_offset, 1)
+    end += struct.pack("<4sHHHHIIH", b"PK\x05\x06", 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                       min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0)
+    layout.add_bytes(end)
+    return layout
+
+
+def tar_layout(entries, opener=None):
+    """Plan a plain tar of entries, see zip_layout for their format."""
+    layout = ArchiveLayout(opener)
+    for arcname, source, size, mtime in entries:
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        # pax headers are only added for long names or huge files
+        layout.add_bytes(info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8"))
+        if isinstance(source, bytes):
+            layout.add_bytes(source)
+        else:
+            layout.add_file(source, size)
+        padding = -size % tarfile.BLOCKSIZE
+        if padding:
+            layout.add_bytes(b"\0" * padding)
+    layout.add_bytes(b"\0" * tarfile.BLOCKSIZE * 2)
+    return layout
+
+
+def layout_etag(entries):
+    """A validator that changes whenever the archive bytes would."""
+    sha = hashlib.sha1()
+    for arcname, source, size, mtime in entries:
+        sha.update(arcname.encode("utf-8"))
+        sha.update(source if isinstance(source, bytes) else source.encode("utf-8"))
+        sha.update("{}:{}".format(size, int(mtime)).encode("ascii"))
+    return sha.hexdigest()
+
+
+def album_entries(album):
+    """(entries, crcs) of an album: a manifest.json, then its pictures by id, and their CRC-32 by key.
+
+    Picture sources are storage keys, to read with the backend's open().
+    Pictures stored before CRCs were recorded are left out of crcs.
+    """
+    backend = get_backend()
+    pictures = []
+    files = []
+    crcs = {}
+    query = Picture.query.filter_by(album_id=album.id).order_by(Picture.id)
+    for picture in query.yield_per(current_app.config.get("STREAM_BATCH_SIZE", 1000)):
+        try:
+            size, mtime = backend.stat(picture.path)
+        except OSError:
+            # listed in the manifest without a file
+            pictures.append(dict(row2dict(picture), file=None, size=None))
+            continue
+        _, ext = os.path.splitext(picture.path)
+        arcname = "{}-{}{}".format(picture.id, picture.name.replace("/", "_"), ext)
+        pictures.append(dict(row2dict(picture), file=arcname, size=size))
+        files.append((arcname, picture.path, size, mtime))
+        if picture.crc32 is not None:
+            crcs[picture.path] = picture.crc32
+
+    # the manifest only depends on the rows and files, so the layout is the same on every request
+    manifest = json.dumps({"album": row2dict(album), "pictures": pictures}, sort_keys=True, indent=2).encode("utf-8")
+    mtime = max([entry[3] for entry in files] or [0])
+    return [("manifest.json", manifest, len(manifest), mtime)] + files, crcs
+
+
+def archive_response(layout, etag, filename, mimetype):
+    """Stream a planned archive, honouring Range, If-Range and If-None-Match."""
+    headers = {"Content-Disposition": 'attachment; filename="{}"'.format(filename),
+               "Accept-Ranges": "bytes"}
+    if etag in request.if_none_match:
+        rv = current_app.response_class(status=304, headers=headers)
+        rv.set_etag(etag)
+        return rv
+
+    start, stop, status = 0, layout.size, 200
+    # a range is only honoured while the archive is still the one the client started
+    if_range = request.if_range
+    if request.range and (if_range.etag is None and if_range.date is None or if_range.etag == etag):
+        window = request.range.range_for_length(layout.size)
+        if window is None:
+            headers["Content-Range"] = "bytes */{}".format(layout.size)
+            return current_app.response_class(status=416, headers=headers)
+        start, stop = window
+        status = 206
+        headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, layout.size)
+
+    body = layout.iter_range(start, stop, current_app.config.get("STREAM_CHUNK_SIZE", 64 * 1024))
+    rv = current_app.response_class(body, status=status, headers=headers,
+                                    mimetype=mimetype, direct_passthrough=True)
+    rv.content_length = stop - start
+    rv.set_etag(etag)
+    return rv
@@ -0,0 +1,134 @@
+import base64
+import json
+import logging
+import re
+import sqlalchemy
+from flask import current_app
+from sqlalchemy import text
+from ImgManager import db
+from ImgManager.models import row2dict, Album, Picture
+from ImgManager.listing import ListingError
+
+logger = logging.getLogger(__name__)
+
+# one FTS5 index per searchable table, over its name column. They are
+# external content tables: the text stays in the table, the triggers keep
+# the index in step with it. prefix='2 3' adds prefix indexes for short
+# prefixes, longer ones are found in the main index.
+INDEXED = {"picture": "picture_fts", "album": "album_fts"}
+
+_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+    "name, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {fts} (rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {fts} ({fts}, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF id, name ON {table} BEGIN "
+    "INSERT INTO {fts} ({fts}, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO {fts} (rowid, name) VALUES (new.id, new.name); END",
+]
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def create_indexes(bind):
+    """Create the missing FTS tables and their triggers, filling new tables from existing rows."""
+    if bind.dialect.name != "sqlite":
+        return
+    inspector = sqlalchemy.inspect(bind)
+    existing = set(inspector.get_table_names())
+    for table, fts in INDEXED.items():
+        if table not in existing:
+            continue
+        try:
+            for statement in _DDL:
+                bind.execute(statement.format(table=table, fts=fts))
+        except sqlalchemy.exc.OperationalError as e:
+            if "no such module" not in str(e.orig):
+                raise
+            logger.warning("SQLite was built without FTS5, /search is not available")
+            return
+        if fts not in existing:
+            bind.execute("INSERT INTO {fts} ({fts}) VALUES ('rebuild')".format(fts=fts))
+
+
+@sqlalchemy.event.listens_for(db.metadata, "after_create")
+def _create_after_create(target, connection, **kw):
+    create_indexes(connection)
+
+
+def rebuild():
+    """Create the indexes if needed, then rebuild them from their tables and merge their segments."""
+    bind = db.session.connection()
+    create_indexes(bind)
+    for fts in INDEXED.values():
+        bind.execute("INSERT INTO {fts} ({fts}) VALUES ('rebuild')".format(fts=fts))
+        bind.execute("INSERT INTO {fts} ({fts}) VALUES ('optimize')".format(fts=fts))
+    db.session.commit()
+
+
+def match_expression(q):
+    """An FTS5 query matching names with a word starting with each word of q."""
+    # words are quoted, so FTS5 operators typed by users are searched as text
+    return " ".join('"{}"*'.format(token) for token in _TOKEN.findall(q))
+
+
+def _encode_cursor(score, kind, ref_id):
+    return base64.urlsafe_b64encode(json.dumps([score, kind, ref_id]).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    try:
+        score, kind, ref_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return float(score), str(kind), int(ref_id)
+    except (ValueError, TypeError):
+        raise ListingError("Invalid after cursor.")
+
+
+def search(args):
+    """One page of the pictures and/or albums whose names match ?q=, returns (data, next cursor).
+
+    Results are ranked by bm25, best first, then by kind and id, and paged
+    with a keyset on those three. Scores depend on the whole index, so a
+    page fetched after many writes may overlap the previous one.
+    """
+    expression = match_expression(args.get("q", ""))
+    if not expression:
+        raise ListingError("q must contain at least one word.")
+    kinds = [args["kind"]] if args.get("kind") else sorted(INDEXED)
+    if any(kind not in INDEXED for kind in kinds):
+        raise ListingError("kind must be one of {}".format(", ".join(sorted(INDEXED))))
+    max_limit = current_app.config.get("MAX_PAGE_SIZE", 1000)
+    try:
+        limit = min(int(args.get("limit", 100)), max_limit)
+    except ValueError:
+        raise ListingError("limit must be an integer.")
+    if limit < 1:
+        raise ListingError("limit must be positive.")
+
+    matches = " UNION ALL ".join(
+        "SELECT '{kind}' AS kind, rowid AS ref_id, bm25({fts}) AS score FROM {fts} WHERE {fts} MATCH :q"
+        .format(kind=kind, fts=INDEXED[kind]) for kind in kinds)
+    params = {"q": expression, "limit": limit + 1}
+    where = ""
+    if args.get("after"):
+        params["score"], params["kind"], params["ref_id"] = _decode_cursor(args["after"])
+        where = "WHERE score > :score OR score = :score AND (kind > :kind OR kind = :kind AND ref_id > :ref_id)"
+    rows = db.session.execute(text("SELECT kind, ref_id, score FROM ({}) {} ORDER BY score, kind, ref_id LIMIT :limit"
+                                   .format(matches, where)), params).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].score, rows[-1].kind, rows[-1].ref_id)
+
+    models = {"picture": Picture, "album": Album}
+    found = {}
+    for kind in kinds:
+        ids = [row.ref_id for row in rows if row.kind == kind]
+        if ids:
+            found.update(((kind, item.id), item) for item in models[kind].query.filter(models[kind].id.in_(ids)))
+    data = [dict(row2dict(found[row.kind, row.ref_id]), kind=row.kind, score=row.score)
+            for row in rows if (row.kind, row.ref_id) in found]
+    return data, next_cursor
@@ -0,0 +1,91 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import bcrypt
+from flask import current_app
+from ImgManager.metrics import timed
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool already has as many jobs as it may queue."""
+
+
+# run inside the pool; module level functions so the process pool can pickle them
+def _generate(password, rounds, prefix):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds, prefix)).decode('utf-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+class HashingExecutor(object):
+    """A bounded pool for bcrypt work.
+
+    bcrypt releases the GIL, so threads give real parallelism; a process pool
+    is available for interpreters where that does not hold. At most
+    workers + max_pending jobs are accepted at once, the next one raises
+    HashingBusy instead of piling up behind the others.
+    """
+
+    def __init__(self, kind="thread", workers=4, max_pending=16):
+        pool_class = ProcessPoolExecutor if kind == "process" else ThreadPoolExecutor
+        self.pool = pool_class(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self.pool.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # built on first use, so a forked worker process gets its own pool
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                config = current_app.config
+                _executor = HashingExecutor(config.get("HASHING_EXECUTOR", "thread"),
+                                            config.get("HASHING_WORKERS", 4),
+                                            config.get("HASHING_MAX_PENDING", 16))
+    return _executor
+
+
+def generate_password_hash(password):
+    rounds = current_app.config.get("BCRYPT_LOG_ROUNDS", 12)
+    prefix = current_app.config.get("BCRYPT_HASH_PREFIX", "2b").encode('ascii')
+    with timed("bcrypt"):
+        return get_executor().run(_generate, password, rounds, prefix)
+
+
+def check_password_hash(pw_hash, password):
+    with timed("bcrypt"):
+        return get_executor().run(_check, pw_hash, password)
+
+
+def hash_rounds(pw_hash):
+    """The cost of a bcrypt hash, None when pw_hash is not one we can read it from."""
+    # bcrypt hashes look like $2b$12$<salt and checksum>
+    try:
+        return int(pw_hash.split('$')[2])
+    except (ValueError, IndexError):
+        return None
+
+
+def needs_rehash(pw_hash):
+    # a hash we cannot read is left as it is
+    rounds = hash_rounds(pw_hash)
+    return rounds is not None and rounds != current_app.config.get("BCRYPT_LOG_ROUNDS", 12)
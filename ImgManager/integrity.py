@@ -0,0 +1,176 @@
+import collections
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from ImgManager import db
+from ImgManager.models import Picture
+from ImgManager.backends import get_backend
+from ImgManager.database import begin_write
+from ImgManager.storage import KEY_PATTERN, legacy_file, picture_folder
+
+# temporary files of uploads, see storage.write_pending
+UPLOAD_PREFIX = ".upload-"
+
+
+def referenced_keys(batch_size, lost=None):
+    """The distinct keys of the Picture rows, sorted, read batch_size at a time along ix_picture_path.
+
+    Rows still holding file paths are left out, `flask migrate-storage`
+    converts them. Those whose file cannot be found are appended to lost.
+    """
+    last = ""
+    while True:
+        rows = db.session.query(Picture.path).filter(Picture.path > last).distinct() \
+            .order_by(Picture.path).limit(batch_size).all()
+        # no read snapshot held between batches, WAL checkpoints would wait for it
+        db.session.commit()
+        if not rows:
+            return
+        for (path,) in rows:
+            if KEY_PATTERN.match(path):
+                yield path
+            elif lost is not None and legacy_file(path) is None:
+                lost.append(path)
+        last = rows[-1][0]
+
+
+def _checked_order(keys, name):
+    previous = None
+    for key in keys:
+        if previous is not None and key <= previous:
+            # a merge of unsorted streams would report (and delete) live files
+            raise RuntimeError("{} keys are not sorted: {!r} after {!r}".format(name, key, previous))
+        previous = key
+        yield key
+
+
+def diff(stored, referenced):
+    """Merge two sorted key streams into (key, stored, referenced), in key order, holding one key of each."""
+    stored = _checked_order(stored, "stored")
+    referenced = _checked_order(referenced, "referenced")
+    s, r = next(stored, None), next(referenced, None)
+    while s is not None or r is not None:
+        if r is None or (s is not None and s < r):
+            yield s, True, False
+            s = next(stored, None)
+        elif s is None or r < s:
+            yield r, False, True
+            r = next(referenced, None)
+        else:
+            yield s, True, True
+            s, r = next(stored, None), next(referenced, None)
+
+
+def intact(backend, key):
+    """Whether the bytes of key hash to the digest in its name, None when it is gone."""
+    sha = hashlib.sha256()
+    try:
+        with backend.open(key) as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+    except FileNotFoundError:
+        return None
+    return sha.hexdigest() == key.rsplit("/", 1)[-1].split(".", 1)[0]
+
+
+def _orphans(backend, keys, cutoff, delete):
+    if delete:
+        # an upload of the same bytes reuses the object, the write lock keeps
+        # its row from being committed between the check and the delete
+        begin_write(db.session)
+    try:
+        # rows added since the scan went past these keys keep their object
+        still = {path for (path,) in db.session.query(Picture.path).filter(Picture.path.in_(keys))}
+        found = []
+        for key in keys:
+            if key in still:
+                continue
+            try:
+                _, mtime = backend.stat(key)
+            except FileNotFoundError:
+                continue
+            if mtime <= cutoff:
+                found.append(key)
+        if delete:
+            backend.delete_many(found)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return [("orphan", key) for key in found]
+
+
+def _stale_uploads(cutoff, delete):
+    try:
+        with os.scandir(picture_folder()) as it:
+            stale = [entry for entry in it if entry.name.startswith(UPLOAD_PREFIX)
+                     and entry.is_file(follow_symlinks=False) and entry.stat().st_mtime <= cutoff]
+    except FileNotFoundError:
+        return []
+    for entry in stale:
+        if delete:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return [("stale", entry.name) for entry in stale]
+
+
+def scan(delete=False, verify=False, workers=None, min_age=None, batch_size=None):
+    """Compare the store with the Picture rows, yields (kind, key) findings, about in key order.
+
+    The store is listed in key order, on a pool of workers threads, and
+    merged with the keys of the rows read in the same order, so memory
+    does not grow with the number of files. Findings:
+
+    - "orphan": a stored object no row references, removed with delete;
+    - "missing": a key referenced by rows but not stored, or the path of
+      a row from before keys whose file cannot be found;
+    - "corrupt": with verify, an object whose sha256 is not its digest;
+    - "stale": a temporary upload file left in PICTURE_FOLDER, removed
+      with delete.
+
+    Files modified less than min_age seconds ago are left alone, they may
+    belong to uploads in progress. Orphans are checked against the rows
+    again, batch_size at a time, before they are reported; with delete,
+    the check and the delete hold the database write lock together.
+    """
+    config = current_app.config
+    workers = workers or config.get("SCAN_WORKERS", 8)
+    min_age = config.get("SCAN_MIN_AGE", 3600) if min_age is None else min_age
+    batch_size = batch_size or config.get("REAPER_BATCH_SIZE", 500)
+    backend = get_backend()
+    cutoff = time.time() - min_age
+
+    orphans = []
+    lost = []
+    checks = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stored = (key for key in backend.iter_keys(pool) if KEY_PATTERN.match(key))
+        for key, in_store, in_db in diff(stored, referenced_keys(batch_size, lost)):
+            if not in_db:
+                orphans.append(key)
+                if len(orphans) >= batch_size:
+                    yield from _orphans(backend, orphans, cutoff, delete)
+                    orphans = []
+            elif not in_store:
+                # an upload stores its object right after committing its row
+                if not backend.exists(key):
+                    yield "missing", key
+            elif verify:
+                checks.append((key, pool.submit(intact, backend, key)))
+                # a few hashes per thread in flight
+                while len(checks) > workers * 4:
+                    checked, future = checks.popleft()
+                    if future.result() is False:
+                        yield "corrupt", checked
+        if orphans:
+            yield from _orphans(backend, orphans, cutoff, delete)
+        for checked, future in checks:
+            if future.result() is False:
+                yield "corrupt", checked
+    for path in lost:
+        yield "missing", path
+    yield from _stale_uploads(cutoff, delete)
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from flask import current_app
+from ImgManager import db
+from ImgManager.database import retry_locked
+from ImgManager.models import Job
+
+logger = logging.getLogger(__name__)
+
+handlers = {}
+
+
+def job_handler(kind, on_failure=None):
+    """Register a function to run jobs of a kind.
+
+    It is called with the job payload as keyword arguments. on_failure, if
+    given, is called the same way once the job has used all its attempts.
+    """
+    def decorator(fn):
+        handlers[kind] = (fn, on_failure)
+        return fn
+    return decorator
+
+
+def enqueue(kind, **payload):
+    """Add a job to the current session.
+
+    It is only visible to workers once the caller commits, so a job and the
+    rows it works on are committed together.
+    """
+    job = Job(kind=kind, payload=json.dumps(payload), run_after=time.time())
+    db.session.add(job)
+    return job
+
+
+def enqueue_many(kind, payloads):
+    """Add one job per payload with a single executemany, in the current transaction."""
+    now = time.time()
+    rows = [{"kind": kind, "payload": json.dumps(payload), "status": 'queued', "attempts": 0, "run_after": now}
+            for payload in payloads]
+    if rows:
+        db.session.execute(Job.__table__.insert(), rows)
+
+
+@retry_locked
+def claim(worker_id):
+    """Mark the oldest due job as running for this worker and return it, or None."""
+    now = time.time()
+    while True:
+        candidate = db.session.query(Job.id).filter(Job.status == 'queued', Job.run_after <= now) \
+            .order_by(Job.run_after, Job.id).first()
+        if candidate is None:
+            db.session.rollback()
+            return None
+
+        # only one worker wins the status change, the others look for the next job
+        claimed = Job.query.filter_by(id=candidate.id, status='queued') \
+            .update({"status": 'running', "locked_by": worker_id, "locked_at": now,
+                     "attempts": Job.attempts + 1}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Job.query.get(candidate.id)
+
+
+def run_job(job):
+    fn, on_failure = handlers[job.kind]
+    payload = json.loads(job.payload)
+    try:
+        fn(**payload)
+    except Exception:
+        db.session.rollback()
+        job.last_error = traceback.format_exc()
+        max_attempts = current_app.config.get("JOB_MAX_ATTEMPTS", 5)
+        if job.attempts >= max_attempts:
+            logger.error("Job %s failed after %s attempts", job, job.attempts)
+            job.status = 'failed'
+            if on_failure:
+                on_failure(**payload)
+        else:
+            # exponential backoff between attempts
+            job.status = 'queued'
+            job.run_after = time.time() + current_app.config.get("JOB_RETRY_DELAY", 10) * 2 ** (job.attempts - 1)
+        job.locked_by = None
+        db.session.commit()
+        return False
+
+    db.session.delete(job)
+    db.session.commit()
+    return True
+
+
+@retry_locked
+def requeue_stale():
+    """Put back jobs whose worker died while running them."""
+    cutoff = time.time() - current_app.config.get("JOB_TIMEOUT", 600)
+    count = Job.query.filter(Job.status == 'running', Job.locked_at < cutoff) \
+        .update({"status": 'queued', "locked_by": None}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def load_handlers():
+    # the task modules register their handlers when imported
+    from ImgManager import tasks
+
+
+def run_pending(worker_id="inline"):
+    """Run due jobs in the calling thread until none is left, returns how many ran."""
+    load_handlers()
+    count = 0
+    job = claim(worker_id)
+    while job is not None:
+        run_job(job)
+        count += 1
+        job = claim(worker_id)
+    return count
+
+
+def _worker_loop(app, worker_id, stop):
+    with app.app_context():
+        poll_interval = app.config.get("JOB_POLL_INTERVAL", 1.0)
+        while not stop.is_set():
+            try:
+                if not run_pending(worker_id):
+                    stop.wait(poll_interval)
+            except Exception:
+                logger.exception("Worker %s crashed, restarting its loop", worker_id)
+                db.session.rollback()
+                stop.wait(poll_interval)
+            finally:
+                db.session.remove()
+
+
+def run_worker(app, threads=None):
+    """Run job worker threads until interrupted."""
+    load_handlers()
+    if threads is None:
+        threads = app.config.get("JOB_WORKER_THREADS", 2)
+    with app.app_context():
+        requeued = requeue_stale()
+        if requeued:
+            logger.warning("Requeued %s stale jobs", requeued)
+
+    stop = threading.Event()
+    prefix = "{}:{}".format(socket.gethostname(), os.getpid())
+    workers = [threading.Thread(target=_worker_loop, args=(app, "{}:{}".format(prefix, i), stop), daemon=True)
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    try:
+        while not stop.is_set():
+            stop.wait(1)
+    except KeyboardInterrupt:
+        stop.set()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,81 @@
+from flask import current_app, jsonify, make_response, request
+from ImgManager import db
+from ImgManager.models import public_columns
+from ImgManager.serializers import stream_rows
+
+
+class ListingError(ValueError):
+    pass
+
+
+def parse_listing_args(model, args):
+    """Read the limit/after/fields query parameters of a listing request.
+
+    Returns None when none of them were given, so the caller can keep the
+    legacy unpaginated behavior.
+    """
+    if not any(key in args for key in ("limit", "after", "fields")):
+        return None
+
+    max_limit = current_app.config.get("MAX_PAGE_SIZE", 1000)
+    try:
+        limit = int(args.get("limit", max_limit))
+        after = int(args["after"]) if args.get("after") else None
+    except ValueError:
+        raise ListingError("limit and after must be integers.")
+    if limit < 1:
+        raise ListingError("limit must be positive.")
+    limit = min(limit, max_limit)
+
+    columns = public_columns(model)
+    if args.get("fields"):
+        by_name = {c.name: c for c in columns}
+        names = [name.strip() for name in args["fields"].split(",") if name.strip()]
+        unknown = [name for name in names if name not in by_name]
+        if unknown:
+            raise ListingError("Unknown fields: {}".format(", ".join(unknown)))
+        columns = [by_name[name] for name in names]
+
+    return limit, after, columns
+
+
+def keyset_page(model, limit, after, columns, query=None):
+    """Fetch one page ordered by id, selecting only the requested columns.
+
+    The id is always selected so the next cursor can be built, but it is only
+    returned to the client when it was asked for.
+    """
+    id_column = model.__table__.c.id
+    selected = columns if id_column in columns else [id_column] + columns
+    if query is None:
+        query = db.session.query(*selected)
+    else:
+        query = query.with_entities(*selected)
+
+    if after is not None:
+        query = query.filter(id_column > after)
+    # fetch one extra row to know whether there is a next page
+    rows = query.order_by(id_column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1].id)
+
+    names = [c.name for c in columns]
+    data = [{name: str(getattr(row, name)) for name in names} for row in rows]
+    return data, next_cursor
+
+
+def list_response(model, query=None):
+    try:
+        listing = parse_listing_args(model, request.args)
+    except ListingError as e:
+        return make_response(jsonify({"code": 400, "msg": str(e)}), 400)
+
+    if listing is None:
+        return stream_rows(model, query)
+
+    limit, after, columns = listing
+    data, next_cursor = keyset_page(model, limit, after, columns, query)
+    return jsonify({"data": data, "next": next_cursor})
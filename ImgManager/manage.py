@@ -1,7 +1,65 @@
-from main import app
+import collections
+import click
+from ImgManager import app
 from ImgManager.models import db, Person, Album, Picture
+from ImgManager.storage import migrate_paths
+from ImgManager.similarity import backfill
+from ImgManager import fulltext, integrity, metadata, schema
 
 
 @app.shell_context_processor
 def make_shell_context():
     return dict(app=app, db=db, Person=Person, Album=Album, Picture=Picture)
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """Create missing tables, columns and indexes in the configured database."""
+    schema.upgrade_database(app)
+    print("Database schema is up to date.")
+
+
+@app.cli.command("migrate-storage")
+def migrate_storage():
+    """Store pictures saved under file paths in the storage backend, keyed by content."""
+    migrated, missing = migrate_paths()
+    print("Migrated {} pictures, {} files not found.".format(migrated, missing))
+
+
+@app.cli.command("backfill-dhash")
+def backfill_dhash():
+    """Compute the perceptual hash of the pictures stored before it existed."""
+    hashed, missing = backfill()
+    print("Hashed {} pictures, {} files not found or unreadable.".format(hashed, missing))
+
+
+@app.cli.command("backfill-metadata")
+@click.option("--workers", type=int, default=None, help="Processes reading the files (default: METADATA_WORKERS).")
+def backfill_metadata(workers):
+    """Read the header metadata of the pictures stored before it was extracted."""
+    done, missing = metadata.backfill(workers)
+    print("Read the metadata of {} pictures, {} files not found.".format(done, missing))
+
+
+@app.cli.command("rebuild-search")
+def rebuild_search():
+    """Create the full-text indexes of picture and album names and rebuild them from the tables."""
+    fulltext.rebuild()
+    print("Search indexes rebuilt.")
+
+
+@app.cli.command("scan-storage")
+@click.option("--delete", is_flag=True, help="Remove the orphaned objects and stale uploads found.")
+@click.option("--verify", is_flag=True, help="Also hash the referenced objects and compare them with their digest.")
+@click.option("--workers", type=int, default=None, help="Threads listing folders and hashing (default: SCAN_WORKERS).")
+@click.option("--min-age", type=float, default=None,
+              help="Seconds before an unreferenced file counts as orphaned (default: SCAN_MIN_AGE).")
+def scan_storage(delete, verify, workers, min_age):
+    """Find stored files no picture references and pictures whose file is missing or corrupted."""
+    counts = collections.Counter()
+    for kind, key in integrity.scan(delete, verify, workers, min_age):
+        counts[kind] += 1
+        print("{} {}".format(kind, key))
+    print("{} orphaned, {} missing, {}, {} stale uploads{}.".format(
+        counts["orphan"], counts["missing"], "{} corrupted".format(counts["corrupt"]) if verify else "not verified",
+        counts["stale"], " (orphans and stale uploads removed)" if delete else ""))
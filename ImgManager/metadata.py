@@ -0,0 +1,251 @@
+import base64
+import contextlib
+import datetime
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from sqlalchemy import select
+from ImgManager import db
+from ImgManager.models import Picture, PictureMetadata, public_columns
+from ImgManager.backends import get_backend
+from ImgManager.listing import ListingError
+from ImgManager.metrics import timed
+from ImgManager.storage import KEY_PATTERN, legacy_file
+
+# EXIF tags, see https://exiftool.org/TagNames/EXIF.html
+_MAKE = 0x010f
+_MODEL = 0x0110
+_DATETIME = 0x0132
+_EXIF_IFD = 0x8769
+_DATETIME_ORIGINAL = 0x9003
+
+# ?sort= of /pictures/search, a leading "-" sorts in descending order
+SORTS = {"taken_at": PictureMetadata.taken_at, "width": PictureMetadata.width,
+         "height": PictureMetadata.height, "size": PictureMetadata.size}
+# range filters: parameter -> (column, operator, parser)
+_RANGES = {
+    "taken_after": ("taken_at", "__ge__", "datetime"),
+    "taken_before": ("taken_at", "__lt__", "datetime"),
+    "min_width": ("width", "__ge__", "int"),
+    "max_width": ("width", "__le__", "int"),
+    "min_height": ("height", "__ge__", "int"),
+    "max_height": ("height", "__le__", "int"),
+    "min_size": ("size", "__ge__", "int"),
+    "max_size": ("size", "__le__", "int"),
+}
+_EQUALS = ("camera_make", "camera_model", "format")
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    value = str(value).strip("\x00 \t\r\n")
+    return value[:64] or None
+
+
+def _exif_datetime(value):
+    try:
+        return datetime.datetime.strptime(_text(value) or "", "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def _exif(img):
+    if hasattr(img, "getexif"):
+        exif = img.getexif()
+        # DateTimeOriginal lives in the Exif sub-IFD
+        return exif, exif.get_ifd(_EXIF_IFD) if hasattr(exif, "get_ifd") else exif
+    # older Pillow only reads EXIF from JPEGs, flattened in one dict
+    exif = img._getexif() if hasattr(img, "_getexif") else None
+    return exif or {}, exif or {}
+
+
+def _exif_fields(img):
+    exif, sub = _exif(img)
+    taken = sub.get(_DATETIME_ORIGINAL) or exif.get(_DATETIME)
+    return {
+        "taken_at": _exif_datetime(taken) if taken else None,
+        "camera_make": _text(exif[_MAKE]) if exif.get(_MAKE) else None,
+        "camera_model": _text(exif[_MODEL]) if exif.get(_MODEL) else None,
+    }
+
+
+def read_metadata(path):
+    """The metadata fields of an image file, without decoding its pixels.
+
+    Image.open only parses the headers, which is all width, height, format
+    and EXIF need. Every field is there, None when the file does not say,
+    so the rows of a batch insert together. A broken EXIF block only leaves
+    the EXIF fields out; Pillow 5 also parses it while opening JPEGs without
+    a JFIF density, those files get no field at all. Module level, so a
+    process pool can run it.
+    """
+    from PIL import Image
+    fields = dict.fromkeys(("width", "height", "format", "taken_at", "camera_make", "camera_model"))
+    # Pillow's parsers raise about anything on malformed headers and tags
+    try:
+        with timed("pillow"), Image.open(path) as img:
+            fields.update(width=img.width, height=img.height, format=img.format)
+            try:
+                fields.update(_exif_fields(img))
+            except Exception:
+                pass
+    except Exception:
+        pass
+    return fields
+
+
+def forget(*criteria):
+    """Delete the metadata of the pictures matching criteria, in the caller's transaction, before the pictures."""
+    ids = select([Picture.id]).where(db.and_(*criteria))
+    db.session.execute(PictureMetadata.__table__.delete().where(PictureMetadata.picture_id.in_(ids)))
+
+
+def _local_file(backend, path, stack):
+    if not KEY_PATTERN.match(path):
+        return legacy_file(path)
+    if not backend.exists(path):
+        return None
+    # copies of remote objects live until the batch is done
+    return stack.enter_context(backend.local_copy(path))
+
+
+def backfill(workers=None, batch_size=None):
+    """Read the metadata of the pictures that have none, returns (read, missing) counts.
+
+    Files are read by a pool of worker processes, one per CPU by default,
+    and the rows inserted in batches of batch_size per transaction. Pictures
+    whose file cannot be found are left without metadata.
+    """
+    if workers is None:
+        workers = current_app.config.get("METADATA_WORKERS") or os.cpu_count()
+    if batch_size is None:
+        batch_size = current_app.config.get("REAPER_BATCH_SIZE", 500)
+    backend = get_backend()
+    done = missing = 0
+    last_id = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = db.session.query(Picture.id, Picture.path) \
+                .outerjoin(PictureMetadata, PictureMetadata.picture_id == Picture.id) \
+                .filter(Picture.id > last_id, PictureMetadata.picture_id.is_(None)) \
+                .order_by(Picture.id).limit(batch_size).all()
+            if not rows:
+                return done, missing
+            last_id = rows[-1].id
+
+            with contextlib.ExitStack() as stack:
+                found = []
+                for picture_id, path in rows:
+                    local = _local_file(backend, path, stack)
+                    if local is None:
+                        missing += 1
+                    else:
+                        found.append((picture_id, local, os.path.getsize(local)))
+                chunksize = max(1, len(found) // (workers * 4))
+                fields = pool.map(read_metadata, [local for _, local, _ in found], chunksize=chunksize)
+                values = [dict(row_fields, picture_id=picture_id, size=size)
+                          for (picture_id, _, size), row_fields in zip(found, fields)]
+            if values:
+                db.session.execute(PictureMetadata.__table__.insert(), values)
+            db.session.commit()
+            done += len(values)
+
+
+def _parse(kind, value, name):
+    try:
+        if kind == "int":
+            return int(value)
+        # dates alone are midnight
+        return datetime.datetime.strptime(value, "%Y-%m-%d") if len(value) == 10 \
+            else datetime.datetime.strptime(value.replace("T", " "), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise ListingError("{} must be {}.".format(name, "an integer" if kind == "int" else
+                                                   "YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS"))
+
+
+def _encode_cursor(value, picture_id):
+    if isinstance(value, datetime.datetime):
+        value = value.strftime("%Y-%m-%d %H:%M:%S")
+    return base64.urlsafe_b64encode(json.dumps([value, picture_id]).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor, kind):
+    try:
+        value, picture_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return (_parse(kind, value, "after") if kind else value), int(picture_id)
+    except (ValueError, TypeError, ListingError):
+        raise ListingError("Invalid after cursor.")
+
+
+def search(args):
+    """One page of pictures matching the filters of args, returns (data, next cursor).
+
+    Filters and sorting are on PictureMetadata columns, each backed by an
+    index ending with picture_id, so pages are found by seeking the index
+    after the cursor: (sort value, picture_id) of the last row. Pictures
+    without a value for the sort column are left out. Without ?sort=, rows
+    come in the order of the first range filter, or of their id.
+    """
+    max_limit = current_app.config.get("MAX_PAGE_SIZE", 1000)
+    try:
+        limit = min(int(args.get("limit", 100)), max_limit)
+    except ValueError:
+        raise ListingError("limit must be an integer.")
+    if limit < 1:
+        raise ListingError("limit must be positive.")
+
+    query = db.session.query(Picture, PictureMetadata).join(PictureMetadata,
+                                                            PictureMetadata.picture_id == Picture.id)
+    for name, (column, operator, kind) in _RANGES.items():
+        if args.get(name):
+            query = query.filter(getattr(getattr(PictureMetadata, column), operator)(_parse(kind, args[name], name)))
+    for name in _EQUALS:
+        if args.get(name):
+            query = query.filter(getattr(PictureMetadata, name) == args[name])
+
+    sort = args.get("sort", "")
+    if not sort:
+        # ordered by the first range filter, so its index gives both the rows and their order
+        sort = next((column for name, (column, _, _) in _RANGES.items() if args.get(name)), "")
+    descending = sort.startswith("-")
+    sort = sort.lstrip("-")
+    if sort and sort not in SORTS:
+        raise ListingError("sort must be one of {}".format(", ".join(sorted(SORTS))))
+    key = PictureMetadata.picture_id
+    column = SORTS.get(sort)
+    kind = "datetime" if sort == "taken_at" else "int" if sort else None
+
+    if column is not None:
+        query = query.filter(column.isnot(None))
+    if args.get("after"):
+        if column is None:
+            try:
+                query = query.filter(key < int(args["after"]) if descending else key > int(args["after"]))
+            except ValueError:
+                raise ListingError("Invalid after cursor.")
+        else:
+            value, picture_id = _decode_cursor(args["after"], kind)
+            if descending:
+                query = query.filter(db.or_(column < value, db.and_(column == value, key < picture_id)))
+            else:
+                query = query.filter(db.or_(column > value, db.and_(column == value, key > picture_id)))
+    order = [column, key] if column is not None else [key]
+    query = query.order_by(*[c.desc() if descending else c for c in order])
+
+    # one extra row tells whether there is a next page
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][1]
+        next_cursor = str(last.picture_id) if column is None else \
+            _encode_cursor(getattr(last, sort), last.picture_id)
+
+    columns = public_columns(Picture) + [c for c in public_columns(PictureMetadata) if c.name != "picture_id"]
+    data = []
+    for picture, metadata in rows:
+        data.append({c.name: str(getattr(picture if c.table is Picture.__table__ else metadata, c.name))
+                     for c in columns})
+    return data, next_cursor
@@ -0,0 +1,262 @@
+import contextlib
+import logging
+import threading
+import time
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# statements per request, an endpoint whose requests land in the high buckets has an N+1
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500, 1000)
+# where the RequestMetrics of a request are kept, in its WSGI environ: streamed
+# bodies run after the request's app context, and its flask.g, are gone
+ENVIRON_KEY = "imgmanager.metrics"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in zip(names, escaped)) + "}"
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("{}{} {}".format(self.name, _labels(self.labels, labels), value))
+        return lines
+
+
+class Sampled(object):
+    """A value read from a callback when the metrics are rendered, for stats kept elsewhere."""
+
+    def __init__(self, name, help, read, type="gauge"):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.type = type
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type),
+                "{} {}".format(self.name, self.read())]
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # one count per bucket, then +Inf, the sum and the number of observations
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[len(self.buckets)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        names = self.labels + ("le",)
+        with self.lock:
+            for labels, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    lines.append("{}_bucket{} {}".format(self.name, _labels(names, labels + (bound,)), count))
+                lines.append("{}_sum{} {}".format(self.name, _labels(self.labels, labels), counts[-2]))
+                lines.append("{}_count{} {}".format(self.name, _labels(self.labels, labels), counts[-1]))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+request_duration = registry.add(Histogram(
+    "imgmanager_request_duration_seconds", "Time to build the response, and send it when streamed.", ("endpoint", "method", "status")))
+request_statements = registry.add(Histogram(
+    "imgmanager_request_sql_statements", "SQL statements run per request.", ("endpoint",), STATEMENT_BUCKETS))
+sql_statements = registry.add(Counter(
+    "imgmanager_sql_statements_total", "SQL statements run by requests.", ("endpoint",)))
+sql_seconds = registry.add(Counter(
+    "imgmanager_sql_seconds_total", "Time spent running SQL statements.", ("endpoint",)))
+request_bytes = registry.add(Counter(
+    "imgmanager_request_bytes_total", "Request and response body bytes.", ("endpoint", "direction")))
+work_seconds = registry.add(Counter(
+    "imgmanager_work_seconds_total", "Time spent in Pillow and bcrypt calls.", ("endpoint", "kind")))
+
+
+class RequestMetrics(object):
+    """What a request did so far, kept in its environ."""
+
+    def __init__(self, max_queries):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.sql_time = 0.0
+        self.queries = []
+        self.max_queries = max_queries
+        self.work = {}
+        self.sent = 0
+        # set once the response is known, see Instrumentation.describe
+        self.status = None
+        self.finished = False
+
+    def add_query(self, statement, duration):
+        self.statements += 1
+        self.sql_time += duration
+        if len(self.queries) < self.max_queries:
+            self.queries.append((duration, statement))
+
+
+def _current():
+    return request.environ.get(ENVIRON_KEY) if has_request_context() else None
+
+
+@contextlib.contextmanager
+def timed(kind):
+    """Account the time of the with block to kind ("pillow", "bcrypt"...) for the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current()
+        if metrics is not None:
+            metrics.work[kind] = metrics.work.get(kind, 0.0) + time.perf_counter() - start
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info["statement_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_statement(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("statement_start", None)
+    metrics = _current()
+    if metrics is not None and start is not None:
+        metrics.add_query(statement, time.perf_counter() - start)
+
+
+def _count_bytes(chunks, metrics, charset):
+    try:
+        for chunk in chunks:
+            # str chunks are sent encoded, as werkzeug does
+            metrics.sent += len(chunk.encode(charset) if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        # stream_with_context bodies pop their request context on close
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class Instrumentation(object):
+    """Per endpoint latency, SQL, body size and Pillow/bcrypt time of every request.
+
+    Latency covers building the response, and sending it for streamed
+    bodies, whose SQL and work are counted once they have been sent.
+    Requests that end in an exception are counted as 500s. Requests slower
+    than SLOW_REQUEST_SECONDS are logged with their queries. Values are per
+    process.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        request.environ[ENVIRON_KEY] = RequestMetrics(current_app.config.get("SLOW_REQUEST_MAX_QUERIES", 50))
+
+    def describe(self, metrics, status):
+        # what finish() needs, it may run after the request context is gone
+        metrics.status = status
+        # the view name, without its blueprint
+        metrics.endpoint = (request.endpoint or "none").rpartition(".")[2]
+        metrics.method = request.method
+        metrics.path = request.path
+        metrics.received = request.content_length or 0
+        metrics.slow = current_app.config.get("SLOW_REQUEST_SECONDS", 1.0)
+
+    def after_request(self, response):
+        metrics = _current()
+        if metrics is None:
+            return response
+        self.describe(metrics, response.status_code)
+        if response.content_length is None and response.is_streamed:
+            response.response = ClosingIterator(_count_bytes(response.response, metrics, response.charset),
+                                                lambda: self.finish(metrics))
+        else:
+            # file bodies are left alone so the server can still use sendfile
+            metrics.sent = response.content_length or 0
+            self.finish(metrics)
+        return response
+
+    def teardown_request(self, exc=None):
+        # after_request does not run for exceptions that reach the server
+        metrics = _current()
+        if metrics is not None and metrics.status is None:
+            self.describe(metrics, 500)
+            self.finish(metrics)
+
+    def finish(self, metrics):
+        if metrics.finished:
+            return
+        metrics.finished = True
+        duration = time.perf_counter() - metrics.start
+        endpoint = metrics.endpoint
+
+        request_duration.observe(duration, endpoint, metrics.method, metrics.status)
+        request_statements.observe(metrics.statements, endpoint)
+        sql_statements.inc(endpoint, amount=metrics.statements)
+        sql_seconds.inc(endpoint, amount=metrics.sql_time)
+        for kind, seconds in metrics.work.items():
+            work_seconds.inc(endpoint, kind, amount=seconds)
+        request_bytes.inc(endpoint, "in", amount=metrics.received)
+        request_bytes.inc(endpoint, "out", amount=metrics.sent)
+
+        if duration >= metrics.slow:
+            queries = "".join("\n  {:.1f} ms: {}".format(seconds * 1000, " ".join(statement.split()))
+                              for seconds, statement in metrics.queries)
+            logger.warning("Slow request %s %s (%s) took %.1f ms, %s SQL statements in %.1f ms:%s",
+                           metrics.method, metrics.path, endpoint, duration * 1000,
+                           metrics.statements, metrics.sql_time * 1000, queries)
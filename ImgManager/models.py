@@ -1,32 +1,71 @@
 from ImgManager import db, login_manager
+from ImgManager.usercache import CachedUser, user_cache
 from flask_login import UserMixin
+from sqlalchemy import event
+
+
+_public_columns = {}
+
+
+def public_columns(model):
+    # computed once per model, the listing and serializing code asks for it on every row
+    columns = _public_columns.get(model)
+    if columns is None:
+        columns = [c for c in model.__table__.columns if not c.info.get("private")]
+        _public_columns[model] = columns
+    return columns
 
 
 def row2dict(row):
-    return {c.name: str(getattr(row, c.name)) for c in row.__table__.columns if c.name is not "password"}
+    return {c.name: str(getattr(row, c.name)) for c in public_columns(type(row))}
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return Person.query.get(int(user_id))
+    user_id = int(user_id)
+    user = user_cache.get(user_id)
+    if user is None:
+        person = db.session.query(Person.id, Person.name).filter_by(id=user_id).first()
+        if not person:
+            return None
+        user = CachedUser(person.id, person.name)
+        user_cache.put(user_id, user)
+    return user
 
 
 class Person(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text(), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
+    password = db.Column(db.String(120), nullable=False, info={"private": True})
     albums = db.relationship('Album', backref='owner', lazy=True)
 
     def __repr__(self):
         return "<Person {}: {}>".format(self.id, self.name)
 
 
+@event.listens_for(Person, "after_update")
+@event.listens_for(Person, "after_delete")
+def _invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(int(target.id))
+
+
+@event.listens_for(db.session, "after_bulk_update")
+@event.listens_for(db.session, "after_bulk_delete")
+def _clear_cached_users(context):
+    # Query.update()/delete() do not say which rows they touched
+    if context.mapper.class_ is Person:
+        user_cache.clear()
+
+
 class Album(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(20), unique=False, nullable=False)
+    name = db.Column(db.String(20), unique=False, nullable=False, index=True)
     person_id = db.Column(db.Integer, db.ForeignKey('person.id'), nullable=False)
     pictures = db.relationship('Picture', backref='album', lazy=True)
 
+    # also serves the person_id lookups, and lists an owner's albums in id order
+    __table_args__ = (db.Index('ix_album_person_id_id', 'person_id', 'id'),)
+
     def __repr__(self):
         return "<Album {}: {}, {}>".format(self.id, self.name, self.person_id)
 
@@ -36,6 +75,90 @@ class Picture(db.Model):
     name = db.Column(db.String(20), unique=True, nullable=False)
     album_id = db.Column(db.Integer, db.ForeignKey('album.id'), nullable=False)
     path = db.Column(db.String(20), nullable=False, default='default.jpg')
+    # sha256 of the stored file, pictures sharing a digest share the file
+    digest = db.Column(db.String(64), index=True, info={"private": True})
+    # CRC-32 of the stored file, what zip exports need
+    crc32 = db.Column(db.BigInteger, info={"private": True})
+    # "pending" until the background processing of an upload is done, then "ready" or "failed"
+    status = db.Column(db.String(10), nullable=False, default='ready', server_default='ready')
+    # perceptual hash of the picture, as a signed 64-bit integer, see ImgManager.similarity
+    dhash = db.Column(db.BigInteger, info={"private": True})
+
+    # album listings filter on album_id and page on id, the storage scan reads paths in order.
+    # AUTOINCREMENT: the id of a deleted picture is never given to a new one,
+    # the similarity index reads new rows past the highest id it has seen
+    __table_args__ = (db.Index('ix_picture_album_id_id', 'album_id', 'id'), db.Index('ix_picture_path', 'path'),
+                      {"sqlite_autoincrement": True})
 
     def __repr__(self):
         return "<Album {}: {}, {}, {}>".format(self.id, self.name, self.album_id, self.path)
+
+
+class Tombstone(db.Model):
+    """A stored file whose Picture rows were deleted, waiting for the reaper to unlink it."""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(20), nullable=False)
+    digest = db.Column(db.String(64))
+    created_at = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return "<Tombstone {}: {}>".format(self.id, self.path)
+
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text(), nullable=False, default='{}')
+    # "queued", "running" or "failed", finished jobs are deleted
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.Float, nullable=False)
+    locked_by = db.Column(db.String(50))
+    locked_at = db.Column(db.Float)
+    last_error = db.Column(db.Text())
+
+    # workers look for the oldest queued job that is due
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'),)
+
+    def __repr__(self):
+        return "<Job {}: {}, {}, {}>".format(self.id, self.kind, self.status, self.attempts)
+
+
+class CacheGeneration(db.Model):
+    """How many committed transactions wrote to a table, see ImgManager.responsecache."""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<CacheGeneration {}: {}>".format(self.name, self.value)
+
+
+class PictureMetadata(db.Model):
+    """What the header of a picture's file says, see ImgManager.metadata.
+
+    Fields the file does not have are NULL; a row exists once the file was read.
+    """
+    __tablename__ = "picture_metadata"
+    picture_id = db.Column(db.Integer, db.ForeignKey('picture.id'), primary_key=True)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    size = db.Column(db.Integer)
+    format = db.Column(db.String(10))
+    # EXIF DateTimeOriginal, in the camera's local time
+    taken_at = db.Column(db.DateTime)
+    camera_make = db.Column(db.String(64))
+    camera_model = db.Column(db.String(64))
+
+    # one per filter or sort of /pictures/search, ending with picture_id for its keyset pagination
+    __table_args__ = (
+        db.Index('ix_picture_metadata_taken_at', 'taken_at', 'picture_id'),
+        db.Index('ix_picture_metadata_width', 'width', 'picture_id'),
+        db.Index('ix_picture_metadata_height', 'height', 'picture_id'),
+        db.Index('ix_picture_metadata_size', 'size', 'picture_id'),
+        db.Index('ix_picture_metadata_camera_make', 'camera_make', 'taken_at', 'picture_id'),
+        db.Index('ix_picture_metadata_camera_model', 'camera_model', 'taken_at', 'picture_id'),
+        db.Index('ix_picture_metadata_format', 'format', 'taken_at', 'picture_id'),
+    )
+
+    def __repr__(self):
+        return "<PictureMetadata {}: {}x{}, {}>".format(self.picture_id, self.width, self.height, self.taken_at)
@@ -0,0 +1,282 @@
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+from ImgManager import db
+
+logger = logging.getLogger(__name__)
+
+# set for the new arbiter when one re-executes itself on SIGHUP
+LISTEN_FD_ENV = "IMGMANAGER_LISTEN_FD"
+OLD_WORKERS_ENV = "IMGMANAGER_OLD_WORKERS"
+# run by a reload before anything else: the new code must build the app.
+# Building it opens no database connection, a busy database cannot refuse the reload.
+APP_CHECK = "from ImgManager import create_app; create_app()"
+
+
+def dispose_engines(app):
+    """Close the pooled connections, a connection must never be used by two processes."""
+    for bind in [None] + list(app.config.get("SQLALCHEMY_BINDS") or ()):
+        db.get_engine(app, bind).dispose()
+
+
+class Worker(object):
+    """A forked server process, serving the arbiter's socket with a thread per connection.
+
+    At most `threads` requests run the app at once. The worker stops
+    accepting connections on SIGTERM or after max_requests requests, then
+    lets the running ones finish for up to graceful_timeout seconds.
+    """
+
+    def __init__(self, app, sock, threads, max_requests, graceful_timeout):
+        self.app = app
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.slots = threading.BoundedSemaphore(threads)
+        self.idle = threading.Condition()
+        self.active = 0
+        self.handled = 0
+        self.stopping = threading.Event()
+        host, port = sock.getsockname()[:2]
+        self.server = make_server(host, port, self, threaded=True, fd=sock.fileno())
+
+    def __call__(self, environ, start_response):
+        self.slots.acquire()
+        with self.idle:
+            self.active += 1
+            self.handled += 1
+            recycle = self.handled == self.max_requests
+        if recycle:
+            self.stop("served {} requests".format(self.handled))
+        try:
+            iterable = self.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        # the request is done once its body is sent
+        return ClosingIterator(iterable, self._done)
+
+    def _done(self):
+        with self.idle:
+            self.active -= 1
+            self.idle.notify_all()
+        self.slots.release()
+
+    def stop(self, reason):
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        logger.info("Worker %s stopping: %s", os.getpid(), reason)
+        # shutdown() waits for serve_forever(), which runs on the main thread
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop("SIGTERM"))
+        # the arbiter decides, even when the whole process group gets the signal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        logger.info("Worker %s serving", os.getpid())
+        self.server.serve_forever()
+        deadline = time.time() + self.graceful_timeout
+        with self.idle:
+            while self.active and time.time() < deadline:
+                self.idle.wait(deadline - time.time())
+            if self.active:
+                logger.warning("Worker %s exiting with %s requests still running", os.getpid(), self.active)
+            return self.active == 0
+
+
+class Arbiter(object):
+    """Pre-fork server: binds the socket, then forks workers from the already imported app.
+
+    Workers share the modules loaded here copy-on-write. The arbiter only
+    watches them: it replaces the ones that exit (max_requests reached,
+    crashes), stops them all on SIGTERM or SIGINT, and reloads on SIGHUP.
+
+    A reload re-executes the arbiter in the same process, with the socket
+    left open, after checking the new code builds the app at all. The new
+    arbiter imports the app again, forks its workers, then tells the old
+    ones to finish their requests and exit, so the socket keeps being served.
+    """
+
+    def __init__(self, app, bind=("127.0.0.1", 8000), workers=None, threads=16, max_requests=10000,
+                 max_requests_jitter=1000, graceful_timeout=30):
+        self.app = app
+        self.bind = bind
+        self.size = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.socket = None
+        self.workers = {}
+        self.retiring = set()
+        self.backoff_until = 0
+        self.wakeup = self.wakeup_write = None
+
+    @classmethod
+    def from_app(cls, app, bind, **options):
+        config = app.config
+        settings = {
+            "workers": config.get("SERVER_WORKERS"),
+            "threads": config.get("SERVER_THREADS", 16),
+            "max_requests": config.get("SERVER_MAX_REQUESTS", 10000),
+            "max_requests_jitter": config.get("SERVER_MAX_REQUESTS_JITTER", 1000),
+            "graceful_timeout": config.get("SERVER_GRACEFUL_TIMEOUT", 30),
+        }
+        settings.update((name, value) for name, value in options.items() if value is not None)
+        return cls(app, bind, **settings)
+
+    def listen(self):
+        family = socket.AF_INET6 if ":" in self.bind[0] else socket.AF_INET
+        if LISTEN_FD_ENV in os.environ:
+            # inherited from the arbiter that re-executed itself
+            fd = int(os.environ.pop(LISTEN_FD_ENV))
+            sock = socket.socket(family, socket.SOCK_STREAM, fileno=fd)
+        else:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self.bind)
+            sock.listen(2048)
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        logger.info("Listening on http://%s:%s with %s workers", host, port, self.size)
+        return sock
+
+    def run(self):
+        """Serve until SIGTERM or SIGINT, returns the exit status."""
+        if self.socket is None:
+            self.listen()
+        self.wakeup, self.wakeup_write = socket.socketpair()
+        self.wakeup_write.setblocking(False)
+        signal.set_wakeup_fd(self.wakeup_write.fileno())
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, lambda signum, frame: None)
+
+        old = [int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, "").split(",") if pid]
+        # the connections opened by importing the app stay here
+        dispose_engines(self.app)
+        self.spawn_missing()
+        self.retire(old)
+        try:
+            while True:
+                for signum in self.wait_signals(1.0):
+                    if signum in (signal.SIGTERM, signal.SIGINT):
+                        logger.info("Stopping on %s", signal.Signals(signum).name)
+                        return self.stop()
+                    if signum == signal.SIGHUP:
+                        self.reload()
+                self.reap()
+                self.spawn_missing()
+        finally:
+            signal.set_wakeup_fd(-1)
+            self.wakeup.close()
+            self.wakeup_write.close()
+
+    def wait_signals(self, timeout):
+        ready, _, _ = select.select([self.wakeup], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            return list(self.wakeup.recv(64))
+        except BlockingIOError:
+            return []
+
+    def spawn_missing(self):
+        if time.time() < self.backoff_until:
+            return
+        while len(self.workers) < self.size:
+            self.spawn()
+
+    def spawn(self):
+        max_requests = self.max_requests + random.randint(0, self.max_requests_jitter) if self.max_requests else 0
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return pid
+
+        status = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            self.wakeup.close()
+            self.wakeup_write.close()
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            dispose_engines(self.app)
+            worker = Worker(self.app, self.socket, self.threads, max_requests, self.graceful_timeout)
+            status = 0 if worker.run() else 1
+        except BaseException:
+            logger.exception("Worker %s crashed", os.getpid())
+        finally:
+            logging.shutdown()
+            # never return into the arbiter's code
+            os._exit(status)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            if code:
+                logger.warning("Worker %s exited with status %s", pid, code)
+                if time.time() - started < 1:
+                    # crashing at startup, do not fork in a tight loop
+                    self.backoff_until = time.time() + 1
+
+    def retire(self, pids):
+        """Ask workers to finish their requests and exit, without replacing them."""
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.retiring.discard(pid)
+
+    def reload(self):
+        """Re-execute the arbiter with the current code, the workers keep serving until the new ones are up."""
+        check = subprocess.run([sys.executable, "-c", APP_CHECK], env=os.environ)
+        if check.returncode:
+            logger.error("Not reloading: the application fails to load")
+            return
+        logger.info("Reloading")
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.socket.fileno())
+        env[OLD_WORKERS_ENV] = ",".join(str(pid) for pid in sorted(set(self.workers) | self.retiring))
+        self.socket.set_inheritable(True)
+        signal.set_wakeup_fd(-1)
+        logging.shutdown()
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+    def stop(self):
+        self.retire(list(self.workers))
+        deadline = time.time() + self.graceful_timeout
+        while self.retiring and time.time() < deadline:
+            self.wait_signals(0.1)
+            self.reap()
+        for pid in self.retiring:
+            logger.warning("Killing worker %s", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.socket.close()
+        return 0
@@ -0,0 +1,34 @@
+import logging
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_EXPLAINED_STATEMENTS = ("SELECT", "UPDATE", "DELETE")
+
+
+def explain(cursor, statement, parameters=()):
+    """Return the detail column of EXPLAIN QUERY PLAN for a statement."""
+    cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def full_scans(plan):
+    # "SCAN picture" is a full table scan, "SCAN picture USING INDEX ..." is not
+    return [detail for detail in plan if detail.startswith("SCAN ") and " USING " not in detail]
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _explain_query(conn, cursor, statement, parameters, context, executemany):
+    if executemany or not has_app_context() or not current_app.config.get("EXPLAIN_QUERIES"):
+        return
+    if conn.dialect.name != "sqlite" or not statement.lstrip().upper().startswith(_EXPLAINED_STATEMENTS):
+        return
+
+    # use a separate cursor so the one about to run the statement is untouched
+    plan = explain(conn.connection.cursor(), statement, parameters)
+    logger.debug("Query plan for %s: %s", statement, plan)
+    scans = full_scans(plan)
+    if scans:
+        logger.warning("Full table scan (%s) in query: %s", "; ".join(scans), statement)
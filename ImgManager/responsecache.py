@@ -0,0 +1,263 @@
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from flask import current_app, json, make_response, request
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+from ImgManager import db
+from ImgManager.models import CacheGeneration
+from ImgManager.metrics import Sampled, registry
+
+# tables whose changes invalidate cached responses
+TRACKED_TABLES = {"person", "album", "picture", "picture_metadata"}
+
+
+@event.listens_for(Engine, "after_execute")
+def _track_writes(conn, clauseelement, multiparams, params, result):
+    if isinstance(clauseelement, UpdateBase) and clauseelement.table.name in TRACKED_TABLES:
+        conn.info.setdefault("touched_tables", set()).add(clauseelement.table.name)
+
+
+@event.listens_for(Engine, "commit")
+def _bump_generations(conn):
+    touched = conn.info.pop("touched_tables", None)
+    if not touched:
+        return
+    # on the DBAPI cursor, so it runs in the transaction about to be committed
+    # without going through the engine events again
+    cursor = conn.connection.cursor()
+    try:
+        for name in sorted(touched):
+            cursor.execute("INSERT OR IGNORE INTO cache_generation (name, value) VALUES (?, 0)", (name,))
+            cursor.execute("UPDATE cache_generation SET value = value + 1 WHERE name = ?", (name,))
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, "rollback")
+def _forget_writes(conn):
+    conn.info.pop("touched_tables", None)
+
+
+def generations(tables):
+    """The current generation of each table, committed writes only."""
+    values = dict(db.session.execute(select([CacheGeneration.name, CacheGeneration.value])
+                                     .where(CacheGeneration.name.in_(sorted(tables)))).fetchall())
+    return [(name, values.get(name, 0)) for name in sorted(tables)]
+
+
+def bump_generation(name):
+    """Count a change that the engine events do not see, in the current transaction."""
+    db.session.execute("INSERT OR IGNORE INTO cache_generation (name, value) VALUES (:name, 0)", {"name": name})
+    db.session.execute("UPDATE cache_generation SET value = value + 1 WHERE name = :name", {"name": name})
+
+
+class DiskTier(object):
+    """Cached bodies as files in a folder, evicted least recently written first."""
+
+    def __init__(self, folder, budget):
+        self.folder = folder
+        self.budget = budget
+        self.total = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.folder, key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        header, _, body = data.partition(b"\n")
+        status, mimetype = header.decode("ascii").split(" ", 1)
+        return int(status), mimetype, body
+
+    def put(self, key, status, mimetype, body):
+        os.makedirs(self.folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".write-")
+        with os.fdopen(fd, "wb") as f:
+            f.write("{} {}\n".format(status, mimetype).encode("ascii"))
+            f.write(body)
+        os.replace(tmp_path, os.path.join(self.folder, key))
+
+        with self.lock:
+            if self.total is None:
+                self.total = sum(entry[1] for entry in self._scan())
+            else:
+                self.total += len(body)
+            if self.total > self.budget:
+                self._evict(self.budget * 9 // 10)
+
+    def _scan(self):
+        return [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                for entry in os.scandir(self.folder) if entry.is_file() and not entry.name.startswith(".")]
+
+    def _evict(self, target):
+        entries = sorted(self._scan())
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.total = total
+
+
+class ResponseCache(object):
+    """Serialized responses keyed by route, arguments and table generations.
+
+    A write committed to a table bumps its generation, so the keys of the
+    responses depending on it change and the old entries are never read
+    again: they age out of the LRU. The key doubles as the ETag.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.disk = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def _disk_tier(self):
+        folder = current_app.config.get("RESPONSE_CACHE_FOLDER")
+        if not folder:
+            return None
+        if self.disk is None or self.disk.folder != folder:
+            self.disk = DiskTier(folder, current_app.config.get("RESPONSE_CACHE_DISK_BYTES", 256 * 1024 * 1024))
+        return self.disk
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        disk = self._disk_tier()
+        entry = disk.get(key) if disk is not None else None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, status, mimetype, body, disk=None):
+        entry = (status, mimetype, body)
+        self._remember(key, entry)
+        if disk is not None:
+            disk.put(key, status, mimetype, body)
+
+    def _remember(self, key, entry, budget=None):
+        budget = current_app.config.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024) if budget is None else budget
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.size += len(entry[2])
+            while self.size > budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+                self.evictions += 1
+
+    def tee(self, key, status, mimetype, chunks, max_body, budget, disk):
+        """Pass a streamed body through, keeping it if it ends under max_body bytes."""
+        kept = []
+        length = 0
+        for chunk in chunks:
+            yield chunk
+            if kept is not None:
+                data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                length += len(data)
+                if length <= max_body:
+                    kept.append(data)
+                else:
+                    kept = None
+        if kept is not None:
+            body = b"".join(kept)
+            self._remember(key, (status, mimetype, body), budget)
+            if disk is not None:
+                disk.put(key, status, mimetype, body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"size": len(self.entries), "bytes": self.size, "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "not_modified": self.not_modified, "evictions": self.evictions,
+                    "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+
+response_cache = ResponseCache()
+for _stat in ("hits", "disk_hits", "misses", "not_modified", "evictions"):
+    registry.add(Sampled("imgmanager_response_cache_{}_total".format(_stat), "Response cache {}.".format(_stat.replace("_", " ")),
+                         lambda stat=_stat: response_cache.stats()[stat], "counter"))
+
+
+def cache_key(view, kwargs, tables):
+    parts = [view, sorted(kwargs.items()), sorted(request.args.items(multi=True)), generations(tables)]
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def cached(*tables):
+    """Serve a read endpoint from the response cache.
+
+    tables are the ones its response is computed from. Only 200 JSON
+    responses are kept, others (404s, picture variants...) go through as
+    they are. Responses get an ETag and clients are asked to revalidate.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            config = current_app.config
+            if not config.get("RESPONSE_CACHE_ENABLED", True):
+                return view(*args, **kwargs)
+
+            key = cache_key(view.__name__, kwargs, tables)
+            if key in request.if_none_match:
+                with response_cache.lock:
+                    response_cache.not_modified += 1
+                return _finish(current_app.response_class(status=304), key)
+
+            entry = response_cache.get(key)
+            if entry is not None:
+                status, mimetype, body = entry
+                return _finish(current_app.response_class(body, status=status, mimetype=mimetype), key)
+
+            rv = make_response(view(*args, **kwargs))
+            if rv.status_code != 200 or rv.mimetype != config["JSONIFY_MIMETYPE"]:
+                return rv
+            max_body = config.get("RESPONSE_CACHE_MAX_BODY", 1024 * 1024)
+            disk = response_cache._disk_tier()
+            if rv.is_streamed:
+                # the tee finishes after the request, when the stream is consumed
+                rv.response = response_cache.tee(key, rv.status_code, rv.mimetype, rv.response, max_body,
+                                                 config.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024), disk)
+            else:
+                body = rv.get_data()
+                if len(body) <= max_body:
+                    response_cache.put(key, rv.status_code, rv.mimetype, body, disk)
+            return _finish(rv, key)
+        return wrapper
+    return decorator
+
+
+def _finish(rv, key):
+    rv.set_etag(key)
+    rv.headers["Cache-Control"] = "no-cache"
+    return rv
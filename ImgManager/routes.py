@@ -1,32 +1,65 @@
-from flask_sqlalchemy import SQLAlchemy
 import sqlalchemy
-import secrets
 import os
-from PIL import Image
-from flask import jsonify, make_response, request
-from ImgManager import app, db, bcrypt
-from ImgManager.models import row2dict, Person, Album, Picture
+from flask import Blueprint, Response, current_app, jsonify, make_response, request
+from ImgManager import db
+from ImgManager.models import row2dict, Person, Album, Picture, PictureMetadata
+from ImgManager.listing import ListingError, list_response
+from ImgManager.hashing import HashingBusy, generate_password_hash, check_password_hash, needs_rehash
+from ImgManager.usercache import user_cache
+from ImgManager.responsecache import cached, response_cache
+from ImgManager.metrics import registry
+from ImgManager.database import is_locked, retry_locked
+from ImgManager import fulltext, metadata, storage
+from ImgManager.uploads import sniff_image
+from ImgManager.serving import send_picture, send_picture_file
+from ImgManager.backends import get_backend
+from ImgManager.derivatives import FORMATS, derivative_cache, source_key
+from ImgManager.similarity import similarity_index
+from ImgManager.jobs import enqueue
+from ImgManager.batch import BatchIngest, ZIP_TYPES, TAR_TYPES
+from ImgManager.archives import ArchiveError, iter_zip, iter_tar
+from ImgManager.export import album_entries, archive_response, layout_etag, tar_layout, zip_layout
 from flask_login import login_user, current_user, logout_user, login_required
 
+api = Blueprint("api", __name__)
 
-@app.errorhandler(404)
+
+@api.app_errorhandler(404)
 def page_not_found(e):
     return make_response(jsonify({"code": 404, "msg": "404: Not Found"}), 404)
 
 
-@app.route('/')
+def busy_response():
+    return make_response(jsonify({"code": 503, "msg": "Server busy, please retry."}), 503, {"Retry-After": "1"})
+
+
+@api.app_errorhandler(sqlalchemy.exc.OperationalError)
+def database_error(e):
+    # still locked after retry_locked gave up, or a route without it
+    if is_locked(e):
+        return busy_response()
+    raise e
+
+
+@api.app_errorhandler(413)
+def too_large(e):
+    return make_response(jsonify({"code": 413, "msg": e.description}), 413)
+
+
+@api.route('/')
 def soen487_a1():
     return jsonify({"title": "SOEN487 Assignment 1",
                     "student": {"id": "40035704", "name": "Joel Dusablon Senécal"}})
 
 
-@app.route("/person")
+@api.route("/person")
+@cached("person")
 def get_all_person():
-    person_list = Person.query.all()
-    return jsonify([row2dict(person) for person in person_list])
+    return list_response(Person)
 
 
-@app.route("/person/<person_id>")
+@api.route("/person/<person_id>")
+@cached("person")
 def get_person(person_id):
     # id is a primary key, so we'll have max 1 result row
     person = Person.query.filter_by(id=person_id).first()
@@ -36,7 +69,8 @@ def get_person(person_id):
         return make_response(jsonify({"code": 404, "msg": "Cannot find this person id."}), 404)
 
 
-@app.route("/register", methods=['GET', 'POST'])
+@api.route("/register", methods=['GET', 'POST'])
+@retry_locked
 def register():
     if current_user.is_authenticated:
         return make_response(jsonify({"code": 403, "msg": "You are logged in please log out to register"}), 403)
@@ -53,15 +87,20 @@ def register():
         return make_response(jsonify({"code": 403, "msg": "Cannot put person. Name is already taken."}), 403)
 
     # if valid, add to db
-    hpw = bcrypt.generate_password_hash(pw).decode('utf-8')
+    try:
+        hpw = generate_password_hash(pw)
+    except HashingBusy:
+        return busy_response()
     user = Person(name=name, password=hpw)
     db.session.add(user)
     db.session.commit()
+    # the id may belong to a deleted person whose record is still cached
+    user_cache.invalidate(user.id)
 
     return jsonify({"code": 200, "msg": "success"})
 
 
-@app.route("/login", methods=['GET', 'POST'])
+@api.route("/login", methods=['GET', 'POST'])
 def login():
     # checking if already logged in
     if current_user.is_authenticated:
@@ -81,7 +120,25 @@ def login():
         return make_response(jsonify({"code": 403, "msg": "Cannot login, invalid account"}), 403)
 
     # password and username combination check
-    if user and bcrypt.check_password_hash(user.password, pw):
+    try:
+        valid = check_password_hash(user.password, pw)
+    except HashingBusy:
+        return busy_response()
+
+    if user and valid:
+        # upgrade hashes made with another cost while we have the plain password
+        if needs_rehash(user.password):
+            try:
+                user.password = generate_password_hash(pw)
+                db.session.commit()
+            except HashingBusy:
+                pass
+            except sqlalchemy.exc.OperationalError as e:
+                # the old hash still works, the rehash waits for a later login
+                if not is_locked(e):
+                    raise
+                db.session.rollback()
+
         user.id = str(getattr(user, 'id'))
         login_user(user)
         return jsonify({"code": 200, "msg": "success"})
@@ -90,20 +147,32 @@ def login():
         return make_response(jsonify({"code": 403, "msg": "Cannot login, invalid password"}), 403)
 
 
-@app.route("/logout", methods=['GET', 'POST'])
+@api.route("/logout", methods=['GET', 'POST'])
 @login_required
 def logout():
     logout_user()
     return jsonify({"code": 200, "msg": "success"})
 
 
-@app.route("/album",  methods={'GET'})
+@api.route("/cache/stats", methods={'GET'})
+def cache_stats():
+    return jsonify({"user": user_cache.stats(), "response": response_cache.stats()})
+
+
+@api.route("/metrics", methods={'GET'})
+def metrics():
+    # Prometheus text exposition format
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@api.route("/album",  methods={'GET'})
+@cached("album")
 def get_all_album():
-    album_list = Album.query.all()
-    return jsonify([row2dict(album) for album in album_list])
+    return list_response(Album)
 
 
-@app.route("/album/<album_id>", methods={'GET'})
+@api.route("/album/<album_id>", methods={'GET'})
+@cached("album")
 def get_album(album_id):
     # id is a primary key, so we'll have max 1 result row
     album = Album.query.filter_by(id=album_id).first()
@@ -113,24 +182,117 @@ def get_album(album_id):
         return make_response(jsonify({"code": 404, "msg": "Cannot find this album id."}), 404)
 
 
-@app.route("/pictures", methods={'GET'})
+@api.route("/album/<album_id>/export", methods={'GET'})
+def export_album(album_id):
+    album = Album.query.filter_by(id=album_id).first()
+    if not album:
+        return make_response(jsonify({"code": 404, "msg": "Cannot find this album id."}), 404)
+
+    fmt = request.args.get("format", "zip")
+    if fmt not in ("zip", "tar"):
+        return make_response(jsonify({"code": 400, "msg": "format must be zip or tar."}), 400)
+
+    # the archive is planned from the rows and file sizes, then streamed without a temp file
+    entries, crcs = album_entries(album)
+    if fmt == "zip":
+        layout = zip_layout(entries, get_backend().open, crcs)
+    else:
+        layout = tar_layout(entries, get_backend().open)
+    mimetype = "application/zip" if fmt == "zip" else "application/x-tar"
+    return archive_response(layout, layout_etag(entries) + "-" + fmt, "album-{}.{}".format(album.id, fmt), mimetype)
+
+
+@api.route("/pictures", methods={'GET'})
+@cached("picture")
 def get_all_pictures():
-    picture_list = Picture.query.all()
-    return jsonify([row2dict(picture) for picture in picture_list])
+    return list_response(Picture)
+
 
+@api.route("/search", methods={'GET'})
+@cached("picture", "album")
+def search_names():
+    try:
+        data, next_cursor = fulltext.search(request.args)
+    except ListingError as e:
+        return make_response(jsonify({"code": 400, "msg": str(e)}), 400)
+    return jsonify({"data": data, "next": next_cursor})
 
-@app.route("/picture/<picture_id>", methods={'GET'})
+
+@api.route("/pictures/search", methods={'GET'})
+@cached("picture", "picture_metadata")
+def search_pictures():
+    try:
+        data, next_cursor = metadata.search(request.args)
+    except ListingError as e:
+        return make_response(jsonify({"code": 400, "msg": str(e)}), 400)
+    return jsonify({"data": data, "next": next_cursor})
+
+
+@api.route("/picture/<picture_id>", methods={'GET'})
+@cached("picture")
 def get_picture(picture_id):
     # id is a primary key, so we'll have max 1 result row
     picture = Picture.query.filter_by(id=picture_id).first()
-    if picture:
-        return jsonify(row2dict(picture))
-    else:
+    if not picture:
         return make_response(jsonify({"code": 404, "msg": "Cannot find this picture id."}), 404)
 
+    # ?w= and/or ?fmt= ask for a resized variant instead of the metadata
+    if "w" in request.args or "fmt" in request.args:
+        return get_picture_variant(picture)
+    return jsonify(row2dict(picture))
+
+
+def get_picture_variant(picture):
+    fmt = request.args.get("fmt", "jpeg")
+    try:
+        width = int(request.args.get("w", current_app.config["DERIVATIVE_MAX_WIDTH"]))
+    except ValueError:
+        width = 0
+    if fmt not in FORMATS or not 0 < width <= current_app.config["DERIVATIVE_MAX_WIDTH"]:
+        return make_response(jsonify({"code": 400, "msg": "Invalid size or format."}), 400)
+    if not get_backend().exists(picture.path):
+        return make_response(jsonify({"code": 404, "msg": "Cannot find this picture id."}), 404)
 
-@app.route("/createAlbum", methods={'POST'})
+    path = derivative_cache.get(picture.path, source_key(picture), width, fmt)
+    # the cache touches its files, so the mtime can't be the validator
+    etag = os.path.splitext(os.path.basename(path))[0]
+    return send_picture_file(path, etag=etag, immutable=picture.digest is not None)
+
+
+@api.route("/picture/<picture_id>/raw", methods={'GET'})
+def get_picture_raw(picture_id):
+    picture = Picture.query.filter_by(id=picture_id).first()
+    if not picture or not get_backend().exists(picture.path):
+        return make_response(jsonify({"code": 404, "msg": "Cannot find this picture id."}), 404)
+
+    # content-addressed files never change, older ones fall back to mtime and size
+    return send_picture(picture.path, etag=picture.digest, immutable=picture.digest is not None)
+
+
+@api.route("/picture/<picture_id>/similar", methods={'GET'})
+@cached("picture")
+def get_similar_pictures(picture_id):
+    picture = Picture.query.filter_by(id=picture_id).first()
+    if not picture:
+        return make_response(jsonify({"code": 404, "msg": "Cannot find this picture id."}), 404)
+    if picture.dhash is None:
+        return make_response(jsonify({"code": 404, "msg": "This picture is not hashed yet."}), 404)
+
+    try:
+        maxdist = int(request.args.get("maxdist", 6))
+        limit = int(request.args.get("limit", current_app.config["MAX_PAGE_SIZE"]))
+    except ValueError:
+        maxdist = limit = -1
+    if not 0 <= maxdist <= current_app.config["SIMILAR_MAX_DISTANCE"] or limit < 1:
+        return make_response(jsonify({"code": 400, "msg": "Invalid maxdist or limit."}), 400)
+
+    found = similarity_index.similar(picture, maxdist, min(limit, current_app.config["MAX_PAGE_SIZE"]))
+    return jsonify({"data": [dict(row2dict(row), distance=d) for d, row in found]})
+
+
+@api.route("/createAlbum", methods={'POST'})
 @login_required
+@retry_locked
 def create_new_album():
     # getting request info
     name = request.form.get("name")
@@ -150,12 +312,14 @@ def create_new_album():
     return jsonify({"code": 200, "msg": "success"})
 
 
-@app.route("/Album/<album_id>/addPicture", methods=['POST', 'GET'])
+@api.route("/Album/<album_id>/addPicture", methods=['POST', 'GET'])
 @login_required
 def add_pic(album_id):
     # make sure its adding a pic to one of its own album
-    album_owner_id = Album.query.filter_by(id=album_id).first()
-    if album_owner_id.person_id is not current_user.id:
+    album = Album.query.filter_by(id=album_id).first()
+    if album is None:
+        return make_response(jsonify({"code": 404, "msg": "Cannot find this album id."}), 404)
+    if album.person_id != current_user.id:
         return make_response(jsonify({"code": 403, "msg": "Cannot add picture to albums you don't own"}), 403)
 
     form_picture = request.files['image']
@@ -164,31 +328,67 @@ def add_pic(album_id):
     if not name or not form_picture:
         return make_response(jsonify({"code": 403, "msg": "Invalid fields"}), 403)
 
-    # taken from Corey M. Schafer code snippets
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path + '\pictures', picture_fn)
-
-    # making sure the random hex hasn't already been produced
-    while os.path.exists(picture_path):
-        print("Creating new hex")
-        random_hex = secrets.token_hex(8)
-        _, f_ext = os.path.splitext(form_picture.filename)
-        picture_fn = random_hex + f_ext
-        picture_path = os.path.join(app.root_path + '\pictures', picture_fn)
-
-    # if valid save picture with a valid path
-    i = Image.open(form_picture)
-    i.save(picture_path)
-    new_pic = Picture(name=name, album_id=album_id, path=picture_path)
+    if form_picture.stream.too_large:
+        return make_response(jsonify({"code": 413, "msg": form_picture.stream.too_large}), 413)
+
+    # the upload was streamed to disk while parsing, we only look at its first bytes
+    f_ext = sniff_image(form_picture.stream.header)
+    if not f_ext:
+        return make_response(jsonify({"code": 403, "msg": "Unsupported image format"}), 403)
+
+    # store by content, identical uploads end up sharing one file
+    blob = form_picture.stream.pending(f_ext)
+    # the header is all we need, read before the transaction takes the write lock
+    header = metadata.read_metadata(blob.tmp_path)
+    new_pic = Picture(name=name, album_id=album_id, path=blob.key, digest=blob.digest, crc32=blob.crc32,
+                      status='pending')
     db.session.add(new_pic)
-    db.session.commit()
+    try:
+        # the rest of the processing is done by the job workers
+        db.session.flush()
+        db.session.add(PictureMetadata(picture_id=new_pic.id, size=blob.size, **header))
+        enqueue('picture.process', picture_id=new_pic.id)
+        db.session.commit()
+    except Exception:
+        blob.discard()
+        raise
+    blob.commit()
 
     return jsonify({"code": 200, "msg": "success"})
 
 
-@app.route("/picture/<pic_id>", methods={'GET'})
+@api.route("/Album/<album_id>/addPictures", methods=['POST'])
+@login_required
+def add_pics(album_id):
+    album = Album.query.filter_by(id=album_id).first()
+    if album is None:
+        return make_response(jsonify({"code": 404, "msg": "Cannot find this album id."}), 404)
+    if album.person_id != current_user.id:
+        return make_response(jsonify({"code": 403, "msg": "Cannot add picture to albums you don't own"}), 403)
+
+    # either many 'images' parts of a multipart form, or a zip/tar archive as the body
+    ingest = BatchIngest(album.id)
+    try:
+        if request.mimetype in ZIP_TYPES:
+            for filename, reader in iter_zip(request.stream):
+                ingest.add_stream(filename, reader)
+        elif request.mimetype in TAR_TYPES:
+            for filename, reader in iter_tar(request.stream):
+                ingest.add_stream(filename, reader)
+        else:
+            for upload in request.files.getlist('images'):
+                ingest.add_upload(upload)
+    except ArchiveError as e:
+        # what was read before the error is kept
+        return make_response(jsonify({"code": 400, "msg": str(e), "results": ingest.finish()}), 400)
+    except Exception:
+        ingest.abort()
+        raise
+
+    return jsonify({"code": 200, "msg": "success", "results": ingest.finish()})
+
+
+@api.route("/picture/<pic_id>", methods={'GET'})
 def show_one_pic(pic_id):
     picture = Picture.query.filter_by(id=pic_id).first()
     if picture:
@@ -197,19 +397,20 @@ def show_one_pic(pic_id):
         return make_response(jsonify({"code": 404, "msg": "Cannot find this person id."}), 404)
 
 
-@app.route("/picture/Album/<album_id>", methods={'GET'})
+@api.route("/picture/Album/<album_id>", methods={'GET'})
+@cached("album", "picture")
 def get_pic_by_album(album_id):
     album = Album.query.filter_by(id=album_id).first()
-    pictures = Picture.query.filter_by(album_id=album_id)
 
-    if not pictures or not album:
+    if not album:
         return make_response(jsonify({"code": 404, "msg": "Cannot find this person id."}), 404)
     else:
-        return jsonify([row2dict(picture) for picture in pictures])
+        return list_response(Picture, Picture.query.filter_by(album_id=album_id))
 
 
-@app.route("/deletePic/<pic_id>", methods={'GET'})
+@api.route("/deletePic/<pic_id>", methods={'GET'})
 @login_required
+@retry_locked
 def delete_pic(pic_id):
     target_pic = Picture.query.filter_by(id=pic_id).first()
 
@@ -225,19 +426,17 @@ def delete_pic(pic_id):
     if not target_pic_album.person_id == current_user.id:
         return make_response(jsonify({"code": 404, "msg": "Cannot find this person id."}), 404)
 
-    if os.path.exists(target_pic.path):
-        try:
-            os.remove(target_pic.path)
-        except OSError:
-            pass
-
+    # the reaper unlinks the file once no other picture shares it
+    storage.bury(Picture.id == target_pic.id)
+    metadata.forget(Picture.id == target_pic.id)
     db.session.delete(target_pic)
     db.session.commit()
     return jsonify({"code": 200, "msg": "success"})
 
 
-@app.route("/deleteAlbum/<album_id>", methods={'POST'})
+@api.route("/deleteAlbum/<album_id>", methods={'POST'})
 @login_required
+@retry_locked
 def delete_alb(album_id):
     album = Album.query.filter_by(id=album_id).first()
 
@@ -247,18 +446,10 @@ def delete_alb(album_id):
     if not album.person_id == current_user.id:
         return make_response(jsonify({"code": 404, "msg": "Cannot comply."}), 404)
 
-    pictures = Picture.query.filter_by(album_id=album_id)
-
-    if pictures:
-        for picture in pictures:
-            print(picture.path)
-            if os.path.exists(picture.path):
-                try:
-                    os.remove(picture.path)
-                except OSError:
-                    pass
-            db.session.delete(picture)
-
+    # one set-based delete whatever the album size, files are left to the reaper
+    storage.bury(Picture.album_id == album.id)
+    metadata.forget(Picture.album_id == album.id)
+    Picture.query.filter_by(album_id=album.id).delete(synchronize_session=False)
     db.session.delete(album)
     db.session.commit()
     return jsonify({"code": 200, "msg": "success"})
@@ -0,0 +1,78 @@
+import sqlalchemy
+from sqlalchemy.schema import CreateColumn, CreateTable
+from ImgManager import db
+
+
+def _needs_autoincrement(bind, table):
+    if bind.dialect.name != "sqlite" or not table.dialect_options["sqlite"]["autoincrement"]:
+        return False
+    sql = bind.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)).scalar()
+    return "AUTOINCREMENT" not in sql.upper()
+
+
+def _rebuild(bind, table):
+    """Recreate a table from its model and copy its rows over, for what ALTER TABLE cannot change.
+
+    See https://sqlite.org/lang_altertable.html#otheralter. Its indexes and
+    triggers go with the old table, create_all adds them back.
+    """
+    metadata = sqlalchemy.MetaData()
+    # the tables its foreign keys point to, for the DDL to name them
+    for key in table.foreign_keys:
+        key.column.table.tometadata(metadata)
+    staging = table.tometadata(metadata, name=table.name + "_rebuild")
+    bind.execute(CreateTable(staging))
+    columns = ", ".join(bind.dialect.identifier_preparer.quote(column.name) for column in table.columns)
+    bind.execute("INSERT INTO {} ({}) SELECT {} FROM {}".format(staging.name, columns, columns, table.name))
+    bind.execute("DROP TABLE {}".format(table.name))
+    bind.execute("ALTER TABLE {} RENAME TO {}".format(staging.name, table.name))
+
+
+def upgrade_schema(bind):
+    """Bring an existing database up to date with the models.
+
+    create_all only creates missing tables, so databases made by an older
+    version of the app get their missing columns and indexes added here,
+    and tables that are now AUTOINCREMENT are rebuilt. Every step is
+    idempotent.
+    """
+    inspector = sqlalchemy.inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        present = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in present:
+                # sqlite can only add a NOT NULL column when it has a server default
+                ddl = CreateColumn(column).compile(dialect=bind.dialect)
+                bind.execute("ALTER TABLE {} ADD COLUMN {}".format(table.name, ddl))
+
+        if _needs_autoincrement(bind, table):
+            _rebuild(bind, table)
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind)
+
+
+def upgrade_database(app):
+    """create_all on the database of app, for `flask upgrade-db`, main.py and the --upgrade-db of the servers.
+
+    SQLite's write lock is held throughout, processes starting together
+    take turns instead of racing to create the same tables. Building an app
+    does not run it: importing the app stays free of database writes.
+    """
+    engine = db.get_engine(app)
+    with engine.begin() as connection:
+        if engine.dialect.name == "sqlite":
+            connection.execute("BEGIN IMMEDIATE")
+        db.metadata.create_all(connection)
+
+
+@sqlalchemy.event.listens_for(db.metadata, "after_create")
+def _upgrade_after_create(target, connection, **kw):
+    # runs on every create_all, so existing sqlite files are upgraded in place
+    upgrade_schema(connection)
@@ -0,0 +1,89 @@
+from flask import current_app, json, jsonify, stream_with_context
+from ImgManager import db
+from ImgManager.models import public_columns
+
+
+def _dumps_options():
+    """The indent and separators jsonify renders with, read from its own output.
+
+    They changed across Flask versions and follow the app's JSON settings,
+    reading them back keeps the streamed body byte for byte what jsonify gives.
+    """
+    sample = jsonify({"a": 0, "b": 0}).get_data(as_text=True)
+    key_separator = sample[sample.index('"a"') + 3:sample.index("0")]
+    between = sample[sample.index("0") + 1:sample.index('"b"')]
+    if "\n" in between:
+        item_separator, _, indent = between.partition("\n")
+        return {"indent": indent, "separators": (item_separator, key_separator)}
+    return {"indent": None, "separators": (between, key_separator)}
+
+
+def _list_framing(options):
+    """Return the (opening, separator, closing) strings dumps puts around list items."""
+    sample = json.dumps([0, 0], **options)
+    first = sample.index("0")
+    second = sample.index("0", first + 1)
+    return sample[:first], sample[first + 1:second], sample[second + 1:]
+
+
+def iter_json_list(items, chunk_size=None):
+    """Serialize an iterable of dicts as a JSON array, one chunk at a time.
+
+    Items are rendered one by one and buffered up to chunk_size characters, so
+    memory stays flat however many items there are.
+    """
+    if chunk_size is None:
+        chunk_size = current_app.config.get("STREAM_CHUNK_SIZE", 64 * 1024)
+    options = _dumps_options()
+    opening, separator, closing = _list_framing(options)
+
+    items = iter(items)
+    first = next(items, None)
+    if first is None:
+        yield json.dumps([], **options) + "\n"
+        return
+
+    buffer = [opening]
+    size = len(opening)
+    item = first
+    while True:
+        text = json.dumps([item], **options)[len(opening):-len(closing)]
+        buffer.append(text)
+        size += len(text)
+        item = next(items, None)
+        if item is None:
+            break
+        buffer.append(separator)
+        size += len(separator)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(closing + "\n")
+    yield "".join(buffer)
+
+
+def iter_rows(model, query=None, batch_size=None):
+    """Yield row2dict-like dicts for a model, reading rows in batches.
+
+    Only the public columns are selected, as plain tuples, so no ORM instance
+    is built per row.
+    """
+    if batch_size is None:
+        batch_size = current_app.config.get("STREAM_BATCH_SIZE", 1000)
+    columns = public_columns(model)
+    names = [c.name for c in columns]
+    if query is None:
+        query = db.session.query(*columns)
+    else:
+        query = query.with_entities(*columns)
+
+    for row in query.order_by(model.__table__.c.id).yield_per(batch_size):
+        yield {name: str(value) for name, value in zip(names, row)}
+
+
+def stream_rows(model, query=None):
+    """Streamed equivalent of jsonify([row2dict(row) for row in query])."""
+    body = iter_json_list(iter_rows(model, query))
+    return current_app.response_class(stream_with_context(body),
+                                      mimetype=current_app.config["JSONIFY_MIMETYPE"])
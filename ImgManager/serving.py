@@ -0,0 +1,70 @@
+import mimetypes
+import os
+from flask import current_app, request
+from werkzeug.wsgi import wrap_file
+from ImgManager.backends import get_backend
+
+
+def send_picture_file(path, etag=None, immutable=False):
+    """Send a stored file with conditional and range request support.
+
+    The body is never read by Python: it is either handed to the WSGI server
+    as a file wrapper (which may use sendfile) or left to the front proxy with
+    X-Sendfile / X-Accel-Redirect. Content-addressed files pass their digest as
+    a strong ETag and immutable=True for a long lived Cache-Control.
+    """
+    config = current_app.config
+    stat = os.stat(path)
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    offloaded = True
+    headers = {}
+    key = os.path.relpath(path, config["PICTURE_FOLDER"]).replace(os.sep, "/")
+    # the proxy location only maps the picture folder
+    if config.get("X_ACCEL_REDIRECT_PREFIX") and not key.startswith("../"):
+        headers["X-Accel-Redirect"] = config["X_ACCEL_REDIRECT_PREFIX"].rstrip("/") + "/" + key
+        data = None
+    elif config.get("USE_X_SENDFILE"):
+        headers["X-Sendfile"] = path
+        data = None
+    else:
+        offloaded = False
+        data = wrap_file(request.environ, open(path, "rb"))
+
+    rv = current_app.response_class(data, mimetype=mimetype, headers=headers, direct_passthrough=True)
+    return _conditional(rv, stat.st_size, stat.st_mtime, etag, immutable, offloaded)
+
+
+def send_picture(key, etag=None, immutable=False):
+    """Send a picture from the storage backend, see send_picture_file.
+
+    Backends without local files are streamed from their file object, which
+    range requests seek into.
+    """
+    backend = get_backend()
+    path = backend.local_path(key)
+    if path is not None:
+        return send_picture_file(path, etag=etag, immutable=immutable)
+
+    size, mtime = backend.stat(key)
+    mimetype = mimetypes.guess_type(key)[0] or "application/octet-stream"
+    data = wrap_file(request.environ, backend.open(key))
+    rv = current_app.response_class(data, mimetype=mimetype, direct_passthrough=True)
+    return _conditional(rv, size, mtime, etag, immutable, False)
+
+
+def _conditional(rv, size, mtime, etag, immutable, offloaded):
+    config = current_app.config
+    rv.content_length = size
+    rv.last_modified = int(mtime)
+    rv.set_etag(etag or "{:x}-{:x}".format(int(mtime), size))
+
+    if immutable:
+        rv.headers["Cache-Control"] = "public, max-age={}, immutable".format(config.get("PICTURE_CACHE_MAX_AGE", 31536000))
+    else:
+        rv.headers["Cache-Control"] = "public, no-cache"
+
+    # ranges of offloaded files are served by the proxy
+    if offloaded:
+        return rv.make_conditional(request)
+    return rv.make_conditional(request, accept_ranges=True, complete_length=size)
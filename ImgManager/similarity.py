@@ -0,0 +1,289 @@
+import functools
+import threading
+from flask import current_app
+from sqlalchemy import bindparam, event, func
+from sqlalchemy.orm import object_session
+from ImgManager import db
+from ImgManager.models import Picture
+from ImgManager.backends import get_backend
+from ImgManager.metrics import Sampled, registry, timed
+from ImgManager.responsecache import bump_generation, generations
+from ImgManager.storage import KEY_PATTERN, legacy_file
+
+# bumped by backfill(), which rewrites the hashes of existing rows
+BACKFILL_GENERATION = "picture_dhash"
+_CHUNKS = 4
+_CHUNK_BITS = 16
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+
+def dhash(img):
+    """64-bit difference hash of a Pillow image.
+
+    Each bit tells whether a pixel of a 9x8 grayscale thumbnail is brighter
+    than its right neighbour, which survives resizing and recompression.
+    """
+    from PIL import Image
+    # JPEG sources are decoded straight at 1/8 scale
+    img.draft("L", (64, 64))
+    pixels = img.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def file_dhash(path):
+    from PIL import Image
+    with timed("pillow"), Image.open(path) as img:
+        return dhash(img)
+
+
+def to_db(value):
+    # SQLite integers are signed
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def from_db(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+# int.bit_count is Python 3.10+
+_popcount = getattr(int, "bit_count", None) or (lambda value: bin(value).count("1"))
+
+
+def distance(a, b):
+    return _popcount(a ^ b)
+
+
+@functools.lru_cache(maxsize=None)
+def _flips(radius):
+    """Every chunk value with at most radius bits set, the chunk values within radius are chunk ^ flip."""
+    return tuple(value for value in range(1 << _CHUNK_BITS) if bin(value).count("1") <= radius)
+
+
+def _chunks(value):
+    return [(value >> (i * _CHUNK_BITS)) & _CHUNK_MASK for i in range(_CHUNKS)]
+
+
+class MultiIndexHash(object):
+    """Hashes by id, searchable by Hamming distance.
+
+    Multi-index hashing: hashes are split in 4 chunks of 16 bits, each with a
+    table of the ids by chunk value. Two hashes at most d bits apart differ
+    by at most d // 4 bits in one of their chunks, so a search looks up the
+    chunk values within that radius in each table and only computes the
+    full distance of the ids found there.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.tables = [{} for _ in range(_CHUNKS)]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, picture_id, value):
+        with self.lock:
+            self._remove(picture_id)
+            self.hashes[picture_id] = value
+            for table, chunk in zip(self.tables, _chunks(value)):
+                table.setdefault(chunk, set()).add(picture_id)
+
+    def remove(self, picture_id):
+        with self.lock:
+            self._remove(picture_id)
+
+    def _remove(self, picture_id):
+        value = self.hashes.pop(picture_id, None)
+        if value is None:
+            return
+        for table, chunk in zip(self.tables, _chunks(value)):
+            bucket = table[chunk]
+            bucket.discard(picture_id)
+            if not bucket:
+                del table[chunk]
+
+    def get(self, picture_id):
+        return self.hashes.get(picture_id)
+
+    def search(self, value, maxdist):
+        """Sorted (distance, id) of the hashes at most maxdist bits from value."""
+        flips = _flips(maxdist // _CHUNKS)
+        hashes = self.hashes
+        seen = set()
+        found = []
+        with self.lock:
+            for table, chunk in zip(self.tables, _chunks(value)):
+                for flip in flips:
+                    for picture_id in table.get(chunk ^ flip, ()):
+                        if picture_id not in seen:
+                            seen.add(picture_id)
+                            d = _popcount(value ^ hashes[picture_id])
+                            if d <= maxdist:
+                                found.append((d, picture_id))
+        return sorted(found)
+
+
+class SimilarityIndex(object):
+    """The dhash of every picture, kept in memory by each process.
+
+    Pictures are hashed by the job workers, possibly in another process, so
+    the index catches up from the database whenever the picture table
+    changed: rows past the highest id it has seen are read, which covers
+    every new row since ids are never reused, and the rows that were still
+    pending are read again by id, so one stuck in pending costs one lookup
+    instead of a rescan. Pictures deleted here leave the
+    index on commit, and results are checked against the rows anyway,
+    which drops the ones deleted elsewhere.
+    """
+
+    def __init__(self):
+        self.hashes = MultiIndexHash()
+        self.watermark = 0
+        self.pending = set()
+        self.generations = None
+        self.lock = threading.Lock()
+
+    def sync(self):
+        current = dict(generations(["picture", BACKFILL_GENERATION]))
+        with self.lock:
+            if self.generations == current:
+                return
+            if self.generations is None or self.generations[BACKFILL_GENERATION] != current[BACKFILL_GENERATION]:
+                self.hashes = MultiIndexHash()
+                self.watermark = 0
+                self.pending = set()
+            # picture ids are not reused (AUTOINCREMENT), they only go back
+            # when the table is emptied and its sequence reset
+            self.watermark = min(self.watermark, db.session.query(func.max(Picture.id)).scalar() or 0)
+            self._load()
+            self.generations = current
+
+    def _load(self):
+        batch_size = current_app.config.get("STREAM_BATCH_SIZE", 1000)
+        columns = (Picture.id, Picture.dhash, Picture.status)
+        waiting = sorted(picture_id for picture_id in self.pending if picture_id <= self.watermark)
+        for start in range(0, len(waiting), batch_size):
+            ids = waiting[start:start + batch_size]
+            # the ones not found were deleted
+            self.pending.difference_update(ids)
+            for row in db.session.query(*columns).filter(Picture.id.in_(ids)):
+                self._add(*row)
+
+        query = db.session.query(*columns).filter(Picture.id > self.watermark).order_by(Picture.id)
+        for row in query.yield_per(batch_size):
+            self._add(*row)
+            self.watermark = row[0]
+
+    def _add(self, picture_id, value, status):
+        if value is not None:
+            self.hashes.add(picture_id, from_db(value))
+            self.pending.discard(picture_id)
+        else:
+            self.hashes.remove(picture_id)
+            if status == 'pending':
+                self.pending.add(picture_id)
+            else:
+                self.pending.discard(picture_id)
+
+    def remove(self, picture_ids):
+        for picture_id in picture_ids:
+            self.hashes.remove(picture_id)
+
+    def similar(self, picture, maxdist, limit):
+        """(distance, Picture) of the other pictures within maxdist bits of picture, closest first."""
+        self.sync()
+        value = from_db(picture.dhash)
+        found = [(d, picture_id) for d, picture_id in self.hashes.search(value, maxdist)
+                 if picture_id != picture.id]
+        results = []
+        # rows are checked limit at a time, until limit of them are still there
+        for start in range(0, len(found), limit):
+            batch = found[start:start + limit]
+            rows = {row.id: row for row in Picture.query.filter(Picture.id.in_([picture_id for _, picture_id in batch]))}
+            for d, picture_id in batch:
+                row = rows.get(picture_id)
+                if row is None or row.dhash is None or from_db(row.dhash) != self.hashes.get(picture_id):
+                    # deleted, or its id reused, since the index saw it
+                    self.hashes.remove(picture_id)
+                    continue
+                results.append((d, row))
+                if len(results) == limit:
+                    return results
+        return results
+
+
+similarity_index = SimilarityIndex()
+registry.add(Sampled("imgmanager_similarity_index_size", "Picture hashes in the similarity index.",
+                     lambda: len(similarity_index.hashes)))
+
+
+@event.listens_for(Picture, "after_delete")
+def _forget_deleted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("deleted_pictures", set()).add(target.id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _apply_deletes(session):
+    similarity_index.remove(session.info.pop("deleted_pictures", ()))
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_deletes(session):
+    session.info.pop("deleted_pictures", None)
+
+
+def picture_file_dhash(picture):
+    """The dhash of a picture's file, None when the file cannot be found."""
+    if KEY_PATTERN.match(picture.path):
+        backend = get_backend()
+        if not backend.exists(picture.path):
+            return None
+        with backend.local_copy(picture.path) as path:
+            return file_dhash(path)
+    source = legacy_file(picture.path)
+    return file_dhash(source) if source is not None else None
+
+
+def backfill(batch_size=None):
+    """Hash the ready pictures that have no dhash yet, returns (hashed, missing) counts.
+
+    Rows are updated in batches of batch_size per transaction; files that
+    cannot be found or read are counted as missing and left unhashed.
+    """
+    if batch_size is None:
+        batch_size = current_app.config.get("REAPER_BATCH_SIZE", 500)
+    update = Picture.__table__.update().where(Picture.id == bindparam("picture_id")) \
+        .values(dhash=bindparam("value"))
+    hashed = missing = 0
+    last_id = 0
+    while True:
+        pictures = Picture.query.filter(Picture.id > last_id, Picture.dhash.is_(None), Picture.status == 'ready') \
+            .order_by(Picture.id).limit(batch_size).all()
+        if not pictures:
+            break
+        last_id = pictures[-1].id
+        rows = []
+        for picture in pictures:
+            try:
+                value = picture_file_dhash(picture)
+            except (OSError, SyntaxError, ValueError):
+                # unreadable or not an image after all
+                value = None
+            if value is None:
+                missing += 1
+            else:
+                rows.append({"picture_id": picture.id, "value": to_db(value)})
+        if rows:
+            db.session.execute(update, rows)
+        db.session.commit()
+        hashed += len(rows)
+    if hashed:
+        bump_generation(BACKFILL_GENERATION)
+        db.session.commit()
+    return hashed, missing
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+import zlib
+from flask import current_app
+from sqlalchemy import literal, select
+from ImgManager import db
+from ImgManager.models import Picture, Tombstone, Job
+from ImgManager.jobs import enqueue
+from ImgManager.backends import get_backend
+from ImgManager.database import begin_write
+
+# what Picture.path holds for content-addressed pictures
+KEY_PATTERN = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$")
+
+
+def picture_folder():
+    # local scratch space for uploads in progress
+    return current_app.config["PICTURE_FOLDER"]
+
+
+def blob_key(digest, ext):
+    # fan out on the first two bytes so no directory grows too large
+    return "{}/{}/{}{}".format(digest[:2], digest[2:4], digest, ext)
+
+
+class PendingBlob(object):
+    """An upload written to a temporary file, waiting to be put in the store.
+
+    The file is only stored under its content-addressed key by commit(),
+    which should be called once the Picture row referencing it is committed:
+    reap_tombstones and the storage scan delete objects that no row
+    references, so an object stored before its row could be taken for
+    garbage.
+    """
+
+    def __init__(self, tmp_path, digest, ext, size, crc32=None):
+        self.tmp_path = tmp_path
+        self.digest = digest
+        self.size = size
+        self.crc32 = crc32
+        self.key = blob_key(digest, ext)
+
+    def commit(self):
+        backend = get_backend()
+        if backend.exists(self.key):
+            # same bytes already stored, keep the existing object
+            os.remove(self.tmp_path)
+        else:
+            backend.put_file(self.key, self.tmp_path, move=True)
+
+    def discard(self):
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class BlobTooLarge(ValueError):
+    pass
+
+
+def write_pending(stream, ext, chunk_size=None, head=b'', max_size=None):
+    """Copy a stream to a temporary file in the store, hashing it on the way.
+
+    head holds bytes already read from the stream by the caller. Going over
+    max_size raises BlobTooLarge, leaving the rest of the stream unread.
+    """
+    if chunk_size is None:
+        chunk_size = current_app.config.get("UPLOAD_CHUNK_SIZE", 64 * 1024)
+    folder = picture_folder()
+    os.makedirs(folder, exist_ok=True)
+
+    sha = hashlib.sha256()
+    crc = 0
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            chunk = head or stream.read(chunk_size)
+            while chunk:
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise BlobTooLarge("Picture is larger than {} bytes.".format(max_size))
+                sha.update(chunk)
+                crc = zlib.crc32(chunk, crc)
+                tmp.write(chunk)
+                chunk = stream.read(chunk_size)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return PendingBlob(tmp_path, sha.hexdigest(), ext.lower(), size, crc)
+
+
+def referenced(digest):
+    # pictures stored before content addressing have no digest and own their file alone
+    return bool(digest) and db.session.query(Picture.id).filter_by(digest=digest).first() is not None
+
+
+def bury(*criteria):
+    """Record the files of the pictures matching criteria, before deleting the rows.
+
+    Runs as one INSERT ... SELECT in the caller's transaction. The files are
+    unlinked later by reap_tombstones, once the deletion is committed.
+    """
+    files = select([Picture.path, Picture.digest, literal(time.time())]) \
+        .where(db.and_(*criteria)).distinct()
+    db.session.execute(Tombstone.__table__.insert().from_select(['path', 'digest', 'created_at'], files))
+
+    # one queued reap job is enough however many deletions happen before it runs
+    if db.session.query(Job.id).filter_by(kind='tombstones.reap', status='queued').first() is None:
+        enqueue('tombstones.reap')
+
+
+def reap_tombstones(batch_size=None):
+    """Delete the objects of committed deletions in batches, returns how many were removed."""
+    if batch_size is None:
+        batch_size = current_app.config.get("REAPER_BATCH_SIZE", 500)
+    removed = 0
+    while True:
+        # the same bytes may have been uploaded since, the write lock keeps
+        # their row from being committed between the check and the unlink
+        begin_write(db.session)
+        try:
+            stones = Tombstone.query.order_by(Tombstone.id).limit(batch_size).all()
+            if not stones:
+                db.session.commit()
+                return removed
+            keys = {stone.path for stone in stones if not referenced(stone.digest)}
+            removed += get_backend().delete_many(sorted(keys))
+            Tombstone.query.filter(Tombstone.id.in_([stone.id for stone in stones])) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def legacy_file(path):
+    """Find the file of a row stored before keys, by its path or its name in PICTURE_FOLDER."""
+    if os.path.isfile(path):
+        return path
+    # the first version stored Windows paths ending in \pictures\<name>
+    candidate = os.path.join(picture_folder(), path.replace("\\", "/").rsplit("/", 1)[-1])
+    return candidate if os.path.isfile(candidate) else None
+
+
+def migrate_paths(batch_size=None):
+    """Convert Picture rows holding file paths to content-addressed keys.
+
+    Each file is hashed, stored in the backend under its key, and the row
+    updated, in batches of batch_size rows per transaction. The original
+    files are left in place. Returns (migrated, missing) counts; rows whose
+    file cannot be found are left untouched.
+    """
+    if batch_size is None:
+        batch_size = current_app.config.get("REAPER_BATCH_SIZE", 500)
+    backend = get_backend()
+    migrated = missing = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(Picture.id, Picture.path).filter(Picture.id > last_id) \
+            .order_by(Picture.id).limit(batch_size).all()
+        if not rows:
+            return migrated, missing
+        last_id = rows[-1].id
+        for picture_id, path in rows:
+            if KEY_PATTERN.match(path):
+                continue
+            source = legacy_file(path)
+            if source is None:
+                missing += 1
+                continue
+            sha = hashlib.sha256()
+            crc = 0
+            with open(source, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+                    crc = zlib.crc32(chunk, crc)
+            key = blob_key(sha.hexdigest(), os.path.splitext(source)[1].lower())
+            if not backend.exists(key):
+                backend.put_file(key, source)
+            Picture.query.filter_by(id=picture_id) \
+                .update({"path": key, "digest": sha.hexdigest(), "crc32": crc}, synchronize_session=False)
+            migrated += 1
+        db.session.commit()
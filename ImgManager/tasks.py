@@ -0,0 +1,43 @@
+from flask import current_app
+from ImgManager import db
+from ImgManager.models import Picture
+from ImgManager import storage
+from ImgManager.jobs import job_handler
+from ImgManager.backends import get_backend
+from ImgManager.derivatives import derivative_cache, source_key
+from ImgManager.similarity import file_dhash, to_db
+
+
+def mark_failed(picture_id):
+    picture = Picture.query.get(picture_id)
+    if picture is not None:
+        picture.status = 'failed'
+        db.session.commit()
+
+
+@job_handler('picture.process', on_failure=mark_failed)
+def process_picture(picture_id):
+    from PIL import Image
+    picture = Picture.query.get(picture_id)
+    if picture is None:
+        # deleted before we got to it
+        return
+
+    # the upload only looked at the header, check the whole file here
+    with get_backend().local_copy(picture.path) as path:
+        with Image.open(path) as img:
+            img.verify()
+        # verify() leaves the image unusable, it is opened again to be hashed
+        picture.dhash = to_db(file_dhash(path))
+
+    for width, fmt in current_app.config.get("DERIVATIVE_PREWARM", ()):
+        derivative_cache.get(picture.path, source_key(picture), width, fmt)
+
+    picture.status = 'ready'
+    db.session.commit()
+
+
+@job_handler('tombstones.reap')
+def reap():
+    storage.reap_tombstones()
+
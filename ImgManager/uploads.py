@@ -0,0 +1,139 @@
+import hashlib
+import os
+import tempfile
+import zlib
+from flask import Request, current_app
+from ImgManager.storage import PendingBlob
+
+# leading bytes of the formats we accept, and the extension they are stored with
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'BM', '.bmp'),
+]
+HEADER_SIZE = 16
+
+
+def sniff_image(header):
+    """Return the extension matching an image header, or None if it is not one we accept."""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return '.webp'
+    for signature, ext in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return ext
+    return None
+
+
+class UploadFile(object):
+    """The container werkzeug's form parser writes an uploaded file into.
+
+    Bytes go straight from the request body to a temporary file in the
+    picture store, hashed and size checked as they arrive, so an upload never
+    sits in memory and is never decoded. Only the first bytes are kept to
+    tell the format. The file descriptor is closed as soon as the part is
+    written, and reopened by path if the file is read, so a batch of
+    thousands of parts does not hold thousands of descriptors.
+
+    A part going over max_size is dropped, the rest of it read and ignored,
+    so the other parts of the form still come through. too_large then holds
+    the reason, for the route to answer 413 with.
+    """
+
+    def __init__(self, folder, max_size):
+        os.makedirs(folder, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=folder, prefix=".upload-")
+        self.file = os.fdopen(fd, "w+b")
+        self.written = False
+        self.max_size = max_size
+        self.sha = hashlib.sha256()
+        self.crc = 0
+        self.size = 0
+        self.header = b''
+        self.claimed = False
+        self.too_large = None
+
+    def write(self, data):
+        if self.too_large:
+            return len(data)
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            self.too_large = "Picture is larger than {} bytes.".format(self.max_size)
+            self.close()
+            return len(data)
+        if len(self.header) < HEADER_SIZE:
+            self.header += data[:HEADER_SIZE - len(self.header)]
+        self.sha.update(data)
+        self.crc = zlib.crc32(data, self.crc)
+        return self.file.write(data)
+
+    def _finish(self):
+        # durable before its row can be committed
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        self.written = True
+
+    def _opened(self):
+        if self.file is None:
+            self.file = open(self.tmp_path, "rb")
+        return self.file
+
+    def seek(self, offset, whence=0):
+        # the parser seeks back to the start once the part is written
+        if self.too_large:
+            return 0
+        if not self.written and self.file is not None:
+            self._finish()
+            if (offset, whence) == (0, 0):
+                return 0
+        return self._opened().seek(offset, whence)
+
+    def __getattr__(self, name):
+        # read, tell... go to the temporary file
+        return getattr(self._opened(), name)
+
+    def __iter__(self):
+        return iter(self._opened())
+
+    def pending(self, ext):
+        """Make the upload durable and hand it over as a PendingBlob to commit."""
+        if not self.written:
+            self._finish()
+        elif self.file is not None:
+            self.file.close()
+            self.file = None
+        self.claimed = True
+        return PendingBlob(self.tmp_path, self.sha.hexdigest(), ext, self.size, self.crc)
+
+    def close(self):
+        # called when the request ends, drops uploads nobody stored
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if not self.claimed:
+            self.claimed = True
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+
+class UploadRequest(Request):
+    def __init__(self, *args, **kwargs):
+        super(UploadRequest, self).__init__(*args, **kwargs)
+        # every container created, the parts of a form that failed to parse
+        # never make it to request.files
+        self.uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = UploadFile(current_app.config["PICTURE_FOLDER"], current_app.config.get("MAX_PICTURE_SIZE"))
+        self.uploads.append(upload)
+        return upload
+
+    def close(self):
+        super(UploadRequest, self).close()
+        for upload in self.uploads:
+            upload.close()
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+
+
+class CachedUser(UserMixin):
+    """What current_user needs from a Person, detached from any session."""
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    def __repr__(self):
+        return "<CachedUser {}: {}>".format(self.id, self.name)
+
+
+class UserCache(object):
+    """A bounded LRU cache of CachedUser records with a time to live.
+
+    The size and ttl default to the USER_CACHE_SIZE and USER_CACHE_TTL
+    settings of the current app.
+    """
+
+    def __init__(self, size=None, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _setting(self, value, name, default):
+        if value is not None:
+            return value
+        if has_app_context():
+            return current_app.config.get(name, default)
+        return default
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[user_id]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, user):
+        size = self._setting(self.size, "USER_CACHE_SIZE", 1024)
+        expires = time.monotonic() + self._setting(self.ttl, "USER_CACHE_TTL", 300)
+        with self.lock:
+            self.entries[user_id] = (expires, user)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+user_cache = UserCache()
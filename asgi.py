@@ -0,0 +1,17 @@
+import argparse
+import logging
+from ImgManager import app
+from ImgManager.asgi import ASGIAdapter
+
+# for an ASGI server, e.g. `uvicorn asgi:application`
+application = ASGIAdapter.from_app(app)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the API with uvicorn.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    import uvicorn
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(application, host=args.host, port=args.port, lifespan="on")
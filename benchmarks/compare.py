@@ -0,0 +1,58 @@
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return {(r["scale"], r["driver"], r["workload"]): r for r in data["results"]}
+
+
+def compare(baseline, current, threshold):
+    """Rows of (key, metric, before, after, change, regressed) for the results in both runs.
+
+    Latencies regress when they grow by more than threshold, throughput
+    when it drops by more than threshold, errors as soon as there are more.
+    """
+    rows = []
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key], current[key]
+        for metric, higher_is_worse in (("p50_ms", True), ("p99_ms", True), ("throughput_rps", False),
+                                        ("peak_rss_kib", True)):
+            old, new = before.get(metric), after.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / float(old)
+            regressed = change > threshold if higher_is_worse else change < -threshold
+            rows.append((key, metric, old, new, change, regressed))
+        if after["errors"] > before["errors"]:
+            rows.append((key, "errors", before["errors"], after["errors"], None, True))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files, exits with 1 on regressions.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative change tolerated before flagging a regression (default: 0.2)")
+    parser.add_argument("--all", action="store_true", help="show every metric, not only the regressions")
+    args = parser.parse_args(argv)
+
+    baseline, current = load(args.baseline), load(args.current)
+    rows = compare(baseline, current, args.threshold)
+    regressions = [row for row in rows if row[5]]
+    for (scale, driver, workload), metric, old, new, change, regressed in (rows if args.all else regressions):
+        print("{} {:>5} {:<12} {:<16} {:<15} {:>12.6g} -> {:>12.6g} {}".format(
+            "REGRESSION" if regressed else "          ", scale, driver, workload, metric, old, new,
+            "" if change is None else "{:+.1%}".format(change)))
+    for key in sorted(set(baseline) ^ set(current)):
+        print("only in {}: {}".format("baseline" if key in baseline else "current", " ".join(key)))
+    print("{} regressions in {} compared metrics (threshold {:.0%})".format(len(regressions), len(rows),
+                                                                          args.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
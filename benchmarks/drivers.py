@@ -0,0 +1,132 @@
+import http.client
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+
+def multipart(fields, files):
+    """A multipart/form-data body of fields {name: value} and files [(field, filename, bytes)]."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'
+                     .format(boundary, name, value).encode("utf-8"))
+    for name, filename, data in files:
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, name, filename).encode("utf-8"))
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append("--{}--\r\n".format(boundary).encode("ascii"))
+    return b"".join(parts), "multipart/form-data; boundary=" + boundary
+
+
+class Call(object):
+    """One request of a workload."""
+
+    def __init__(self, method, url, body=None, content_type=None):
+        self.method = method
+        self.url = url
+        self.body = body
+        self.content_type = content_type
+
+
+class Driver(object):
+    """Sends the calls of a workload and times each of them, response body included."""
+
+    name = None
+    concurrency = 1
+
+    def call(self, call):
+        """Send call, returns the status code once the whole body was read."""
+        raise NotImplementedError
+
+    def login(self, name, password):
+        body = "name={}&password={}".format(name, password).encode("utf-8")
+        status = self.call(Call("POST", "/login", body, "application/x-www-form-urlencoded"))
+        if status != 200:
+            raise RuntimeError("Benchmark login failed with {}".format(status))
+
+    def _timed(self, call):
+        start = time.perf_counter()
+        try:
+            status = self.call(call)
+        except Exception:
+            status = None
+        return time.perf_counter() - start, status
+
+    def run(self, calls):
+        """Returns the latency and status of each call, and the wall time of the whole run."""
+        start = time.perf_counter()
+        if self.concurrency == 1:
+            results = [self._timed(call) for call in calls]
+        else:
+            with ThreadPoolExecutor(self.concurrency) as pool:
+                results = list(pool.map(self._timed, calls))
+        return results, time.perf_counter() - start
+
+    def close(self):
+        pass
+
+
+class TestClientDriver(Driver):
+    """Calls the app in process, one request at a time: the cost of the app alone."""
+
+    name = "test_client"
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def call(self, call):
+        rv = self.client.open(call.url, method=call.method, data=call.body, content_type=call.content_type)
+        rv.get_data()
+        status = rv.status_code
+        rv.close()
+        return status
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class WSGIServerDriver(Driver):
+    """Serves the app with a threaded WSGI server and calls it from concurrent clients over HTTP.
+
+    Each call opens its own connection, like the clients of the API do.
+    """
+
+    name = "wsgi_server"
+
+    def __init__(self, app, concurrency=8):
+        self.concurrency = concurrency
+        self.server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=_QuietHandler)
+        self.port = self.server.server_port
+        self.cookie = None
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def call(self, call):
+        headers = {}
+        if call.content_type:
+            headers["Content-Type"] = call.content_type
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            conn.request(call.method, call.url, body=call.body, headers=headers)
+            response = conn.getresponse()
+            while response.read(64 * 1024):
+                pass
+            cookie = response.getheader("Set-Cookie")
+            if cookie and call.url == "/login":
+                self.cookie = cookie.split(";", 1)[0]
+            return response.status
+        finally:
+            conn.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
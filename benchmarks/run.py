@@ -0,0 +1,215 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from ImgManager import app, db
+from ImgManager.models import Picture
+from ImgManager.responsecache import response_cache
+from ImgManager.usercache import user_cache
+from benchmarks import startup
+from benchmarks.drivers import Call, TestClientDriver, WSGIServerDriver, multipart
+from benchmarks.seed import BENCH_USER, ROOT, SAMPLE_JPEG, SCALES, prepare
+
+RESULTS_FOLDER = os.path.join(ROOT, "benchmarks", "results")
+UPLOAD_PREFIX = "bench-upload-"
+
+
+def percentile(values, p):
+    # nearest rank, values are sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def peak_rss_kib():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def summarize(workload, driver, scale, results, elapsed):
+    latencies = sorted(latency for latency, status in results)
+    errors = sum(1 for latency, status in results if status is None or status >= 400)
+    return {
+        "workload": workload,
+        "driver": driver.name,
+        "scale": scale,
+        "concurrency": driver.concurrency,
+        "requests": len(results),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else None,
+        # the process peak so far, the largest workloads push it up for the ones after them
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def read_workloads(info, rng, requests):
+    """(name, calls) of the read routes, ids drawn from rng so runs ask for the same rows."""
+    pictures, albums, persons = info["pictures"], info["albums"], info["persons"]
+
+    def calls(url, pick):
+        return [Call("GET", url.format(pick())) for _ in range(requests)]
+
+    return [
+        ("person_page", calls("/person?limit=100&after={}", lambda: rng.randint(0, max(0, persons - 100)))),
+        ("person", calls("/person/{}", lambda: rng.randint(1, persons))),
+        ("album_page", calls("/album?limit=100&after={}", lambda: rng.randint(0, max(0, albums - 100)))),
+        ("album", calls("/album/{}", lambda: rng.randint(1, albums))),
+        ("pictures_page", calls("/pictures?limit=100&after={}", lambda: rng.randint(0, max(0, pictures - 100)))),
+        ("album_pictures", calls("/picture/Album/{}", lambda: rng.randint(1, albums))),
+        ("picture", calls("/picture/{}", lambda: rng.randint(1, pictures))),
+        ("picture_raw", calls("/picture/{}/raw", lambda: rng.randint(1, pictures))),
+        ("picture_variant", calls("/picture/{}?w=256", lambda: rng.randint(1, pictures))),
+        ("picture_similar", calls("/picture/{}/similar?maxdist=6", lambda: rng.randint(1, pictures))),
+        # name prefixes of random rows, a handful of matches each
+        ("search_pictures", calls("/search?kind=picture&q=picture{}", lambda: rng.randint(1, pictures))),
+        ("search_albums", calls("/search?kind=album&q=album{}", lambda: rng.randint(1, albums))),
+    ]
+
+
+def uploaded_ids(prefix):
+    with app.app_context():
+        return [row.id for row in db.session.query(Picture.id).filter(Picture.name.like(prefix + "%"))
+                .order_by(Picture.id)]
+
+
+def write_workloads(driver, requests, batch_size):
+    """Run the upload, batch upload and delete workloads, yields (name, results, elapsed)."""
+    with open(SAMPLE_JPEG, "rb") as f:
+        image = f.read()
+    # names are unique per driver, each driver uploads into the same album
+    prefix = "{}{}-".format(UPLOAD_PREFIX, driver.name)
+
+    calls = []
+    for i in range(requests):
+        body, content_type = multipart({"name": "{}{}".format(prefix, i)}, [("image", "bench.jpg", image)])
+        calls.append(Call("POST", "/Album/1/addPicture", body, content_type))
+    yield ("upload",) + driver.run(calls)
+
+    calls = []
+    for i in range(max(1, requests // batch_size)):
+        files = [("images", "{}batch{}-{}.jpg".format(prefix, i, j), image) for j in range(batch_size)]
+        body, content_type = multipart({}, files)
+        calls.append(Call("POST", "/Album/1/addPictures", body, content_type))
+    yield ("batch_upload",) + driver.run(calls)
+
+    calls = [Call("GET", "/deletePic/{}".format(picture_id)) for picture_id in uploaded_ids(prefix)]
+    yield ("delete",) + driver.run(calls)
+
+
+def make_driver(name, concurrency):
+    if name == "test_client":
+        return TestClientDriver(app)
+    return WSGIServerDriver(app, concurrency)
+
+
+def run_scale(scale, args, folder):
+    info = prepare(scale, os.path.join(folder, scale), reseed=args.reseed)
+    app.config["RESPONSE_CACHE_ENABLED"] = not args.no_cache
+    response_cache.clear()
+    user_cache.clear()
+
+    results = []
+    for driver_name in args.drivers:
+        driver = make_driver(driver_name, args.concurrency)
+        try:
+            rng = random.Random("{}:{}".format(args.seed, scale))
+            for workload, calls in read_workloads(info, rng, args.requests):
+                if args.workloads and workload not in args.workloads:
+                    continue
+                # untimed, so one-off work (first connections, loading the similarity index) is left out
+                driver.call(calls[0])
+                results.append(summarize(workload, driver, scale, *driver.run(calls)))
+                print_result(results[-1])
+            if not args.no_writes and not args.workloads:
+                driver.login(*BENCH_USER)
+                for workload, runs, elapsed in write_workloads(driver, args.requests, args.batch_size):
+                    results.append(summarize(workload, driver, scale, runs, elapsed))
+                    print_result(results[-1])
+        finally:
+            driver.close()
+    return results
+
+
+def print_result(result):
+    print("{scale:>5} {driver:<12} {workload:<16} {requests:>6} req {errors:>4} err "
+          "p50 {p50_ms:>9.2f} ms  p99 {p99_ms:>9.2f} ms  {throughput:>9} req/s  "
+          "rss {peak_rss_kib} KiB".format(throughput="-" if result["throughput_rps"] is None
+                                          else "{:.1f}".format(result["throughput_rps"]), **result))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API on synthetic databases and write the results as JSON. "
+                    "Compare two result files with `python -m benchmarks.compare`.")
+    parser.add_argument("--scales", default="1k", help="comma separated, among {} (default: 1k)"
+                        .format(", ".join(SCALES)))
+    parser.add_argument("--drivers", default="test_client,wsgi_server",
+                        help="test_client and/or wsgi_server (default: both)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per workload (default: 200)")
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads of wsgi_server (default: 8)")
+    parser.add_argument("--batch-size", type=int, default=10, help="pictures per batch upload (default: 10)")
+    parser.add_argument("--seed", type=int, default=487, help="random seed of the requested ids")
+    parser.add_argument("--workloads", default="", help="comma separated read workloads to run, and no writes "
+                                                         "(default: all of them)")
+    parser.add_argument("--no-writes", action="store_true", help="skip the upload and delete workloads")
+    parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    parser.add_argument("--reseed", action="store_true", help="rebuild the seeded databases")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="fresh interpreters timed per startup workload, 0 to skip them (default: 5)")
+    parser.add_argument("--out", help="result file (default: benchmarks/results/<time>.json)")
+    args = parser.parse_args(argv)
+    args.scales = [scale.strip().lower() for scale in args.scales.split(",") if scale.strip()]
+    args.drivers = [name.strip() for name in args.drivers.split(",") if name.strip()]
+    args.workloads = [name.strip() for name in args.workloads.split(",") if name.strip()]
+    unknown = [scale for scale in args.scales if scale not in SCALES]
+    unknown += [name for name in args.drivers if name not in ("test_client", "wsgi_server")]
+    if unknown:
+        parser.error("unknown scales or drivers: {}".format(", ".join(unknown)))
+
+    started = datetime.datetime.utcnow().replace(microsecond=0)
+    results = startup.measure(runs=args.startup_runs) if args.startup_runs > 0 else []
+    for result in results:
+        print_result(result)
+    with tempfile.TemporaryDirectory(prefix="imgmanager-bench-") as folder:
+        for scale in args.scales:
+            results.extend(run_scale(scale, args, folder))
+
+    out = args.out or os.path.join(RESULTS_FOLDER, started.strftime("%Y%m%dT%H%M%SZ.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({
+            "meta": {
+                "started": started.isoformat() + "Z",
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "arguments": {key: value for key, value in vars(args).items() if key != "out"},
+            },
+            "results": results,
+        }, f, indent=2)
+    print("Results written to {}".format(out))
+
+
+if __name__ == "__main__":
+    main()
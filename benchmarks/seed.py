@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import time
+import zlib
+from ImgManager import app, db
+from ImgManager.config import ProdConfig
+from ImgManager.models import Person, Album, Picture
+from ImgManager.backends import get_backend
+from ImgManager.hashing import generate_password_hash
+from ImgManager.similarity import to_db
+from ImgManager.storage import blob_key
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_JPEG = os.path.join(ROOT, "tests", "test_img.jpg")
+DATA_FOLDER = os.path.join(ROOT, "benchmarks", ".data")
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+PICTURES_PER_ALBUM = 100
+ALBUMS_PER_PERSON = 10
+# the person the write workloads log in as, it owns album 1
+BENCH_USER = ("bench", "bench-password")
+# bump when the shape of the seeded data changes, older templates are rebuilt
+SEED_VERSION = 4
+INSERT_CHUNK = 10000
+
+
+def configure(folder):
+    """Point the app at a benchmark database and store under folder."""
+    # engines are created per URI, close the one of a previous folder
+    with app.app_context():
+        db.get_engine().dispose()
+    app.config.from_object(ProdConfig)
+    app.config.update(
+        DEBUG=False,
+        SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(folder, "bench.sqlite"),
+        PICTURE_FOLDER=os.path.join(folder, "pictures"),
+        DERIVATIVE_FOLDER=os.path.join(folder, "derivatives"),
+        STORAGE_BACKEND="local",
+        STORAGE_ROOT=None,
+        RESPONSE_CACHE_FOLDER=None,
+    )
+
+
+def counts(pictures):
+    albums = max(1, pictures // PICTURES_PER_ALBUM)
+    persons = max(1, albums // ALBUMS_PER_PERSON)
+    return persons, albums, pictures
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed(folder, pictures):
+    """Build a database of `pictures` pictures in folder, all sharing the sample JPEG."""
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    configure(folder)
+    persons, albums, pictures = counts(pictures)
+
+    with app.app_context():
+        db.create_all()
+        with open(SAMPLE_JPEG, "rb") as f:
+            data = f.read()
+        digest, crc = hashlib.sha256(data).hexdigest(), zlib.crc32(data)
+        key = blob_key(digest, ".jpg")
+        get_backend().put_file(key, SAMPLE_JPEG)
+        # one hash for everybody, bcrypt would otherwise dominate seeding
+        password = generate_password_hash(BENCH_USER[1])
+
+        engine = db.get_engine()
+        with engine.begin() as conn:
+            conn.execute(Person.__table__.insert(),
+                         [{"name": BENCH_USER[0] if i == 0 else "person{}".format(i), "password": password}
+                          for i in range(persons)])
+            conn.execute(Album.__table__.insert(),
+                         [{"name": "album{}".format(i), "person_id": i // ALBUMS_PER_PERSON + 1}
+                          for i in range(albums)])
+        # random perceptual hashes, the same on every seeding
+        rng = random.Random(SEED_VERSION)
+        rows = ({"name": "picture{}".format(i), "album_id": min(i // PICTURES_PER_ALBUM, albums - 1) + 1,
+                 "path": key, "digest": digest, "crc32": crc, "status": "ready", "dhash": to_db(rng.getrandbits(64))}
+                for i in range(pictures))
+        for chunk in _chunks(rows):
+            with engine.begin() as conn:
+                conn.execute(Picture.__table__.insert(), chunk)
+        with engine.connect() as conn:
+            conn.execute("ANALYZE")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        engine.dispose()
+
+    with open(os.path.join(folder, "seed.json"), "w") as f:
+        json.dump({"version": SEED_VERSION, "persons": persons, "albums": albums, "pictures": pictures}, f)
+
+
+def prepare(scale, run_folder, reseed=False):
+    """A fresh copy of the seeded database of scale in run_folder, seeding it first if needed.
+
+    Seeding 1M pictures takes a while, so the seeded databases are kept in
+    benchmarks/.data and copied for each run: write workloads never change
+    the template and every run starts from the same rows.
+    """
+    template = os.path.join(DATA_FOLDER, scale)
+    info = None
+    try:
+        with open(os.path.join(template, "seed.json")) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if reseed or info is None or info.get("version") != SEED_VERSION:
+        start = time.perf_counter()
+        seed(template, SCALES[scale])
+        print("Seeded {} pictures in {:.1f} s".format(SCALES[scale], time.perf_counter() - start))
+
+    shutil.rmtree(run_folder, ignore_errors=True)
+    shutil.copytree(template, run_folder)
+    configure(run_folder)
+    with open(os.path.join(run_folder, "seed.json")) as f:
+        return json.load(f)
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what a cold start runs, each in a fresh interpreter. None of them opens the
+# database, the numbers are import and app building time only.
+TARGETS = {
+    "import": "import ImgManager",
+    "app": "from ImgManager import app",
+    "cli": "import ImgManager.manage",
+}
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)")
+
+
+def parse_importtime(output):
+    """{module: (self µs, cumulative µs)} from the stderr of `python -X importtime`."""
+    modules = {}
+    for line in output.splitlines():
+        found = _LINE.match(line)
+        if found:
+            modules[found.group(3)] = (int(found.group(1)), int(found.group(2)))
+    return modules
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def profile(statement, runs):
+    """(wall times in seconds, failures, {module: [(self, cumulative)...]}) of runs fresh interpreters."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    times, failures, modules = [], 0, {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        done = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        times.append(time.perf_counter() - start)
+        if done.returncode:
+            failures += 1
+            continue
+        for name, costs in parse_importtime(done.stderr).items():
+            modules.setdefault(name, []).append(costs)
+    return times, failures, modules
+
+
+def measure(targets=("import", "app", "cli"), runs=10, top=20):
+    """Result rows, in the format of benchmarks.run, of the cold start of each target.
+
+    Latencies are the wall time of the whole interpreter, from exec to exit.
+    "modules" lists the top modules by median self import time, in ms.
+    """
+    results = []
+    for target in targets:
+        times, failures, modules = profile(TARGETS[target], runs)
+        times.sort()
+        costs = sorted(((median([own for own, _ in values]), median([cumulative for _, cumulative in values]), name)
+                        for name, values in modules.items()), reverse=True)
+        results.append({
+            "workload": "startup_" + target,
+            "driver": "subprocess",
+            "scale": "-",
+            "concurrency": 1,
+            "requests": runs,
+            "errors": failures,
+            "p50_ms": round(median(times) * 1000, 3),
+            "p99_ms": round(times[-1] * 1000, 3),
+            "mean_ms": round(sum(times) / len(times) * 1000, 3),
+            "throughput_rps": None,
+            # the largest child so far
+            "peak_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            "modules": [{"name": name, "self_ms": round(own / 1000.0, 3), "cumulative_ms": round(cumulative / 1000.0, 3)}
+                        for own, cumulative, name in costs[:top]],
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile the cold start of the package, module by module.")
+    parser.add_argument("--targets", default=",".join(TARGETS),
+                        help="comma separated, among {} (default: all)".format(", ".join(TARGETS)))
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per target (default: 10)")
+    parser.add_argument("--top", type=int, default=20, help="slowest modules shown (default: 20)")
+    parser.add_argument("--out", help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+    targets = [name.strip() for name in args.targets.split(",") if name.strip()]
+    unknown = [name for name in targets if name not in TARGETS]
+    if unknown or args.runs < 1:
+        parser.error("unknown targets: {}".format(", ".join(unknown)) if unknown else "--runs must be positive")
+
+    results = measure(targets, args.runs, args.top)
+    for result in results:
+        print("{workload}: p50 {p50_ms} ms, max {p99_ms} ms, {errors} failed runs".format(**result))
+        print("  {:>9} {:>9}  module".format("self ms", "cumul ms"))
+        for module in result["modules"]:
+            print("  {self_ms:>9.3f} {cumulative_ms:>9.3f}  {name}".format(**module))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+    return 1 if any(result["errors"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,12 @@
 from ImgManager import app
+from ImgManager.schema import upgrade_database
 
-if __name__ == '__main__':
+
+def main():
+    # the app leaves its database alone: bring the development one up to the models first
+    upgrade_database(app)
     app.run(debug=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import logging
+import os
+
+# production settings unless told otherwise, before the app is imported
+os.environ.setdefault("IMGMANAGER_CONFIG", "prod")
+
+# imported once here, the forked workers share it
+from ImgManager import app
+from ImgManager.prefork import LISTEN_FD_ENV, Arbiter
+from ImgManager.schema import upgrade_database
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the API with pre-forked worker processes. "
+                                                 "SIGHUP reloads the code without downtime, SIGTERM stops.")
+    parser.add_argument("--bind", default="127.0.0.1:8000", help="host:port to listen on (default: 127.0.0.1:8000)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: SERVER_WORKERS)")
+    parser.add_argument("--threads", type=int, default=None, help="request threads per worker (default: SERVER_THREADS)")
+    parser.add_argument("--max-requests", type=int, default=None,
+                        help="requests before a worker is replaced, 0 for never (default: SERVER_MAX_REQUESTS)")
+    parser.add_argument("--max-requests-jitter", type=int, default=None,
+                        help="up to this many more requests, drawn per worker (default: SERVER_MAX_REQUESTS_JITTER)")
+    parser.add_argument("--graceful-timeout", type=float, default=None,
+                        help="seconds stopping workers get to finish (default: SERVER_GRACEFUL_TIMEOUT)")
+    parser.add_argument("--upgrade-db", action="store_true",
+                        help="create missing tables, columns and indexes before forking the workers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+    # not again on reload: the old workers are still serving, and DDL
+    # waiting behind their writes would hold up the new ones
+    if args.upgrade_db and LISTEN_FD_ENV not in os.environ:
+        upgrade_database(app)
+    host, _, port = args.bind.rpartition(":")
+    arbiter = Arbiter.from_app(app, (host.strip("[]") or "127.0.0.1", int(port)), workers=args.workers,
+                               threads=args.threads, max_requests=args.max_requests,
+                               max_requests_jitter=args.max_requests_jitter,
+                               graceful_timeout=args.graceful_timeout)
+    raise SystemExit(arbiter.run())
@@ -0,0 +1,93 @@
+import atexit
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from ImgManager import app as tested_app
+from ImgManager import db as tested_db
+from ImgManager.models import Person, Album, Picture, PictureMetadata, Job, Tombstone
+from ImgManager.derivatives import derivative_cache
+
+TEST_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_img.jpg')
+
+# the tests run against a database of their own, the checked-in one is left alone
+DATABASE_FOLDER = tempfile.mkdtemp()
+DATABASE_URI = "sqlite:///" + os.path.join(DATABASE_FOLDER, "test_SOEN487_A1.sqlite")
+atexit.register(shutil.rmtree, DATABASE_FOLDER, ignore_errors=True)
+
+
+def image_bytes():
+    """The bytes of the JPEG the tests upload."""
+    with open(TEST_IMAGE, 'rb') as img:
+        return img.read()
+
+
+class AppTestCase(unittest.TestCase):
+    """Alice, and Bob with Album1 holding two pictures, uploads and variants going to throwaway folders."""
+
+    def setUp(self):
+        # set up the test DB, create_all also upgrades it to the models
+        tested_app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        self.db = tested_db
+        self.db.create_all()
+        self.app = tested_app.test_client()
+        # cleanups run even when the fixture below fails halfway, unlike tearDown
+        self.addCleanup(self.clear_database)
+
+        # uploads and variants go to throwaway folders, with the files of the fixture rows
+        self.folders = {"PICTURE_FOLDER": tempfile.mkdtemp(), "DERIVATIVE_FOLDER": tempfile.mkdtemp()}
+        self.saved_folders = {key: tested_app.config[key] for key in self.folders}
+        for name in ('test_img.jpg', 'test_img2.jpg'):
+            shutil.copy(os.path.join(self.saved_folders["PICTURE_FOLDER"], name), self.folders["PICTURE_FOLDER"])
+        tested_app.config.update(self.folders)
+        derivative_cache.total = None
+        self.addCleanup(self.restore_folders)
+
+        # Setting up some testing Data
+        self.app.post("/register", data={"name": "Alice", "password": "Alice123"})
+        self.app.post("/register", data={"name": "Bob", "password": "Bob123"})
+
+        self.app.post("/login", data={"name": "Bob", "password": "Bob123"})
+        self.app.post("/createAlbum", data={"name": "Album1"})
+        self.app.post("/logout")
+        picture_path = os.path.join(tested_app.root_path + '\pictures', 'test_img.jpg')
+        picture_path2 = os.path.join(tested_app.root_path + '\pictures', 'test_img2.jpg')
+
+        new_pic = Picture(name='tst_img', album_id=1, path=picture_path)
+        new_pic2 = Picture(name='tst_img2', album_id=1, path=picture_path2)
+        self.db.session.add(new_pic)
+        self.db.session.add(new_pic2)
+        self.db.session.commit()
+
+    def clear_database(self):
+        # clean up the DB after the tests
+        self.db.session.rollback()
+        Person.query.delete()
+        Album.query.delete()
+        PictureMetadata.query.delete()
+        Picture.query.delete()
+        Job.query.delete()
+        Tombstone.query.delete()
+        # the next test starts from id 1 again
+        self.db.session.execute("DELETE FROM sqlite_sequence")
+        self.db.session.commit()
+
+    def restore_folders(self):
+        tested_app.config.update(self.saved_folders)
+        derivative_cache.total = None
+        for folder in self.folders.values():
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def login(self, name="Bob", password="Bob123"):
+        response = self.app.post("/login", data={"name": name, "password": password})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def upload(self, name, data=None, album_id=1):
+        """Add data (default: the test image) to album_id as picture name, the id of its row."""
+        data = image_bytes() if data is None else data
+        response = self.app.post('/Album/{}/addPicture'.format(album_id), content_type='multipart/form-data',
+                                 data={'image': (io.BytesIO(data), 'test_img.jpg'), 'name': name})
+        self.assertEqual(response.status_code, 200)
+        return Picture.query.filter_by(name=name).first().id
@@ -0,0 +1,102 @@
+import asyncio
+import io
+import json
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+from ImgManager.asgi import ASGIAdapter
+from ImgManager.models import Picture
+from support import AppTestCase, image_bytes, tested_app
+
+
+def http_scope(method, path, headers=()):
+    path, _, query = path.partition("?")
+    return {"type": "http", "method": method, "path": path, "query_string": query.encode("latin-1"),
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]}
+
+
+class TestASGI(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        # small buffers, so the listing below is streamed from its thread
+        self.application = ASGIAdapter(tested_app, threads=2, spool_bytes=4096, buffer_bytes=100)
+        self.addCleanup(self.application.close)
+
+    def request(self, method, path, body=b"", headers=()):
+        """(status, headers, body) of a request to the adapter, its body sent 1000 bytes at a time."""
+        received = [{"type": "http.request", "body": body[i:i + 1000], "more_body": i + 1000 < len(body)}
+                    for i in range(0, max(len(body), 1), 1000)]
+        sent = []
+
+        async def receive():
+            return received.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.application(http_scope(method, path, headers), receive, send))
+        response_headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in sent[0]["headers"]}
+        self.assertFalse(sent[-1]["more_body"])
+        return sent[0]["status"], response_headers, b"".join(message["body"] for message in sent[1:])
+
+    def test_upload_and_download(self):
+        status, headers, body = self.request("POST", "/login", b"name=Bob&password=Bob123",
+                                             [("Content-Type", "application/x-www-form-urlencoded")])
+        self.assertEqual(status, 200)
+        cookie = ("Cookie", headers["set-cookie"].split(";")[0])
+
+        img_bytes = image_bytes()
+        boundary, stream = encode_multipart({"name": "asgi", "image": FileStorage(io.BytesIO(img_bytes), "test_img.jpg")})
+        status, headers, body = self.request("POST", "/Album/1/addPicture", stream,
+                                             [cookie, ("Content-Type", "multipart/form-data; boundary={}".format(boundary))])
+        self.assertEqual(status, 200)
+        picture = Picture.query.filter_by(name="asgi").first()
+
+        status, headers, body = self.request("GET", "/picture/{}/raw".format(picture.id))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, img_bytes)
+        status, headers, body = self.request("GET", "/picture/{}/raw".format(picture.id),
+                                             headers=[("Range", "bytes=10-19")])
+        self.assertEqual(status, 206)
+        self.assertEqual(body, img_bytes[10:20])
+
+        status, headers, body = self.request("GET", "/picture/1000000/raw")
+        self.assertEqual(status, 404)
+
+    def test_streamed_listing(self):
+        status, headers, body = self.request("GET", "/pictures")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body.decode("utf-8"))), Picture.query.count())
+
+    def test_stalled_client_releases_thread(self):
+        application = ASGIAdapter(tested_app, threads=1)
+        self.addCleanup(application.close)
+        self.login()
+        self.upload("stalled")
+        picture = Picture.query.filter_by(name="stalled").first()
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def scenario():
+            resume = asyncio.Event()
+            sent = []
+
+            async def stalled(message):
+                # takes the headers, then stops reading
+                if message["type"] == "http.response.body":
+                    await resume.wait()
+
+            async def send(message):
+                sent.append(message)
+
+            # a JSON body and a file body, both waiting on their clients
+            waiting = [asyncio.ensure_future(application(http_scope("GET", path), receive, stalled))
+                       for path in ("/person", "/picture/{}/raw".format(picture.id))]
+            await asyncio.wait_for(application(http_scope("GET", "/person/1"), receive, send), 10)
+            resume.set()
+            await asyncio.wait_for(asyncio.gather(*waiting), 10)
+            return sent
+
+        sent = asyncio.run(scenario())
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertEqual(json.loads(b"".join(message["body"] for message in sent[1:]).decode("utf-8"))["name"], "Alice")
@@ -0,0 +1,50 @@
+import json
+from unittest import mock
+from sqlalchemy.exc import OperationalError
+from ImgManager.hashing import HashingBusy, hash_rounds, needs_rehash
+from ImgManager.models import Person
+from ImgManager.usercache import user_cache
+from support import AppTestCase, tested_app
+
+
+class TestAuth(AppTestCase):
+    def test_login_rehashes_password(self):
+        with mock.patch.dict(tested_app.config, BCRYPT_LOG_ROUNDS=5):
+            self.login("Alice", "Alice123")
+
+        alice = Person.query.filter_by(name="Alice").first()
+        self.assertEqual(hash_rounds(alice.password), 5)
+
+    def test_login_rehash_locked(self):
+        # a locked database only skips the rehash
+        old = Person.query.filter_by(name="Alice").first().password
+        with mock.patch.dict(tested_app.config, BCRYPT_LOG_ROUNDS=5), \
+                mock.patch.object(self.db.session, "commit",
+                                  side_effect=OperationalError("UPDATE", {}, Exception("database is locked"))):
+            self.login("Alice", "Alice123")
+
+        self.assertEqual(Person.query.filter_by(name="Alice").first().password, old)
+
+    def test_unreadable_hash_not_rehashed(self):
+        for pw_hash in ("legacy", "$2b$xx$salt", ""):
+            self.assertIsNone(hash_rounds(pw_hash))
+            with tested_app.app_context():
+                self.assertFalse(needs_rehash(pw_hash))
+
+    def test_login_busy(self):
+        with mock.patch("ImgManager.routes.check_password_hash", side_effect=HashingBusy):
+            response = self.app.post("/login", data={"name": "Alice", "password": "Alice123"})
+        self.assertEqual(response.status_code, 503)
+
+    def test_logged_in_user_is_cached(self):
+        self.login()
+        response = self.app.post("/createAlbum", data={"name": "Summer"})
+        self.assertEqual(response.status_code, 200)
+
+        hits = user_cache.stats()["hits"]
+        response = self.app.post("/createAlbum", data={"name": "Winter"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_cache.stats()["hits"], hits + 1)
+
+        response = self.app.get("/cache/stats")
+        self.assertEqual(json.loads(str(response.data, "utf8"))["user"], user_cache.stats())
@@ -0,0 +1,135 @@
+import io
+import json
+import os
+import resource
+import zipfile
+from unittest import mock
+from PIL import Image
+from sqlalchemy.exc import OperationalError
+from ImgManager import batch
+from ImgManager.database import writer
+from ImgManager.models import Picture
+from support import AppTestCase, image_bytes, tested_app
+
+
+class TestBatch(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.login()
+
+    def add_pictures(self, **kwargs):
+        """The per-item results of a batch upload to Album1."""
+        response = self.app.post('/Album/1/addPictures', **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(str(response.data, "utf8"))["results"]
+
+    def uploads_left(self):
+        folder = tested_app.config["PICTURE_FOLDER"]
+        return [name for name in os.listdir(folder) if name.startswith(".upload-")]
+
+    def test_add_pics_multipart(self):
+        img_bytes = image_bytes()
+        results = self.add_pictures(content_type='multipart/form-data',
+                                    data={'images': [(io.BytesIO(img_bytes), 'batch1.jpg'),
+                                                     (io.BytesIO(b"not a picture"), 'batch2.jpg'),
+                                                     (io.BytesIO(img_bytes), 'tst_img.jpg')]})
+        self.assertEqual([result["code"] for result in results], [200, 403, 403])
+        self.assertEqual(Picture.query.filter_by(name="batch1").first().status, "pending")
+
+    def test_add_pics_zip(self):
+        img_bytes = image_bytes()
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('shoot/zip1.jpg', img_bytes)
+            zf.writestr('shoot/zip2.jpg', img_bytes, compress_type=zipfile.ZIP_DEFLATED)
+        results = self.add_pictures(content_type='application/zip', data=archive.getvalue())
+        self.assertEqual([(result["name"], result["code"]) for result in results], [("zip1", 200), ("zip2", 200)])
+        self.assertEqual(Picture.query.filter_by(album_id=1).count(), 4)
+
+    def test_add_pics_truncated_zip(self):
+        img_bytes = image_bytes()
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('whole.jpg', img_bytes)
+            zf.writestr('cut.jpg', img_bytes)
+        # cut in the middle of the second entry
+        body = archive.getvalue()[:len(img_bytes) * 3 // 2]
+        response = self.app.post('/Album/1/addPictures', content_type='application/zip', data=body)
+        self.assertEqual(response.status_code, 400)
+        results = json.loads(str(response.data, "utf8"))["results"]
+        self.assertEqual([(result["name"], result["code"]) for result in results], [("whole", 200), ("cut", 400)])
+        self.assertEqual(self.uploads_left(), [])
+
+    def test_add_pics_reads_headers_unlocked(self):
+        read_metadata = batch.read_metadata
+        owners = []
+
+        def reading(path):
+            owners.append(writer.owner)
+            return read_metadata(path)
+
+        with mock.patch('ImgManager.batch.read_metadata', side_effect=reading):
+            results = self.add_pictures(content_type='multipart/form-data',
+                                        data={'images': [(io.BytesIO(image_bytes()), 'unlocked.jpg')]})
+        self.assertEqual([result["code"] for result in results], [200])
+        self.assertEqual(owners, [None])
+
+    def test_add_pics_file_descriptors(self):
+        small = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(small, "JPEG")
+
+        def parts(prefix):
+            return [(io.BytesIO(small.getvalue()), '{}{}.jpg'.format(prefix, i)) for i in range(300)]
+
+        # many more parts than descriptors left
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir('/proc/self/fd')) + 100, hard))
+        try:
+            self.add_pictures(content_type='multipart/form-data', data={'images': parts('part')})
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        self.assertEqual(Picture.query.filter(Picture.name.like("part%")).count(), 300)
+        self.assertEqual(self.uploads_left(), [])
+
+        # a request failing halfway leaves no temporary file behind, once it ends
+        with mock.patch('ImgManager.batch.BatchIngest.flush', side_effect=RuntimeError("flush failed")), \
+                mock.patch.dict(tested_app.config, PRESERVE_CONTEXT_ON_EXCEPTION=False):
+            with self.assertRaises(RuntimeError):
+                self.app.post('/Album/1/addPictures', content_type='multipart/form-data',
+                              data={'images': parts('again')})
+        self.assertEqual(self.uploads_left(), [])
+
+    def test_add_pics_unknown_album(self):
+        response = self.app.post('/Album/99/addPictures', content_type='multipart/form-data', data={'images': []})
+        self.assertEqual(response.status_code, 404)
+
+    def test_add_pics_too_large_part(self):
+        small = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(small, "JPEG")
+        with mock.patch.dict(tested_app.config, MAX_PICTURE_SIZE=len(small.getvalue())):
+            results = self.add_pictures(content_type='multipart/form-data',
+                                        data={'images': [(io.BytesIO(small.getvalue()), 'small.jpg'),
+                                                         (io.BytesIO(image_bytes()), 'big.jpg'),
+                                                         (io.BytesIO(small.getvalue()), 'small2.jpg')]})
+        self.assertEqual([(result["name"], result["code"]) for result in results],
+                         [("small", 200), ("big", 413), ("small2", 200)])
+        self.assertEqual(self.uploads_left(), [])
+
+    def test_add_pics_failed_chunk(self):
+        small = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(small, "JPEG")
+        parts = [(io.BytesIO(small.getvalue()), 'chunk{}.jpg'.format(i)) for i in range(4)]
+        calls = []
+
+        def enqueue_many(kind, payloads):
+            # the second chunk finds the database locked
+            calls.append(kind)
+            if len(calls) == 2:
+                raise OperationalError("INSERT", {}, Exception("database is locked"))
+
+        with mock.patch.dict(tested_app.config, BATCH_INSERT_CHUNK=2), \
+                mock.patch('ImgManager.batch.enqueue_many', side_effect=enqueue_many):
+            results = self.add_pictures(content_type='multipart/form-data', data={'images': parts})
+        self.assertEqual([result["code"] for result in results], [200, 200, 503, 503])
+        self.assertEqual(Picture.query.filter(Picture.name.like("chunk%")).count(), 2)
+        self.assertEqual(self.uploads_left(), [])
@@ -0,0 +1,120 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from ImgManager import create_app
+from ImgManager.config import TestConfig
+from ImgManager.database import retry_locked, writer
+from ImgManager.models import Album
+from ImgManager.queryplan import explain, full_scans
+from ImgManager.schema import upgrade_database
+from support import DATABASE_URI, AppTestCase, tested_app, tested_db
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestDatabase(AppTestCase):
+    def test_display_album_uses_index(self):
+        # create_all upgrades databases made before the indexes existed
+        index_names = [row[1] for row in self.db.session.execute("PRAGMA index_list(picture)")]
+        self.assertIn("ix_picture_album_id_id", index_names)
+
+        cursor = self.db.session.connection().connection.cursor()
+        plan = explain(cursor, "SELECT id, name, album_id, path FROM picture WHERE album_id = ? ORDER BY id", (1,))
+        self.assertEqual(full_scans(plan), [])
+
+    def test_sqlite_tuning(self):
+        self.assertIsInstance(self.db.engine.pool, QueuePool)
+        self.assertEqual(self.db.session.execute("PRAGMA journal_mode").scalar(), "wal")
+        self.assertEqual(self.db.session.execute("PRAGMA busy_timeout").scalar(),
+                         tested_app.config["SQLITE_PRAGMAS"]["busy_timeout"])
+        self.db.session.rollback()
+
+        # writes take the process write lock until their transaction ends
+        writes = writer.stats()["writes"]
+        self.db.session.add(Album(name="Locked", person_id=1))
+        self.db.session.flush()
+        self.assertIsNotNone(writer.owner)
+        self.db.session.commit()
+        self.assertIsNone(writer.owner)
+        self.assertGreater(writer.stats()["writes"], writes)
+
+    def test_retry_locked(self):
+        calls = []
+
+        @retry_locked
+        def unit_of_work():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError("INSERT", {}, Exception("database is locked"))
+            return "done"
+
+        self.assertEqual(unit_of_work(), "done")
+        self.assertEqual(len(calls), 3)
+
+        # locked for good: the client is asked to come back later
+        with mock.patch('ImgManager.routes.Album.query') as query:
+            query.filter_by.side_effect = OperationalError("SELECT", {}, Exception("database is locked"))
+            self.login()
+            response = self.app.post("/createAlbum", data={"name": "Busy"})
+        self.assertEqual(response.status_code, 503)
+
+    def test_main_upgrades_database(self):
+        # the checked-in development database still has the schema of the first version
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, "dev.sqlite")
+        shutil.copy(os.path.join(ROOT, "ImgManager", "SOEN487_A1.sqlite"), path)
+        tested_app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+        # in reverse order: the session keeps the engine it was made with
+        self.addCleanup(tested_db.session.remove)
+        self.addCleanup(tested_app.config.__setitem__, "SQLALCHEMY_DATABASE_URI", DATABASE_URI)
+        self.addCleanup(lambda: tested_db.get_engine(tested_app).dispose())
+
+        with mock.patch.object(tested_app, "run") as run:
+            main.main()
+        run.assert_called_once_with(debug=True)
+        for path in ("/person", "/album", "/pictures"):
+            self.assertEqual(self.app.get(path).status_code, 200, path)
+
+    def test_upgrade_database(self):
+        # the tables as they were before pictures were stored by content
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "old.sqlite")
+        old = sqlite3.connect(path)
+        old.executescript("CREATE TABLE person (id INTEGER NOT NULL, name TEXT NOT NULL, password VARCHAR(120) NOT NULL, "
+                          "PRIMARY KEY (id), UNIQUE (name));"
+                          "CREATE TABLE album (id INTEGER NOT NULL, name VARCHAR(20) NOT NULL, person_id INTEGER NOT NULL, "
+                          "PRIMARY KEY (id));"
+                          "CREATE TABLE picture (id INTEGER NOT NULL, name VARCHAR(20) NOT NULL, album_id INTEGER NOT NULL, "
+                          "path VARCHAR(20) NOT NULL, PRIMARY KEY (id), UNIQUE (name));"
+                          "INSERT INTO person VALUES (1, 'Old', 'x'); INSERT INTO album VALUES (1, 'Old', 1);"
+                          "INSERT INTO picture VALUES (1, 'old', 1, 'old.jpg');")
+        old.close()
+        try:
+            other = create_app(type("Config", (TestConfig,), {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path}))
+            # building the app leaves the database alone
+            self.assertEqual(sorted(os.listdir(folder)), ["old.sqlite"])
+            upgrade_database(other)
+            tested_db.get_engine(other).dispose()
+            upgraded = sqlite3.connect(path)
+            try:
+                tables = {name for (name,) in upgraded.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                columns = {row[1] for row in upgraded.execute("PRAGMA table_info(picture)")}
+                rows = upgraded.execute("SELECT id, name, path FROM picture").fetchall()
+                sql = upgraded.execute("SELECT sql FROM sqlite_master WHERE name = 'picture'").fetchone()[0]
+                indexes = {row[1] for row in upgraded.execute("PRAGMA index_list(picture)")}
+            finally:
+                upgraded.close()
+        finally:
+            shutil.rmtree(folder)
+        self.assertTrue({"cache_generation", "job", "tombstone", "picture_metadata"} <= tables)
+        self.assertTrue({"digest", "status", "crc32", "dhash"} <= columns)
+        self.assertEqual(rows, [(1, "old", "old.jpg")])
+        # rebuilt with AUTOINCREMENT, and its indexes added back
+        self.assertIn("AUTOINCREMENT", sql)
+        self.assertTrue({"ix_picture_album_id_id", "ix_picture_path", "ix_picture_digest"} <= indexes)
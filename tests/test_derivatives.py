@@ -0,0 +1,83 @@
+import io
+import os
+import threading
+import time
+from unittest import mock
+from PIL import Image
+from ImgManager import derivatives
+from ImgManager.derivatives import derivative_cache
+from ImgManager.models import Picture
+from support import AppTestCase, tested_app
+
+
+class TestDerivatives(AppTestCase):
+    def variants(self):
+        folder = tested_app.config["DERIVATIVE_FOLDER"]
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(folder) for name in names)
+
+    def test_get_picture_variant(self):
+        self.login()
+        picture_id = self.upload("thumb")
+
+        response = self.app.get("/picture/{}?w=64&fmt=png".format(picture_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+        thumbnail = Image.open(io.BytesIO(response.data))
+        self.assertEqual(thumbnail.width, 64)
+
+        # the second request is served from the cache with the same validator
+        etag = response.headers["ETag"]
+        response = self.app.get("/picture/{}?w=64&fmt=png".format(picture_id), headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get("/picture/{}?w=0".format(picture_id))
+        self.assertEqual(response.status_code, 400)
+
+    def test_cache_budget(self):
+        self.login()
+        picture = Picture.query.get(self.upload("evicted"))
+        with tested_app.app_context():
+            first = derivative_cache.get(picture.path, picture.digest, 32, "png")
+            size = os.path.getsize(first)
+            # older than the ones rendered next, the least recently used
+            os.utime(first, (time.time() - 60, time.time() - 60))
+            # room for two and a half variants: the third one is over, and evicting
+            # down to 90% of the budget only takes the first
+            budget = size * 5 // 2
+            with mock.patch.dict(tested_app.config, DERIVATIVE_CACHE_BYTES=budget):
+                second = derivative_cache.get(picture.path, picture.digest, 33, "png")
+                third = derivative_cache.get(picture.path, picture.digest, 34, "png")
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(self.variants(), sorted([second, third]))
+        self.assertLessEqual(derivative_cache.total, budget)
+
+    def test_concurrent_requests_render_once(self):
+        self.login()
+        picture = Picture.query.get(self.upload("coalesced"))
+        render = derivatives.render
+        calls = []
+
+        def slow_render(*args):
+            calls.append(args)
+            # long enough for every thread to be waiting on the variant
+            time.sleep(0.2)
+            render(*args)
+
+        paths = []
+        start = threading.Barrier(4)
+
+        def get():
+            with tested_app.app_context():
+                start.wait()
+                paths.append(derivative_cache.get(picture.path, picture.digest, 48, "jpeg"))
+
+        with mock.patch("ImgManager.derivatives.render", side_effect=slow_render):
+            threads = [threading.Thread(target=get) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(len(paths), 4)
+        self.assertEqual(derivative_cache.key_locks, {})
@@ -0,0 +1,73 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+import zlib
+from unittest import mock
+from ImgManager.backends import get_backend
+from ImgManager.export import zip_layout
+from ImgManager.models import Picture
+from support import AppTestCase, image_bytes, tested_app
+
+
+class TestExport(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.login()
+        self.img_bytes = image_bytes()
+        self.picture_id = self.upload("exported")
+        self.member = '{}-exported.jpg'.format(self.picture_id)
+
+    def test_export_zip(self):
+        response = self.app.get('/album/1/export?format=zip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_length, len(response.data))
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+            self.assertIsNone(zf.testzip())
+            manifest = json.loads(zf.read('manifest.json').decode('utf-8'))
+            self.assertEqual(zf.read(self.member), self.img_bytes)
+        # the fixture pictures have no file but are still listed
+        self.assertEqual(len(manifest["pictures"]), 3)
+
+    def test_export_zip_resumes(self):
+        response = self.app.get('/album/1/export?format=zip')
+        full, etag = response.data, response.headers["ETag"]
+
+        # an interrupted download resumes where it stopped
+        response = self.app.get('/album/1/export?format=zip', headers={"Range": "bytes=100-", "If-Range": etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, full[100:])
+        response = self.app.get('/album/1/export?format=zip', headers={"Range": "bytes=100-", "If-Range": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, full)
+
+        # the CRCs stored at upload make the central directory, no file is read for it
+        self.assertEqual(Picture.query.get(self.picture_id).crc32, zlib.crc32(self.img_bytes))
+        with tested_app.app_context():
+            backend = get_backend()
+        tail = full.rindex(b"PK\x07\x08")
+        with mock.patch.object(backend, "open", side_effect=AssertionError("file read")):
+            response = self.app.get('/album/1/export?format=zip', headers={"Range": "bytes={}-".format(tail),
+                                                                           "If-Range": etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, full[tail:])
+
+    def test_export_short_file(self):
+        # a file shorter than planned fails the download instead of producing a wrong CRC
+        short = os.path.join(self.folders["PICTURE_FOLDER"], "short.jpg")
+        with open(short, "wb") as f:
+            f.write(self.img_bytes[:100])
+        layout = zip_layout([("short.jpg", short, len(self.img_bytes), 0)])
+        with self.assertRaises(IOError):
+            b"".join(layout.iter_range(layout.size - 100, layout.size))
+
+    def test_export_tar(self):
+        response = self.app.get('/album/1/export?format=tar')
+        self.assertEqual(response.status_code, 200)
+        with tarfile.open(fileobj=io.BytesIO(response.data)) as tf:
+            self.assertEqual(tf.extractfile(self.member).read(), self.img_bytes)
+
+    def test_export_invalid(self):
+        self.assertEqual(self.app.get('/album/1/export?format=rar').status_code, 400)
+        self.assertEqual(self.app.get('/album/99/export').status_code, 404)
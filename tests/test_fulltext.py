@@ -0,0 +1,52 @@
+import json
+from ImgManager import fulltext
+from ImgManager.models import Picture
+from support import AppTestCase, tested_app
+
+
+class TestFullText(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.login()
+        self.app.post("/createAlbum", data={"name": "Summer Holidays"})
+        for name in ("beach_sunset", "beach-party", "sunrise"):
+            self.upload(name)
+
+    def search(self, query):
+        """The sorted (kind, name) found by /search?query, and the cursor of the next page."""
+        response = self.app.get("/search?" + query)
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(str(response.data, "utf8"))
+        return sorted((item["kind"], item["name"]) for item in body["data"]), body["next"]
+
+    def test_search_names(self):
+        self.assertEqual(self.search("q=beach"), ([("picture", "beach-party"), ("picture", "beach_sunset")], None))
+        self.assertEqual(self.search("q=summ"), ([("album", "Summer Holidays")], None))
+        self.assertEqual(self.search("q=sun&kind=album"), ([], None))
+        self.assertEqual(self.search("q=beach sun")[0], [("picture", "beach_sunset")])
+
+        self.assertEqual(self.app.get("/search?q=%2B%2B").status_code, 400)
+        self.assertEqual(self.app.get("/search?q=beach&kind=person").status_code, 400)
+
+    def test_search_pages(self):
+        # keyset pages of one
+        seen = []
+        page, cursor = self.search("q=sun&limit=1")
+        while cursor:
+            seen += page
+            page, cursor = self.search("q=sun&limit=1&after=" + cursor)
+        seen += page
+        self.assertEqual(sorted(seen), [("picture", "beach_sunset"), ("picture", "sunrise")])
+
+    def test_index_follows_writes(self):
+        # renames and deletions reach the index
+        sunrise = Picture.query.filter_by(name="sunrise").first()
+        sunrise.name = "dawn"
+        self.db.session.commit()
+        self.assertEqual(self.search("q=dawn")[0], [("picture", "dawn")])
+        self.assertEqual(self.app.get("/deletePic/{}".format(sunrise.id)).status_code, 200)
+        self.assertEqual(self.search("q=dawn")[0], [])
+
+        with tested_app.app_context():
+            fulltext.rebuild()
+        self.assertEqual(len(self.search("q=beach")[0]), 2)
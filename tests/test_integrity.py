@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import time
+from unittest import mock
+from ImgManager import integrity
+from ImgManager.backends import get_backend
+from ImgManager.models import Picture
+from support import AppTestCase, tested_app, tested_db
+
+
+class TestIntegrity(AppTestCase):
+    def store(self, key, data, mtime=None):
+        """Write data under key in the picture folder, two hours old unless mtime says otherwise."""
+        path = os.path.join(tested_app.config["PICTURE_FOLDER"], *key.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        mtime = time.time() - 7200 if mtime is None else mtime
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_scan_storage(self):
+        self.login()
+        self.upload("scanned")
+
+        orphan = self.store("fe/ed/" + "fe" * 32 + ".jpg", b"orphan")
+        recent = self.store("fe/ed/" + "ed" * 32 + ".jpg", b"recent", time.time())
+        corrupt = "fe/ee/" + "ee" * 32 + ".jpg"
+        self.store(corrupt, b"not what the digest says")
+        missing = "fe/ef/" + "ef" * 32 + ".jpg"
+        stale = self.store(".upload-scan", b"half an upload")
+        self.db.session.add(Picture(name="corrupt", album_id=1, path=corrupt))
+        self.db.session.add(Picture(name="missing", album_id=1, path=missing))
+        # a row from before keys whose file is gone, the fixture's rows still find theirs
+        lost = "C:\\pictures\\lost.jpg"
+        self.db.session.add(Picture(name="lost", album_id=1, path=lost))
+        self.db.session.commit()
+
+        with tested_app.app_context():
+            findings = list(integrity.scan(verify=True, workers=2, batch_size=2))
+        self.assertEqual(sorted(findings), [("corrupt", corrupt), ("missing", lost), ("missing", missing),
+                                            ("orphan", "fe/ed/" + "fe" * 32 + ".jpg"), ("stale", ".upload-scan")])
+
+        with tested_app.app_context():
+            self.assertEqual(len(list(integrity.scan(delete=True))), 4)
+            self.assertEqual(list(integrity.scan()), [("missing", missing), ("missing", lost)])
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(recent))
+
+    def test_scan_holds_write_lock(self):
+        key = "fe/ed/" + "fe" * 32 + ".jpg"
+        path = self.store(key, b"orphan")
+
+        # an upload of the same bytes commits its row while the scan unlinks the orphan
+        database = tested_db.get_engine(tested_app).url.database
+        blocked = []
+        with tested_app.app_context():
+            backend = get_backend()
+            delete_many = backend.delete_many
+
+            def racing_delete(keys):
+                other = sqlite3.connect(database, timeout=0)
+                try:
+                    other.execute("UPDATE picture SET name = name")
+                except sqlite3.OperationalError as e:
+                    blocked.append(str(e))
+                finally:
+                    other.close()
+                return delete_many(keys)
+
+            with mock.patch.object(backend, "delete_many", racing_delete):
+                self.assertIn(("orphan", key), list(integrity.scan(delete=True)))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(blocked, ["database is locked"])
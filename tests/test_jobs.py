@@ -0,0 +1,20 @@
+import json
+from ImgManager.jobs import run_pending
+from ImgManager.models import Job
+from support import AppTestCase, tested_app
+
+
+class TestJobs(AppTestCase):
+    def test_add_pic_background_processing(self):
+        self.login()
+        picture_id = self.upload("later")
+
+        response = self.app.get("/picture/{}".format(picture_id))
+        self.assertEqual(json.loads(str(response.data, "utf8"))["status"], "pending")
+
+        with tested_app.app_context():
+            self.assertEqual(run_pending(), 1)
+
+        response = self.app.get("/picture/{}".format(picture_id))
+        self.assertEqual(json.loads(str(response.data, "utf8"))["status"], "ready")
+        self.assertEqual(Job.query.count(), 0)
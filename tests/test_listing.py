@@ -0,0 +1,36 @@
+import json
+from unittest import mock
+from flask import jsonify
+from ImgManager.models import row2dict, Picture
+from support import AppTestCase, tested_app
+
+
+class TestListing(AppTestCase):
+    def test_get_all_person_paginated(self):
+        response = self.app.get("/person?limit=1")
+        self.assertEqual(response.status_code, 200)
+
+        page = json.loads(str(response.data, "utf8"))
+        self.assertEqual(page["data"], [{"id": "1", "name": "Alice"}])
+        self.assertEqual(page["next"], "1")
+
+        # follow the cursor, projecting only the name
+        response = self.app.get("/person?limit=1&fields=name&after=" + page["next"])
+        page = json.loads(str(response.data, "utf8"))
+        self.assertEqual(page["data"], [{"name": "Bob"}])
+        self.assertIsNone(page["next"])
+
+    def test_get_all_person_invalid_fields(self):
+        response = self.app.get("/person?fields=password")
+        self.assertEqual(response.status_code, 400)
+
+    def test_streamed_listing_matches_jsonify(self):
+        for pretty in (False, True):
+            with mock.patch.dict(tested_app.config, JSONIFY_PRETTYPRINT_REGULAR=pretty, RESPONSE_CACHE_ENABLED=False):
+                response = self.app.get("/pictures")
+                self.assertEqual(response.status_code, 200)
+
+                # the streamed body must stay byte for byte what jsonify produced
+                with tested_app.test_request_context():
+                    expected = jsonify([row2dict(picture) for picture in Picture.query.all()]).get_data()
+            self.assertEqual(response.data, expected)
@@ -0,0 +1,118 @@
+import io
+import json
+import struct
+import warnings
+from PIL import Image, TiffImagePlugin
+from ImgManager import metadata
+from ImgManager.models import Picture, PictureMetadata
+from ImgManager.queryplan import explain, full_scans
+from ImgManager.schema import upgrade_database
+from support import AppTestCase, image_bytes, tested_app
+
+
+def exif_block(tags):
+    """The EXIF bytes of a JPEG APP1 segment holding tags, {TIFF tag: value}.
+
+    Built from an ImageFileDirectory_v2, Image.Exif only came with Pillow 6.
+    """
+    ifd = TiffImagePlugin.ImageFileDirectory_v2()
+    for tag, value in tags.items():
+        ifd[tag] = value
+    tiff = io.BytesIO()
+    ifd.save(tiff)
+    return b"Exif\x00\x00" + tiff.getvalue()
+
+
+class TestMetadata(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.login()
+        self.original = image_bytes()
+        self.upload("plain", self.original)
+        for name, size, taken in (("canon2019", (300, 200), "2019:05:04 10:00:00"),
+                                  ("canon2020", (100, 50), "2020:01:02 03:04:05")):
+            data = io.BytesIO()
+            with Image.open(io.BytesIO(self.original)) as img:
+                # Make, Model and DateTime
+                exif = exif_block({0x010f: "Canon", 0x0110: "EOS 5D", 0x0132: taken})
+                img.convert("RGB").resize(size).save(data, "JPEG", exif=exif)
+            self.upload(name, data.getvalue())
+
+    def names(self, query):
+        """The names of the pictures found by /pictures/search?query, and the cursor of the next page."""
+        response = self.app.get("/pictures/search?" + query)
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(str(response.data, "utf8"))
+        return [picture["name"] for picture in body["data"]], body["next"]
+
+    def test_read_at_upload(self):
+        # read at upload, before any processing
+        plain = Picture.query.filter_by(name="plain").first()
+        row = PictureMetadata.query.get(plain.id)
+        self.assertEqual((row.width, row.height, row.format, row.size), (600, 600, "JPEG", len(self.original)))
+        self.assertIsNone(row.taken_at)
+
+        response = self.app.get("/deletePic/{}".format(plain.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(PictureMetadata.query.get(plain.id))
+
+    def test_search_pictures(self):
+        self.assertEqual(self.names("camera_make=Canon&sort=taken_at"), (["canon2019", "canon2020"], None))
+        self.assertEqual(self.names("taken_after=2019-06-01"), (["canon2020"], None))
+        self.assertEqual(self.names("min_width=200&max_height=300"), (["canon2019"], None))
+
+        # keyset pages, widest first
+        page, cursor = self.names("sort=-width&limit=2")
+        self.assertEqual(page, ["plain", "canon2019"])
+        self.assertEqual(self.names("sort=-width&limit=2&after=" + cursor), (["canon2020"], None))
+
+        self.assertEqual(self.app.get("/pictures/search?sort=name").status_code, 400)
+        self.assertEqual(self.app.get("/pictures/search?taken_after=May").status_code, 400)
+
+    def test_corrupt_exif(self):
+        # an Exif sub-IFD pointer that is negative, Pillow fails seeking to it
+        tiff = b"II*\x00" + struct.pack("<IH", 8, 1) + struct.pack("<HHIi", 0x8769, 9, 1, -1) + b"\x00" * 4
+        parts = []
+        for name, options in (("corrupt_jfif", {"dpi": (72, 72)}), ("corrupt", {})):
+            data = io.BytesIO()
+            Image.new("RGB", (30, 20)).save(data, "JPEG", exif=b"Exif\x00\x00" + tiff, **options)
+            parts.append((io.BytesIO(data.getvalue()), name + ".jpg"))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            response = self.app.post('/Album/1/addPictures', content_type='multipart/form-data',
+                                     data={'images': parts + [(io.BytesIO(image_bytes()), 'fine.jpg')]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["code"] for result in json.loads(str(response.data, "utf8"))["results"]],
+                         [200, 200, 200])
+
+        rows = {picture.name: PictureMetadata.query.get(picture.id)
+                for picture in Picture.query.filter(Picture.name.in_(["corrupt_jfif", "corrupt", "fine"]))}
+        # the size is still read when Pillow only trips on the EXIF after opening the file
+        self.assertEqual((rows["corrupt_jfif"].width, rows["corrupt_jfif"].format), (30, "JPEG"))
+        self.assertIsNone(rows["corrupt_jfif"].camera_make)
+        self.assertIsNone(rows["corrupt"].width)
+        self.assertEqual(rows["fine"].width, 600)
+
+    def test_format_uses_index(self):
+        self.assertEqual(self.names("format=JPEG&sort=taken_at"), (["canon2019", "canon2020"], None))
+
+        # databases made before the index get it on upgrade
+        self.db.session.execute("DROP INDEX ix_picture_metadata_format")
+        self.db.session.commit()
+        upgrade_database(tested_app)
+        index_names = [row[1] for row in self.db.session.execute("PRAGMA index_list(picture_metadata)")]
+        self.assertIn("ix_picture_metadata_format", index_names)
+        cursor = self.db.session.connection().connection.cursor()
+        plan = explain(cursor, "SELECT picture_id FROM picture_metadata WHERE format = ? "
+                               "ORDER BY taken_at, picture_id", ("JPEG",))
+        self.assertEqual(full_scans(plan), [])
+        self.db.session.rollback()
+
+    def test_backfill(self):
+        # pictures stored before the extraction existed
+        PictureMetadata.query.delete()
+        self.db.session.commit()
+        with tested_app.app_context():
+            done, missing = metadata.backfill(workers=2)
+        self.assertGreaterEqual(done, 3)
+        self.assertEqual(self.names("camera_model=EOS 5D")[0], ["canon2019", "canon2020"])
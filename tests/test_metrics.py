@@ -0,0 +1,65 @@
+import json
+import os
+import re
+from types import SimpleNamespace
+from unittest import mock
+from ImgManager.metrics import _count_bytes
+from support import AppTestCase, tested_app
+
+
+class TestMetrics(AppTestCase):
+    def sample(self, name):
+        """The value of the sample name on /metrics, 0 before it is first recorded."""
+        found = re.search(re.escape(name) + r" (\S+)\n", self.app.get("/metrics").data.decode("utf-8"))
+        return float(found.group(1)) if found else 0.0
+
+    def test_metrics(self):
+        self.login()
+        picture_id = self.upload('measured')
+        # the metrics are per process: only what this test adds to them counts.
+        # The variant is rendered here, setUp gave the test an empty DERIVATIVE_FOLDER.
+        pillow = 'imgmanager_work_seconds_total{endpoint="get_picture",kind="pillow"}'
+        before = self.sample(pillow)
+        self.assertEqual(os.listdir(tested_app.config["DERIVATIVE_FOLDER"]), [])
+        self.assertEqual(self.app.get('/picture/{}?w=16'.format(picture_id)).status_code, 200)
+        self.assertGreater(self.sample(pillow), before)
+
+        self.assertEqual(self.app.get("/album/1").status_code, 200)
+        response = self.app.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        text = response.data.decode("utf-8")
+        self.assertIn('imgmanager_request_duration_seconds_count{endpoint="login",method="POST",status="200"}', text)
+        self.assertIn('imgmanager_request_sql_statements_bucket{endpoint="get_album",le="+Inf"}', text)
+        self.assertIn('imgmanager_work_seconds_total{endpoint="login",kind="bcrypt"}', text)
+        self.assertIn('imgmanager_request_bytes_total{endpoint="add_pic",direction="in"}', text)
+
+    def test_slow_request_logged(self):
+        # every request is slow, so it is logged with its queries
+        with mock.patch.dict(tested_app.config, SLOW_REQUEST_SECONDS=0):
+            with self.assertLogs('ImgManager.metrics', level='WARNING') as logs:
+                self.app.get("/album/1")
+        self.assertIn("SELECT", logs.output[0])
+
+    def test_streamed_body_counted_when_closed(self):
+        # the queries of a streamed body are counted once it is sent and closed
+        statements = 'imgmanager_request_sql_statements_sum{endpoint="get_all_person"}'
+        before = self.sample(statements)
+        with mock.patch.dict(tested_app.config, RESPONSE_CACHE_ENABLED=False):
+            response = self.app.get("/person", buffered=True)
+        self.assertEqual(len(json.loads(response.data.decode("utf-8"))), 2)
+        self.assertGreater(self.sample(statements), before)
+
+    def test_streamed_str_counted_encoded(self):
+        metrics = SimpleNamespace(sent=0)
+        self.assertEqual(list(_count_bytes(iter(["Sénécal", b"\xff"]), metrics, "utf-8")), ["Sénécal", b"\xff"])
+        self.assertEqual(metrics.sent, len("Sénécal".encode("utf-8")) + 1)
+
+    def test_failed_request_counted(self):
+        errors = 'imgmanager_request_duration_seconds_count{endpoint="get_person",method="GET",status="500"}'
+        before = self.sample(errors)
+        with mock.patch('ImgManager.routes.Person.query') as query, \
+                mock.patch.dict(tested_app.config, RESPONSE_CACHE_ENABLED=False, PRESERVE_CONTEXT_ON_EXCEPTION=False):
+            query.filter_by.side_effect = RuntimeError("broken")
+            with self.assertRaises(RuntimeError):
+                self.app.get("/person/1")
+        self.assertEqual(self.sample(errors), before + 1)
@@ -1,44 +1,15 @@
-import unittest
 import json
 import io
 import os
 from ImgManager import app as tested_app
-from ImgManager import db as tested_db
-from ImgManager.models import Person, Album, Picture
+from ImgManager.models import Person, Album, Picture, Tombstone
+from ImgManager.jobs import run_pending
+from support import AppTestCase
 
 # tested_app.config.from_object(TestConfig)
 
 
-class TestPerson(unittest.TestCase):
-    def setUp(self):
-        # set up the test DB
-        self.db = tested_db
-        self.db.create_all()
-        self.app = tested_app.test_client()
-
-        # Setting up some testing Data
-        self.app.post("/register", data={"name": "Alice", "password": "Alice123"})
-        self.app.post("/register", data={"name": "Bob", "password": "Bob123"})
-
-        self.app.post("/login", data={"name": "Bob", "password": "Bob123"})
-        self.app.post("/createAlbum", data={"name": "Album1"})
-        self.app.post("/logout")
-        picture_path = os.path.join(tested_app.root_path + '\pictures', 'test_img.jpg')
-        picture_path2 = os.path.join(tested_app.root_path + '\pictures', 'test_img2.jpg')
-
-        new_pic = Picture(name='tst_img', album_id=1, path=picture_path)
-        new_pic2 = Picture(name='tst_img2', album_id=1, path=picture_path2)
-        self.db.session.add(new_pic)
-        self.db.session.add(new_pic2)
-        self.db.session.commit()
-
-    def tearDown(self):
-        # clean up the DB after the tests
-        Person.query.delete()
-        Album.query.delete()
-        Picture.query.delete()
-        self.db.session.commit()
-
+class TestPerson(AppTestCase):
     def test_get_all_person(self):
         # send the request and check the response status code
         response = self.app.get("/person")
@@ -201,8 +172,8 @@ class TestPerson(unittest.TestCase):
     def test_display_all_pic(self):
         response = self.app.get("/pictures")
         picture_list = json.loads(str(response.data, "utf8"))
-        self.assertEqual(picture_list[0], {"id": "1", "name": "tst_img", "album_id": "1", "path": 'C:\\Users\\joedu\\Desktop\SOEN487_A1\\ImgManager\\pictures\\test_img.jpg'})
-        self.assertEqual(picture_list[1], {"id": "2", "name": "tst_img2", "album_id": "1", "path": 'C:\\Users\joedu\\Desktop\\SOEN487_A1\\ImgManager\\pictures\\test_img2.jpg'})
+        self.assertEqual(picture_list[0], {"id": "1", "name": "tst_img", "album_id": "1", "status": "ready", "path": 'C:\\Users\\joedu\\Desktop\SOEN487_A1\\ImgManager\\pictures\\test_img.jpg'})
+        self.assertEqual(picture_list[1], {"id": "2", "name": "tst_img2", "album_id": "1", "status": "ready", "path": 'C:\\Users\joedu\\Desktop\\SOEN487_A1\\ImgManager\\pictures\\test_img2.jpg'})
 
     def test_get_picture(self):
         # send the request and check the response status code
@@ -211,7 +182,7 @@ class TestPerson(unittest.TestCase):
 
         # convert the response data from json and call the asserts
         picture = json.loads(str(response.data, "utf8"))
-        self.assertDictEqual(picture, {"id": "1", "name": "tst_img", "album_id": "1", "path": 'C:\\Users\\joedu\\Desktop\SOEN487_A1\\ImgManager\\pictures\\test_img.jpg'})
+        self.assertDictEqual(picture, {"id": "1", "name": "tst_img", "album_id": "1", "status": "ready", "path": 'C:\\Users\\joedu\\Desktop\SOEN487_A1\\ImgManager\\pictures\\test_img.jpg'})
 
     def test_add_pic_OtherAlbum(self):
         response = self.app.post("/register", data={"name": "PicTest", "password": "PicTest123"})
@@ -233,6 +204,10 @@ class TestPerson(unittest.TestCase):
                                  data={'image': (imgBytesIO, 'test_img.jpg'), 'name': 'testImg1'})
         self.assertEqual(response.status_code, 403)
 
+        response = self.app.post('/Album/100000/addPicture', content_type='multipart/form-data',
+                                 data={'image': (io.BytesIO(b"unused"), 'test_img.jpg'), 'name': 'testImg1'})
+        self.assertEqual(response.status_code, 404)
+
     def test_delete_pic(self):
         init_pic_count = Picture.query.count()
         response = self.app.post("/login", data={"name": "Bob", "password": "Bob123"})
@@ -268,9 +243,9 @@ class TestPerson(unittest.TestCase):
     def test_display_album(self):
         response = self.app.get("/picture/Album/1")
         picture_list = json.loads(str(response.data, "utf8"))
-        self.assertEqual(picture_list[0], {"id": "1", "name": "tst_img", "album_id": "1",
+        self.assertEqual(picture_list[0], {"id": "1", "name": "tst_img", "album_id": "1", "status": "ready",
                                            "path": 'C:\\Users\\joedu\\Desktop\SOEN487_A1\\ImgManager\\pictures\\test_img.jpg'})
-        self.assertEqual(picture_list[1], {"id": "2", "name": "tst_img2", "album_id": "1",
+        self.assertEqual(picture_list[1], {"id": "2", "name": "tst_img2", "album_id": "1", "status": "ready",
                                            "path": 'C:\\Users\joedu\\Desktop\\SOEN487_A1\\ImgManager\\pictures\\test_img2.jpg'})
 
     def test_display_album_invalid_id(self):
@@ -318,9 +293,18 @@ class TestPerson(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
 
         init_pic_count = Picture.query.count()
+        key = Picture.query.filter_by(name="testImg1").first().path
+        path = os.path.join(tested_app.config["PICTURE_FOLDER"], *key.split("/"))
 
         response = self.app.post("/deleteAlbum/2")
         self.assertEqual(response.status_code, 200)
 
         pic_count = Picture.query.count()
         self.assertEqual(init_pic_count - 2, pic_count)
+
+        # the files are unlinked by the reaper, after the request
+        self.assertEqual(Tombstone.query.count(), 1)
+        with tested_app.app_context():
+            run_pending()
+        self.assertEqual(Tombstone.query.count(), 0)
+        self.assertFalse(os.path.exists(path))
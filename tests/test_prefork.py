@@ -0,0 +1,59 @@
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        # a database of its own, created by --upgrade-db, the checked-in one is left alone
+        self.env = dict(os.environ, IMGMANAGER_CONFIG="prod", PYTHONPATH=ROOT,
+                        IMGMANAGER_DATABASE_URI="sqlite:///" + os.path.join(folder, "prefork.sqlite"))
+        self.log = tempfile.TemporaryFile()
+        self.addCleanup(self.log.close)
+
+    def serve(self, *args):
+        """A serve.py process started with args, and the port it listens on."""
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, "serve.py"), "--bind", "127.0.0.1:0",
+                                   "--upgrade-db"] + list(args),
+                                  cwd=ROOT, env=self.env, stdout=self.log, stderr=subprocess.STDOUT)
+        for _ in range(100):
+            time.sleep(0.1)
+            found = re.search(rb"Listening on http://127\.0\.0\.1:(\d+)", self.output())
+            if found:
+                return server, int(found.group(1))
+        server.kill()
+        server.wait()
+        self.fail("the server did not start: {!r}".format(self.output()))
+
+    def output(self):
+        self.log.seek(0)
+        return self.log.read()
+
+    def test_replace_and_reload_workers(self):
+        server, port = self.serve("--workers", "2", "--max-requests", "2", "--max-requests-jitter", "0")
+
+        def get():
+            with urllib.request.urlopen("http://127.0.0.1:{}/person".format(port), timeout=10) as response:
+                return response.status
+
+        try:
+            # workers are replaced every 2 requests, then all of them on reload
+            self.assertEqual([get() for _ in range(6)], [200] * 6)
+            server.send_signal(signal.SIGHUP)
+            self.assertEqual([get() for _ in range(6)], [200] * 6)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            self.assertEqual(server.wait(30), 0)
+        self.assertIn(b"stopping: served 2 requests", self.output())
+        self.assertIn(b"Reloading", self.output())
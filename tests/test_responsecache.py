@@ -0,0 +1,37 @@
+import json
+from ImgManager.responsecache import response_cache
+from support import AppTestCase
+
+
+class TestResponseCache(AppTestCase):
+    def test_response_cache(self):
+        hits = response_cache.stats()["hits"]
+        first = self.app.get("/picture/Album/1")
+        self.assertEqual(first.status_code, 200)
+        # the streamed body is kept once it has been sent whole
+        self.assertTrue(first.data)
+        second = self.app.get("/picture/Album/1")
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers["ETag"], first.headers["ETag"])
+        self.assertEqual(response_cache.stats()["hits"], hits + 1)
+
+        response = self.app.get("/picture/Album/1", headers={"If-None-Match": first.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def test_write_invalidates(self):
+        etag = self.app.get("/picture/Album/1").headers["ETag"]
+
+        # a committed write to a table the response depends on changes its key
+        self.login()
+        response = self.app.get("/deletePic/1")
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get("/picture/Album/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(str(response.data, "utf8"))), 1)
+
+        # an album write changes the album listing of pictures, not /pictures
+        etag = response.headers["ETag"]
+        pictures_etag = self.app.get("/pictures").headers["ETag"]
+        self.app.post("/createAlbum", data={"name": "Unrelated"})
+        self.assertNotEqual(self.app.get("/picture/Album/1").headers["ETag"], etag)
+        self.assertEqual(self.app.get("/pictures").headers["ETag"], pictures_etag)
@@ -0,0 +1,95 @@
+import io
+import json
+from PIL import Image
+from ImgManager.jobs import run_pending
+from ImgManager.models import Picture
+from ImgManager.similarity import backfill, from_db, similarity_index
+from support import AppTestCase, image_bytes, tested_app
+
+
+class TestSimilarity(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        # the index lives as long as the process, it is reloaded from this test's rows
+        similarity_index.generations = None
+        self.login()
+        # the same photo, smaller and compressed harder
+        self.small = io.BytesIO()
+        with Image.open(io.BytesIO(image_bytes())) as img:
+            img.convert("RGB").resize((img.width // 3, img.height // 3)).save(self.small, "JPEG", quality=40)
+        self.original_id = self.upload("original")
+        self.smaller_id = self.upload("smaller", self.small.getvalue())
+
+    def similar(self, picture_id, query=""):
+        """The ids found by /picture/<picture_id>/similar?query."""
+        response = self.app.get("/picture/{}/similar?{}".format(picture_id, query))
+        self.assertEqual(response.status_code, 200)
+        return [row["id"] for row in json.loads(str(response.data, "utf8"))["data"]]
+
+    def test_similar_pictures(self):
+        response = self.app.get("/picture/{}/similar".format(self.original_id))
+        self.assertEqual(response.status_code, 404)
+        with tested_app.app_context():
+            run_pending()
+        self.assertIsNotNone(Picture.query.get(self.original_id).dhash)
+
+        response = self.app.get("/picture/{}/similar?maxdist=6".format(self.original_id))
+        self.assertEqual(response.status_code, 200)
+        found = json.loads(str(response.data, "utf8"))["data"]
+        self.assertEqual([row["id"] for row in found], [str(self.smaller_id)])
+        self.assertLessEqual(found[0]["distance"], 6)
+        self.assertNotIn("dhash", found[0])
+        self.assertEqual(self.app.get("/picture/{}/similar?maxdist=64".format(self.original_id)).status_code, 400)
+
+        response = self.app.get("/deletePic/{}".format(self.smaller_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.similar(self.original_id, "maxdist=6"), [])
+
+    def test_stale_and_pending_rows(self):
+        with tested_app.app_context():
+            run_pending()
+
+        # a match the index still has, deleted elsewhere, does not eat into the limit
+        similarity_index.hashes.add(0, from_db(Picture.query.get(self.original_id).dhash))
+        self.assertEqual(self.similar(self.original_id, "maxdist=6&limit=1"), [str(self.smaller_id)])
+        self.assertIsNone(similarity_index.hashes.get(0))
+
+        # a row stuck in pending is looked up again by id, the scan goes on past it
+        stuck = Picture(name="stuck", album_id=1, path="stuck.jpg", status="pending")
+        self.db.session.add(stuck)
+        self.db.session.commit()
+        stuck_id = stuck.id
+        with tested_app.app_context():
+            similarity_index.sync()
+            self.assertIn(stuck_id, similarity_index.pending)
+            self.assertGreaterEqual(similarity_index.watermark, stuck_id)
+            Picture.query.filter_by(id=stuck_id).update({"dhash": 1, "status": "ready"})
+            self.db.session.commit()
+            similarity_index.sync()
+            self.assertNotIn(stuck_id, similarity_index.pending)
+            self.assertEqual(similarity_index.hashes.get(stuck_id), 1)
+
+    def test_ids_not_reused(self):
+        with tested_app.app_context():
+            run_pending()
+        self.assertEqual(self.similar(self.original_id, "maxdist=6"), [str(self.smaller_id)])
+
+        # an upload right after the last picture is deleted does not take over its id
+        self.assertEqual(self.app.get("/deletePic/{}".format(self.smaller_id)).status_code, 200)
+        again_id = self.upload("again", self.small.getvalue())
+        self.assertGreater(again_id, self.smaller_id)
+        self.assertEqual(self.app.get("/picture/{}/similar".format(again_id)).status_code, 404)
+        with tested_app.app_context():
+            run_pending()
+        self.assertEqual(self.similar(self.original_id, "maxdist=6"), [str(again_id)])
+
+    def test_backfill(self):
+        with tested_app.app_context():
+            run_pending()
+        # pictures stored before the hashes existed
+        Picture.query.filter_by(id=self.original_id).update({"dhash": None})
+        self.db.session.commit()
+        with tested_app.app_context():
+            hashed, missing = backfill()
+        self.assertGreaterEqual(hashed, 1)
+        self.assertIsNotNone(Picture.query.get(self.original_id).dhash)
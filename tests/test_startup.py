@@ -0,0 +1,42 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from ImgManager import app as tested_app
+from ImgManager import db as tested_db
+from ImgManager import create_app
+from ImgManager.config import TestConfig
+from ImgManager.prefork import APP_CHECK
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        check = ("import sys, ImgManager.models; print('ImgManager.routes' in sys.modules); "
+                 "from ImgManager import app; print('PIL' in sys.modules)")
+        output = subprocess.check_output([sys.executable, "-c", check], cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT),
+                                         stderr=subprocess.DEVNULL)
+        # the routes come with the app, Pillow with the first image route
+        self.assertEqual(output.split(), [b"False", b"False"])
+
+    def test_app_leaves_database_alone(self):
+        # a database SQLite could not even open: any connection would fail the import
+        env = dict(os.environ, PYTHONPATH=ROOT, IMGMANAGER_DATABASE_URI="sqlite:////nonexistent/imgmanager.sqlite")
+        for statement in (APP_CHECK, "from ImgManager import app", "import ImgManager.manage"):
+            subprocess.check_call([sys.executable, "-c", statement], cwd=ROOT, env=env, stderr=subprocess.DEVNULL)
+
+    def test_create_app(self):
+        folder = tempfile.mkdtemp()
+        try:
+            other = create_app(type("Config", (TestConfig,), {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(folder, "other.sqlite")}))
+            tested_db.get_engine(other).dispose()
+        finally:
+            shutil.rmtree(folder)
+        self.assertIsNot(other, tested_app)
+        self.assertTrue(other.testing)
+        self.assertEqual(sorted(rule.rule for rule in other.url_map.iter_rules()),
+                         sorted(rule.rule for rule in tested_app.url_map.iter_rules()))
@@ -0,0 +1,140 @@
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
+from ImgManager.backends import get_backend
+from ImgManager.jobs import run_pending
+from ImgManager.models import Picture
+from ImgManager.storage import KEY_PATTERN, migrate_paths
+from support import AppTestCase, image_bytes, tested_app, tested_db
+
+
+class TestStorage(AppTestCase):
+    def test_add_pic_deduplicates(self):
+        self.login()
+        dup1_id = self.upload("dup1")
+        dup2_id = self.upload("dup2")
+
+        dup1 = Picture.query.get(dup1_id)
+        self.assertEqual(dup1.path, Picture.query.get(dup2_id).path)
+        self.assertRegex(dup1.path, KEY_PATTERN)
+        path = os.path.join(tested_app.config["PICTURE_FOLDER"], *dup1.path.split("/"))
+        self.assertTrue(os.path.exists(path))
+
+        # the file stays until its last picture is deleted
+        response = self.app.get("/deletePic/" + str(dup1_id))
+        self.assertEqual(response.status_code, 200)
+        with tested_app.app_context():
+            run_pending()
+        self.assertTrue(os.path.exists(path))
+
+        response = self.app.get("/deletePic/" + str(dup2_id))
+        self.assertEqual(response.status_code, 200)
+        with tested_app.app_context():
+            run_pending()
+        self.assertFalse(os.path.exists(path))
+
+    def test_add_pic_not_an_image(self):
+        self.login()
+        response = self.app.post('/Album/1/addPicture', content_type='multipart/form-data',
+                                 data={'image': (io.BytesIO(b"not a picture"), 'test_img.jpg'), 'name': 'fake'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_add_pic_too_large(self):
+        self.login()
+        with mock.patch.dict(tested_app.config, MAX_PICTURE_SIZE=1024):
+            response = self.app.post('/Album/1/addPicture', content_type='multipart/form-data',
+                                     data={'image': (io.BytesIO(image_bytes()), 'test_img.jpg'), 'name': 'big'})
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(Picture.query.filter_by(name="big").count(), 0)
+
+    def test_get_picture_raw(self):
+        self.login()
+        img_bytes = image_bytes()
+        picture = Picture.query.get(self.upload("raw"))
+
+        response = self.app.get("/picture/{}/raw".format(picture.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, img_bytes)
+        self.assertEqual(response.headers["ETag"], '"{}"'.format(picture.digest))
+        self.assertIn("immutable", response.headers["Cache-Control"])
+
+        # revalidation and byte ranges
+        response = self.app.get("/picture/{}/raw".format(picture.id), headers={"If-None-Match": '"{}"'.format(picture.digest)})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get("/picture/{}/raw".format(picture.id), headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, img_bytes[10:20])
+
+        response = self.app.get("/picture/1000000/raw")
+        self.assertEqual(response.status_code, 404)
+
+    def test_object_store_backend(self):
+        self.login()
+        img_bytes = image_bytes()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        # small parts so the upload is made of several
+        with mock.patch.dict(tested_app.config, STORAGE_BACKEND="objectstore", STORAGE_ROOT=root, STORAGE_PART_SIZE=4096):
+            picture_id = self.upload("remote")
+            key = Picture.query.get(picture_id).path
+            with tested_app.app_context():
+                self.assertIsNone(get_backend().local_path(key))
+                run_pending()
+            self.assertEqual(Picture.query.get(picture_id).status, "ready")
+
+            response = self.app.get('/picture/{}/raw'.format(picture_id))
+            self.assertEqual(response.data, img_bytes)
+            response = self.app.get('/picture/{}/raw'.format(picture_id), headers={"Range": "bytes=10-19"})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, img_bytes[10:20])
+            self.assertEqual(self.app.get('/picture/{}?w=32'.format(picture_id)).status_code, 200)
+
+            response = self.app.get("/deletePic/" + str(picture_id))
+            self.assertEqual(response.status_code, 200)
+            with tested_app.app_context():
+                run_pending()
+                self.assertFalse(get_backend().exists(key))
+
+    def test_migrate_storage(self):
+        # the fixture rows still hold the paths of the first version
+        with tested_app.app_context():
+            self.assertEqual(migrate_paths(), (2, 0))
+            for picture in Picture.query.filter_by(album_id=1):
+                self.assertRegex(picture.path, KEY_PATTERN)
+                self.assertTrue(get_backend().exists(picture.path))
+            # already converted rows are skipped
+            self.assertEqual(migrate_paths(), (0, 0))
+
+    def test_reaper_holds_write_lock(self):
+        self.login()
+        picture_id = self.upload("reaped")
+        key = Picture.query.get(picture_id).path
+        with tested_app.app_context():
+            run_pending()
+        self.assertEqual(self.app.get("/deletePic/" + str(picture_id)).status_code, 200)
+
+        # an upload of the same bytes commits its row while the reaper unlinks the file
+        database = tested_db.get_engine(tested_app).url.database
+        blocked = []
+        with tested_app.app_context():
+            backend = get_backend()
+            delete_many = backend.delete_many
+
+            def racing_delete(keys):
+                other = sqlite3.connect(database, timeout=0)
+                try:
+                    other.execute("UPDATE picture SET name = name")
+                except sqlite3.OperationalError as e:
+                    blocked.append(str(e))
+                finally:
+                    other.close()
+                return delete_many(keys)
+
+            with mock.patch.object(backend, "delete_many", racing_delete):
+                run_pending()
+            self.assertFalse(backend.exists(key))
+        self.assertEqual(blocked, ["database is locked"])
@@ -0,0 +1,17 @@
+import argparse
+import logging
+from ImgManager import app
+from ImgManager.jobs import run_worker
+from ImgManager.schema import upgrade_database
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the background job workers.")
+    parser.add_argument("--threads", type=int, default=None, help="worker threads (default: JOB_WORKER_THREADS)")
+    parser.add_argument("--upgrade-db", action="store_true",
+                        help="create missing tables, columns and indexes before running the jobs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.upgrade_db:
+        upgrade_database(app)
+    run_worker(app, threads=args.threads)